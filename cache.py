@@ -0,0 +1,135 @@
+# cache.py — кэш результатов обработки: одинаковый файл + одинаковые настройки = готовый результат
+
+import functools
+import hashlib
+import importlib.util
+import json
+import marshal
+import os
+import shutil
+import tempfile
+
+from mapped import MappedFile
+
+# Меняется вместе с форматом ключа; правки логики обработки учитывает code_version()
+CACHE_VERSION = 2
+CACHE_LIMIT_BYTES = 512 * 1024 * 1024
+
+# Модули, от кода которых зависит содержимое результата
+RESULT_MODULES = ('processor', 'sheetxml', 'passthrough', 'saver', 'sheetfeed')
+
+# Поля конфига, которые не влияют на содержимое результата
+VOLATILE_KEYS = ('input_file', 'output_file', 'use_result_cache', 'checkpoints', 'parallel_save',
+                 'parallel_load', 'keep_warm', 'parsed_cache', 'save_compression')
+
+
+def app_data_dir(*parts):
+    base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'Chik-chik', *parts)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    if isinstance(path, MappedFile):
+        return path.digest(chunk_size)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """
+    Отпечаток кода обработки: байт-код модулей RESULT_MODULES и версия openpyxl.
+    После обновления программы старые результаты не выдаются за новые.
+    """
+    import openpyxl
+
+    digest = hashlib.sha256(f"v{CACHE_VERSION}\n{openpyxl.__version__}\n".encode())
+    for name in RESULT_MODULES:
+        spec = importlib.util.find_spec(name)
+        code = spec.loader.get_code(name) if spec is not None else None
+        digest.update(marshal.dumps(code) if code is not None else name.encode())
+    return digest.hexdigest()
+
+
+def normalize_config(CONFIG):
+    data = {key: value for key, value in CONFIG.items() if key not in VOLATILE_KEYS}
+    # Кортежи и списки, порядок ключей — всё приводится к одному виду через JSON
+    return json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def result_key(CONFIG, source=None):
+    """source — уже открытый входной файл (mapped.MappedFile), чтобы не читать его ради хэша ещё раз."""
+    digest = hashlib.sha256()
+    digest.update(f"{code_version()}\n".encode())
+    digest.update(file_digest(source or CONFIG['input_file']).encode())
+    digest.update(normalize_config(CONFIG).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Готовые выходные файлы, сохранённые под ключом result_key().
+    Размер ограничен limit байтами; при переполнении удаляются давно не использованные (LRU по mtime).
+    """
+    suffix = '.xlsx'
+
+    def __init__(self, directory=None, limit=CACHE_LIMIT_BYTES):
+        self.directory = directory or app_data_dir('results')
+        self.limit = limit
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def fetch(self, key, output_file):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
+        # Как в saver.save_workbook: прерванное копирование не оставляет обрезанный результат
+        directory, name = os.path.split(os.path.abspath(output_file))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=f"~{name}.", suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, output_file)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        os.utime(path)
+        return True
+
+    def store(self, key, output_file):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.path(key) + '.tmp'
+        shutil.copyfile(output_file, tmp)
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        result = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(self.suffix) and os.path.isfile(path):
+                st = os.stat(path)
+                result.append((st.st_mtime, st.st_size, path))
+        return sorted(result)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        freed = 0
+        for _, size, path in self.entries():
+            os.remove(path)
+            freed += size
+        return freed
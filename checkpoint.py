@@ -0,0 +1,122 @@
+# checkpoint.py — контрольные точки обработки: после сбоя или остановки готовые листы не обрабатываются заново
+
+import json
+import os
+import pickle
+import shutil
+
+from openpyxl.utils.indexed_list import IndexedList
+
+from cache import app_data_dir
+from saver import write_sheet_part
+
+# Меняется, когда меняется формат файла или смысл сохранённых полей
+CHECKPOINT_VERSION = 2
+# Таблицы стилей книги, на номера записей которых ссылается XML готовых листов
+STYLE_TABLE_ATTRS = ('_fonts', '_fills', '_borders', '_protections', '_alignments', '_number_formats', '_cell_styles')
+
+
+def style_tables(wb):
+    return [getattr(wb, attr) for attr in STYLE_TABLE_ATTRS] + [wb._differential_styles.dxf]
+
+
+class Checkpoint:
+    """
+    Состояние обработки одного входного файла с одними настройками (ключ — result_key()).
+    sheets — {имя листа: диапазон данных}; done — {имя листа: файл с готовым XML листа}.
+    Готовый лист пишется на диск один раз, когда его обработка закончена, вместе со снимком таблиц стилей;
+    при сохранении результата этот XML берётся как есть. JSON — маленький, пишется атомарно (tmp + os.replace)
+    и ссылается только на уже записанные файлы.
+    """
+    origin = "контрольной точки"
+
+    def __init__(self, key, directory=None):
+        self.directory = directory or app_data_dir('checkpoints')
+        self.path = os.path.join(self.directory, key + '.json')
+        self.parts_dir = os.path.join(self.directory, key)
+        self.styles_path = os.path.join(self.parts_dir, 'styles.pickle')
+        self.sheets, self.done = self.load()
+        self.resumed = bool(self.sheets or self.done)
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}, {}
+        if data.get('version') != CHECKPOINT_VERSION:
+            return {}, {}
+        done = {name: part for name, part in data.get('done', {}).items()
+                if os.path.exists(os.path.join(self.parts_dir, part))}
+        return data.get('sheets', {}), done
+
+    def sheet(self, name):
+        return self.sheets.get(name)
+
+    def update(self, name, state):
+        self.sheets[name] = state
+        self.save()
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': CHECKPOINT_VERSION, 'sheets': self.sheets, 'done': self.done}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def restore_styles(self, wb):
+        """
+        Дописывает в таблицы стилей книги записи, добавленные обработкой готовых листов, — до обработки
+        остальных. Таблицы только что загруженной книги должны быть началом сохранённых; иначе (книга
+        уже изменена) готовые листы забываются и обрабатываются заново. Возвращает True, если листы взяты.
+        """
+        if not self.done:
+            return False
+        try:
+            with open(self.styles_path, 'rb') as f:
+                saved = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            saved = None
+        current = style_tables(wb)
+        if saved is None or len(saved) != len(current) or any(
+                len(old) < len(new) or list(old[:len(new)]) != list(new) for old, new in zip(saved, current)):
+            self.done = {}
+            return False
+        for old, new in zip(saved, current):
+            for item in old[len(new):]:
+                if isinstance(new, IndexedList):
+                    new._dict.setdefault(item, len(new))
+                    list.append(new, item)
+                else:
+                    new.append(item)
+        return True
+
+    def finish_sheet(self, ws):
+        """Записывает XML обработанного листа и снимок таблиц стилей. False — лист так сохранить нельзя."""
+        os.makedirs(self.parts_dir, exist_ok=True)
+        part = f"{ws.parent.worksheets.index(ws)}.xml"
+        path = os.path.join(self.parts_dir, part)
+        try:
+            if not write_sheet_part(ws, path + '.tmp'):
+                return False
+        except Exception:
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+            raise
+        os.replace(path + '.tmp', path)
+        with open(self.styles_path + '.tmp', 'wb') as f:
+            pickle.dump([list(table) for table in style_tables(ws.parent)], f, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.styles_path + '.tmp', self.styles_path)
+        self.done[ws.title] = part
+        self.save()
+        return True
+
+    def parts(self, wb):
+        """Готовый XML листов для записи результата: {id(ws): путь к файлу}."""
+        return {id(wb[name]): os.path.join(self.parts_dir, part)
+                for name, part in self.done.items() if name in wb.sheetnames}
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
@@ -0,0 +1,99 @@
+# export.py — выгрузка посчитанной иерархии рядом с результатом: CSV, JSONL или Parquet (если есть pyarrow)
+
+import csv
+import datetime
+import importlib.util
+import json
+import os
+import re
+from pathlib import Path
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+PARQUET_BATCH_ROWS = 10000
+BASE_COLUMNS = ['row', 'level', 'label', 'parent']
+
+
+def parquet_available():
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def export_path(output_file, sheet_name, fmt):
+    p = Path(output_file)
+    safe_sheet = re.sub(r'[\\/:*?"<>|]', '_', sheet_name)
+    return str(p.parent / f"{p.stem}.{safe_sheet}.{fmt}")
+
+
+def _text(value):
+    if value is None:
+        return None
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+class CsvExport:
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.file, delimiter=';')
+        self.writer.writerow(BASE_COLUMNS + columns)
+
+    def write(self, row, level, label, parent, values):
+        self.writer.writerow([row, level, label, parent] + ['' if v is None else _text(v) for v in values])
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlExport:
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.columns = columns
+
+    def write(self, row, level, label, parent, values):
+        record = {'row': row, 'level': level, 'label': label, 'parent': parent}
+        record.update(zip(self.columns, values))
+        self.file.write(json.dumps(record, ensure_ascii=False, default=_text))
+        self.file.write('\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetExport:
+    """Значения столбцов пишутся строками: тип ячеек в столбце Excel не обязан быть одинаковым."""
+
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.columns = columns
+        self.schema = pa.schema([('row', pa.int32()), ('level', pa.int8()), ('label', pa.string()), ('parent', pa.string())]
+                                + [(column, pa.string()) for column in columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.batch = []
+
+    def write(self, row, level, label, parent, values):
+        self.batch.append([row, level, label, parent] + [_text(v) for v in values])
+        if len(self.batch) >= PARQUET_BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            columns = list(zip(*self.batch))
+            arrays = [self.pa.array(values, type=field.type) for values, field in zip(columns, self.schema)]
+            self.writer.write_batch(self.pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+EXPORTERS = {'csv': CsvExport, 'jsonl': JsonlExport, 'parquet': ParquetExport}
+
+
+def open_export(fmt, path, columns):
+    """columns — буквы столбцов, значения которых выгружаются вслед за row/level/label/parent."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return EXPORTERS[fmt](path, columns)
@@ -1,10 +1,19 @@
 # main.py — Chik-chik — ФИНАЛЬНАЯ ВЕРСИЯ v6.0
 
 import sys
+import time
+
+STARTUP_STARTED = time.perf_counter()
+# Замер запуска включается до остальных импортов, иначе PyQt5 в отчёт не попадёт
+startup_profile = None
+if '--profile-startup' in sys.argv:
+    from profiling import StartupProfile
+    startup_profile = StartupProfile(STARTUP_STARTED)
+
 import os
+import copy
 import json
-import psutil
-import time
+import threading
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QPushButton, QLabel, QLineEdit, QFileDialog, QTextEdit, QGroupBox,
@@ -13,10 +22,14 @@ from PyQt5.QtWidgets import (
     QTabWidget, QTableWidget, QTableWidgetItem, QListWidget, QListWidgetItem,
     QHeaderView, QMessageBox, QFrame, QStyleFactory
 )
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QSize, QSettings, QFileInfo
+from PyQt5.QtCore import Qt, QThread, QObject, QTimer, pyqtSignal, QSize, QSettings, QFileInfo
 from PyQt5.QtGui import QFont, QColor, QIcon, QPalette
-import qdarkstyle
-from processor import process_excel
+from cache import ResultCache
+from pipeline import PIPELINE_DEPTH, run_pipeline
+from warm import WarmCache
+
+# processor (а с ним openpyxl) и psutil импортируются по требованию: окно появляется, не дожидаясь их,
+# а processor догружается в фоне сразу после показа окна (warm_up_imports)
 
 SETTINGS_FILE = "chikchik_settings.json"
 
@@ -102,6 +115,28 @@ class NumberFormatPreview(QLabel):
 # КОНФИГ
 # ======================
 
+# Уровни сжатия выходного файла: 0 — zip без сжатия (store), 1..9 — deflate
+SAVE_COMPRESSION_LEVELS = [
+    (0, "Без сжатия (быстро)"),
+    (1, "Быстрое"),
+    (6, "Стандартное"),
+    (9, "Максимальное"),
+]
+
+# Форматы выгрузки иерархии рядом с результатом (export.py)
+EXPORT_FORMAT_TITLES = [
+    (None, "Нет"),
+    ('csv', "CSV"),
+    ('jsonl', "JSON Lines"),
+    ('parquet', "Parquet"),
+]
+
+# Что делать с цветами, которых нет в закреплённой палитре шаблона (processor.RowState.pin_palette)
+PALETTE_UNKNOWN_TITLES = [
+    ('discover', "Определить уровни по файлу"),
+    ('flag', "Последний уровень и предупреждение"),
+]
+
 class Config:
     def __init__(self):
         self.input_file = ""
@@ -125,6 +160,22 @@ class Config:
         self.fill_color = None
         self.text_color = None
         self.grid_enabled = False
+        self.use_result_cache = True
+        self.compact_styles = True
+        self.column_styles = False
+        self.save_compression = 6
+        self.parallel_save = False
+        self.checkpoints = False
+        self.export_format = None
+        self.subtotal_columns = ['E']
+        self.subtotal_formulas = False
+        self.value_free_scan = True
+        self.palette = []
+        self.palette_unknown = 'discover'
+        self.keep_warm = False
+        self.parsed_cache = False
+        self.parallel_load = True
+        self.level_color_rules = False
         self.stages = {
             'grouping': True,
             'hierarchy': True,
@@ -133,6 +184,7 @@ class Config:
             'alignment': False,
             'formatting': False,
             'number_formats': False,
+            'subtotals': False,
             'large_file_mode': False,
         }
 
@@ -154,6 +206,22 @@ class Config:
             "fill_color": self.fill_color,
             "text_color": self.text_color,
             "grid_enabled": self.grid_enabled,
+            "use_result_cache": self.use_result_cache,
+            "compact_styles": self.compact_styles,
+            "column_styles": self.column_styles,
+            "save_compression": self.save_compression,
+            "parallel_save": self.parallel_save,
+            "checkpoints": self.checkpoints,
+            "export_format": self.export_format,
+            "subtotal_columns": self.subtotal_columns,
+            "subtotal_formulas": self.subtotal_formulas,
+            "value_free_scan": self.value_free_scan,
+            "palette": self.palette,
+            "palette_unknown": self.palette_unknown,
+            "keep_warm": self.keep_warm,
+            "parsed_cache": self.parsed_cache,
+            "parallel_load": self.parallel_load,
+            "level_color_rules": self.level_color_rules,
             "stages": self.stages
         }
 
@@ -174,6 +242,22 @@ class Config:
         self.fill_color = data.get("fill_color", None)
         self.text_color = data.get("text_color", None)
         self.grid_enabled = data.get("grid_enabled", False)
+        self.use_result_cache = data.get("use_result_cache", True)
+        self.compact_styles = data.get("compact_styles", True)
+        self.column_styles = data.get("column_styles", False)
+        self.save_compression = data.get("save_compression", 6)
+        self.parallel_save = data.get("parallel_save", False)
+        self.checkpoints = data.get("checkpoints", False)
+        self.export_format = data.get("export_format", None)
+        self.subtotal_columns = data.get("subtotal_columns", [])
+        self.subtotal_formulas = data.get("subtotal_formulas", False)
+        self.value_free_scan = data.get("value_free_scan", True)
+        self.palette = data.get("palette", [])
+        self.palette_unknown = data.get("palette_unknown", 'discover')
+        self.keep_warm = data.get("keep_warm", False)
+        self.parsed_cache = data.get("parsed_cache", False)
+        self.parallel_load = data.get("parallel_load", True)
+        self.level_color_rules = data.get("level_color_rules", False)
         self.stages = data.get("stages", {})
 
 
@@ -451,46 +535,339 @@ class AlignmentEditor(QWidget):
 # ======================
 
 class WorkerThread(QThread):
+    """
+    Выполняет пакет групп задач. В группе — задачи с одним и тем же входным файлом: файл читается один раз,
+    каждая задача получает свою копию обрабатываемых листов (fork_workbook).
+    Группы пакета идут конвейером (pipeline.run_pipeline): пока обрабатывается одна, файл следующей
+    уже читается, а результат предыдущей сжимается и записывается.
+    С «Держать книгу в памяти» разобранный файл и анализ его строк остаются в warm
+    (warm.WarmCache), и следующий запуск того же файла его не читает.
+    """
+    log_signal = pyqtSignal(object, str)
+    job_started_signal = pyqtSignal(object)
+    job_finished_signal = pyqtSignal(object, str, str)  # задача, статус из JOB_STATUSES, сообщение
+
+    def __init__(self, groups, warm):
+        super().__init__()
+        self.groups = groups
+        self.warm = warm
+        self.memory_estimate = pipeline_memory(groups)
+
+    def use_warm(self, jobs):
+        from processor import value_free_mode
+        # Лист без разбора (value_free_mode) обрабатывается быстрее, чем копируется тёплая книга
+        return isinstance(jobs[0].source_key, tuple) and any(
+            job.config.keep_warm and not value_free_mode(job.config.__dict__) for job in jobs)
+
+    def run(self):
+        run_pipeline(self.groups, self.load_group, self.process_group, self.write_job)
+
+    def load_group(self, jobs):
+        """
+        Стадия чтения. Возвращает ExcelRun одиночной задачи после шага read, (книга, тёплая запись)
+        для группы или None, если задачи группы уже завершены (ошибка чтения, остановка).
+        """
+        from processor import load_source, open_sheet_cache, report_sheet_cache
+        if all(job.stopped for job in jobs):
+            for job in jobs:
+                self.job_finished_signal.emit(job, 'stopped', "Остановлено пользователем")
+            return None
+        warm = self.use_warm(jobs)
+        if len(jobs) == 1 and not warm:
+            run = self.make_run(jobs[0])
+            if run is not None:
+                run.prefetch = len(self.groups) > 1
+                run.read()
+            return run
+
+        # Разбираются листы, выбранные хотя бы в одной из вкладок
+        sheet_names = list(dict.fromkeys(name for job in jobs for name in job.sheet_names))
+        key = jobs[0].source_key
+        workbook = entry = None
+        if warm:
+            entry = self.warm.get(key, sheet_names)
+            if entry is not None:
+                for job in jobs:
+                    self.log_signal.emit(job, f"🔥 Файл уже разобран в памяти — повторно не читается: {job.config.input_file}")
+        if entry is None:
+            if len(jobs) > 1:
+                for job in jobs:
+                    self.log_signal.emit(job, f"📦 Файл читается один раз для {len(jobs)} вкладок: {job.config.input_file}")
+            # Кэш разбора нужен, если он включён хотя бы в одной вкладке
+            cached = next((job for job in jobs if job.config.parsed_cache), jobs[0])
+            log = lambda message: self.log_signal.emit(cached, message)
+            try:
+                sheet_cache = open_sheet_cache(cached.config.__dict__, log)
+                workbook = load_source(jobs[0].config.input_file, sheet_names, sheet_cache=sheet_cache)
+            except Exception as e:
+                for job in jobs:
+                    self.job_finished_signal.emit(job, 'error', f"Исключение: {str(e)}")
+                return None
+            report_sheet_cache(sheet_cache, log)
+            if warm:
+                entry = self.warm.put(key, workbook, sheet_names, pipeline_memory([jobs]))
+                if entry is None:
+                    self.log_signal.emit(jobs[0], "ℹ️ Файл слишком большой, чтобы держать его в памяти между запусками")
+        return workbook, entry
+
+    def process_group(self, jobs, loaded, emit):
+        """Стадия обработки: готовые к записи задачи уходят в emit."""
+        from processor import ExcelRun, fork_workbook
+        if loaded is None:
+            return
+        if isinstance(loaded, ExcelRun):
+            self.job_started_signal.emit(jobs[0])
+            loaded.process()
+            emit((jobs[0], loaded))
+            return
+
+        workbook, entry = loaded
+        for i, job in enumerate(jobs):
+            if job.stopped:
+                self.job_finished_signal.emit(job, 'stopped', "Остановлено пользователем")
+                continue
+            shared = analysis = None
+            try:
+                if entry is not None:
+                    # Тёплая книга не меняется: задача работает с копией своих листов и таблиц стилей
+                    with entry.lock:
+                        shared = fork_workbook(entry.workbook, job.sheet_names, own_styles=True)
+                    analysis = entry.analysis_for(job.config.__dict__)
+                else:
+                    # Последняя задача забирает исходную книгу, остальные работают с копиями своих листов
+                    shared = fork_workbook(workbook, job.sheet_names) if i < len(jobs) - 1 else workbook
+                self.job_started_signal.emit(job)
+                run = self.make_run(job, shared, analysis)
+            except Exception as e:
+                # Ошибка одной задачи не должна оставить остальные задачи группы без результата
+                self.job_finished_signal.emit(job, 'error', f"Исключение: {str(e)}")
+                continue
+            if run is None:
+                continue
+            run.read()
+            run.process()
+            if entry is None and i < len(jobs) - 1:
+                # Копия делит с исходной книгой остальные листы и стили, а их меняет следующая задача:
+                # она записывается сразу, до обработки следующей
+                self.write_job((job, run))
+            else:
+                emit((job, run))
+
+    def make_run(self, job, workbook=None, analysis=None):
+        from processor import ExcelRun
+        if not job.sheet_names:
+            self.job_finished_signal.emit(job, 'error', "Нет выбранных листов")
+            return None
+
+        # Все листы обрабатываются за один вызов: книга читается и сохраняется один раз,
+        # и результат обработки предыдущего листа не теряется
+        self.log_signal.emit(job, f"📋 Листов к обработке: {len(job.sheet_names)} ({', '.join(job.sheet_names)})")
+
+        temp_config = Config()
+        temp_config.__dict__.update(job.config.__dict__)
+        temp_config.sheet_names = list(job.sheet_names)
+        return ExcelRun(
+            temp_config.__dict__,
+            lambda message: self.log_signal.emit(job, message),
+            stop_callback=lambda: job.stopped,
+            workbook=workbook,
+            analysis=analysis
+        )
+
+    def write_job(self, item):
+        """Стадия записи."""
+        job, run = item
+        try:
+            success, message = run.write()
+        except Exception as e:
+            self.job_finished_signal.emit(job, 'error', f"Исключение: {str(e)}")
+            return
+        if success:
+            status = 'done'
+        elif run.stopped:
+            status = 'stopped'
+        else:
+            status = 'error'
+        self.job_finished_signal.emit(job, status, message)
+
+
+class MergeThread(QThread):
+    """Объединение нескольких книг (merger.merge_excel) с настройками вкладки — вне очереди задач."""
     log_signal = pyqtSignal(str)
-    finished_signal = pyqtSignal(bool, str)
-    stopped = False
+    finished_signal = pyqtSignal(str, str)  # статус из JOB_STATUSES, сообщение
 
-    def __init__(self, config, sheet_names):
-        super().__init__()
+    def __init__(self, config, input_files, parent=None):
+        super().__init__(parent)
         self.config = config
-        self.sheet_names = sheet_names
+        self.input_files = input_files
+        self.stopped = False
 
     def run(self):
-        if not self.sheet_names:
-            self.finished_signal.emit(False, "Нет выбранных листов")
+        from merger import merge_excel
+        try:
+            success, message = merge_excel(self.config, self.input_files, self.log_signal.emit, lambda: self.stopped)
+        except Exception as e:
+            self.finished_signal.emit('error', f"Исключение: {str(e)}")
             return
+        if success:
+            status = 'done'
+        elif self.stopped:
+            status = 'stopped'
+        else:
+            status = 'error'
+        self.finished_signal.emit(status, message)
 
-        total = len(self.sheet_names)
-        for i, sheet_name in enumerate(self.sheet_names):
-            if self.stopped:
-                self.log_signal.emit("🛑 Обработка остановлена пользователем.")
-                self.finished_signal.emit(False, "Остановлено пользователем")
-                return
 
-            self.log_signal.emit(f"📋 Обработка листа {i+1}/{total}: {sheet_name}")
+# ======================
+# ПЛАНИРОВЩИК ЗАДАЧ
+# ======================
 
-            temp_config = Config()
-            temp_config.__dict__.update(self.config.__dict__)
-            temp_config.sheet_names = [sheet_name]
+# Во сколько раз книга в памяти openpyxl больше файла .xlsx на диске (оценка с запасом)
+JOB_MEMORY_FACTOR = 40
+
+
+def pipeline_memory(groups):
+    """
+    Оценка памяти пакета групп: у группы — как у её самой большой задачи, а конвейер держит одновременно
+    не больше 2 * PIPELINE_DEPTH + 1 книг (прочитанные наперёд, обрабатываемая, ждущие записи).
+    """
+    sizes = sorted((max(job.memory_estimate for job in group) for group in groups), reverse=True)
+    return sum(sizes[:2 * PIPELINE_DEPTH + 1])
+
+JOB_STATUSES = {
+    'queued': ("⏳ В очереди", "#ffc107"),
+    'running': ("⚙️ Выполняется", "#03a9f4"),
+    'done': ("✅ Готово", "#4caf50"),
+    'error': ("❌ Ошибка", "#f44336"),
+    'stopped': ("🛑 Остановлено", "#9e9e9e"),
+}
+
+
+class ProcessingJob:
+    def __init__(self, tab, config, sheet_names):
+        self.tab = tab
+        self.config = copy.deepcopy(config)
+        self.sheet_names = list(sheet_names)
+        self.stopped = False
+        self.detached = False  # вкладку закрыли: сообщения задачи больше некуда выводить
+        try:
+            path = os.path.abspath(self.config.input_file)
+            self.memory_estimate = os.path.getsize(path) * JOB_MEMORY_FACTOR
+            # Задачи с одинаковым ключом (путь + время изменения) читают файл один раз
+            self.source_key = (os.path.normcase(path), os.path.getmtime(path))
+        except OSError:
+            self.memory_estimate = 0
+            self.source_key = id(self)
+
+
+class JobScheduler(QObject):
+    """
+    Общая очередь задач всех вкладок. Одновременно выполняется не больше задач,
+    чем ядер процессора, и новая задача стартует, только если хватает свободной памяти.
+    Задачи из очереди с одним и тем же входным файлом запускаются вместе и читают его один раз.
+    Если файлов в очереди больше, чем свободных потоков, последний поток берёт их долю (на каждый поток
+    поровну) и ведёт конвейером (WorkerThread): чтение следующего файла и запись предыдущего не простаивают.
+    """
+    status_signal = pyqtSignal(object, str)
 
-            try:
-                success, message = process_excel(temp_config.__dict__, self.log_signal.emit)
-                if not success:
-                    self.finished_signal.emit(False, f"Ошибка на листе {sheet_name}: {message}")
-                    return
-            except Exception as e:
-                self.finished_signal.emit(False, f"Исключение на листе {sheet_name}: {str(e)}")
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.max_jobs = max(1, os.cpu_count() or 1)
+        self.queue = []
+        self.running = []
+        self.workers = []
+        self.warm = WarmCache()
+
+    def is_active(self, tab):
+        return any(job.tab is tab for job in self.queue + self.running)
+
+    def submit(self, tab, config, sheet_names):
+        job = ProcessingJob(tab, config, sheet_names)
+        self.queue.append(job)
+        self.status_signal.emit(tab, 'queued')
+        tab.log(f"📥 Задача в очереди: позиция {len(self.queue)}, одновременно до {self.max_jobs} задач")
+        # Даём «Запустить все» поставить в очередь все вкладки, чтобы задачи с общим файлом попали в одну группу
+        QTimer.singleShot(0, self.pump)
+
+    def cancel(self, tab):
+        for job in self.queue:
+            if job.tab is tab:
+                self.queue.remove(job)
+                self.status_signal.emit(tab, 'stopped')
+                tab.on_finished('stopped', "Остановлено пользователем")
+                return
+        for job in self.running:
+            if job.tab is tab:
+                job.stopped = True
                 return
 
-        self.finished_signal.emit(True, "Обработка завершена успешно.")
-
-    def stop(self):
-        self.stopped = True
+    def detach(self, tab):
+        """Вкладку закрывают: её задача из очереди снимается, выполняющаяся останавливается и больше не пишет во вкладку."""
+        self.queue = [job for job in self.queue if job.tab is not tab]
+        for job in self.running:
+            if job.tab is tab:
+                job.stopped = True
+                job.detached = True
+
+    def memory_available(self):
+        import psutil
+        reserved = sum(worker.memory_estimate for worker in self.workers)
+        return psutil.virtual_memory().available - reserved
+
+    def can_start(self, memory_estimate):
+        if not self.workers:
+            return True
+        if len(self.workers) >= self.max_jobs:
+            return False
+        return self.memory_available() >= memory_estimate
+
+    def queued_groups(self):
+        groups = {}
+        for job in self.queue:
+            groups.setdefault(job.source_key, []).append(job)
+        return list(groups.values())
+
+    def pump(self):
+        while self.queue:
+            groups = self.queued_groups()
+            batch = groups[:1]
+            if len(groups) > 1 and len(self.workers) + 1 >= self.max_jobs:
+                # Последний свободный поток берёт не всё, а свою долю очереди: остальные доли
+                # достанутся потокам, которые освободятся раньше, и они не будут простаивать
+                share = groups[:-(-len(groups) // self.max_jobs)]
+                if self.memory_available() >= pipeline_memory(share):
+                    batch = share
+            if not self.can_start(pipeline_memory(batch)):
+                break
+            for job in [job for group in batch for job in group]:
+                self.queue.remove(job)
+                self.running.append(job)
+
+            worker = WorkerThread(batch, self.warm)
+            worker.log_signal.connect(self.on_job_log)
+            worker.job_started_signal.connect(self.on_job_started)
+            worker.job_finished_signal.connect(self.on_job_finished)
+            worker.finished.connect(lambda worker=worker: self.on_worker_finished(worker))
+            self.workers.append(worker)
+            worker.start()
+
+    def on_job_log(self, job, message):
+        if not job.detached:
+            job.tab.log(message)
+
+    def on_job_started(self, job):
+        if not job.detached:
+            self.status_signal.emit(job.tab, 'running')
+
+    def on_job_finished(self, job, status, message):
+        self.running.remove(job)
+        if not job.detached:
+            self.status_signal.emit(job.tab, status)
+            job.tab.on_finished(status, message)
+
+    def on_worker_finished(self, worker):
+        self.workers.remove(worker)
+        self.pump()
 
 
 # ======================
@@ -503,7 +880,6 @@ class ConfigTab(QWidget):
         self.parent = parent
         self.config = Config()
         self.config_name = config_name
-        self.worker = None
         self.last_input_file = None
         self.initUI()
 
@@ -523,6 +899,7 @@ class ConfigTab(QWidget):
             ("Выравнивание", 'alignment'),
             ("Форматирование", 'formatting'),
             ("Числовые форматы", 'number_formats'),
+            ("Подытоги", 'subtotals'),
             ("Большой файл", 'large_file_mode'),
         ]
 
@@ -607,9 +984,94 @@ class ConfigTab(QWidget):
         self.min_row_spin.setMaximum(10000)
         self.min_row_spin.setValue(11)
         params_layout.addWidget(self.min_row_spin, 2, 1)
+        self.result_cache_check = QCheckBox("Кэш результатов")
+        self.result_cache_check.setChecked(True)
+        self.result_cache_check.setToolTip("Если этот же файл уже обрабатывался с теми же настройками,\nготовый результат копируется без повторной обработки.")
+        params_layout.addWidget(self.result_cache_check, 3, 0, 1, 2)
+        self.compact_styles_check = QCheckBox("Сжимать таблицу стилей")
+        self.compact_styles_check.setChecked(True)
+        self.compact_styles_check.setToolTip("Перед сохранением удаляет дублирующиеся и неиспользуемые стили —\nфайл меньше и быстрее открывается.")
+        params_layout.addWidget(self.compact_styles_check, 4, 0, 1, 2)
+        self.column_styles_check = QCheckBox("Стиль на весь столбец")
+        self.column_styles_check.setToolTip("Перенос, выравнивание и числовые форматы задаются столбцу целиком,\nотдельно — только ячейкам со значением или своим стилем.\nБыстрее на больших листах; пустые ячейки столбца тоже получат этот стиль.")
+        params_layout.addWidget(self.column_styles_check, 5, 0, 1, 2)
+        params_layout.addWidget(QLabel("Сжатие файла:"), 6, 0)
+        self.compression_combo = QComboBox()
+        for level, title in SAVE_COMPRESSION_LEVELS:
+            self.compression_combo.addItem(title, level)
+        self.compression_combo.setCurrentIndex(self.compression_combo.findData(6))
+        self.compression_combo.setToolTip("«Без сжатия» пишет быстрее всего, но файл в несколько раз больше —\nудобно для промежуточных результатов.")
+        params_layout.addWidget(self.compression_combo, 6, 1)
+        from saver import fork_available
+        self.parallel_save_check = QCheckBox("Записывать листы параллельно")
+        self.parallel_save_check.setToolTip("Большие листы сериализуются в отдельных процессах (fork, только Linux).\nС «Разбирать листы параллельно» в процессах и разбираются ячейки листов.")
+        # Без fork (Windows, macOS) листы всё равно пишутся по очереди — флажок там не показывается
+        self.parallel_save_check.setVisible(fork_available())
+        params_layout.addWidget(self.parallel_save_check, 7, 0, 1, 2)
+        self.checkpoints_check = QCheckBox("Контрольные точки")
+        self.checkpoints_check.setToolTip("Каждый обработанный лист сохраняется в %LOCALAPPDATA%\\Chik-chik\\checkpoints.\nПосле остановки или сбоя следующий запуск того же файла с теми же настройками\nне обрабатывает готовые листы заново. Таблица стилей при этом не сжимается.")
+        params_layout.addWidget(self.checkpoints_check, 8, 0, 1, 2)
+        params_layout.addWidget(QLabel("Выгрузка иерархии:"), 9, 0)
+        self.export_combo = QComboBox()
+        for fmt, title in EXPORT_FORMAT_TITLES:
+            self.export_combo.addItem(title, fmt)
+        self.export_combo.setToolTip("Рядом с результатом для каждого листа пишется файл:\nномер строки, уровень, номер в иерархии, номер родителя и значения столбцов.\nParquet — только если установлен pyarrow.")
+        params_layout.addWidget(self.export_combo, 9, 1)
+        self.value_free_check = QCheckBox("Быстрый режим без чтения значений")
+        self.value_free_check.setChecked(True)
+        self.value_free_check.setToolTip("Если включены только «Группировка» и «Иерархия», листы не разбираются целиком:\nпрограмма смотрит лишь, какие строки заполнены и какого цвета ячейки цветового столбца.\nФормулы на таких листах сохраняются как есть.")
+        params_layout.addWidget(self.value_free_check, 10, 0, 1, 2)
+        self.keep_warm_check = QCheckBox("Держать книгу в памяти между запусками")
+        self.keep_warm_check.setChecked(False)
+        self.keep_warm_check.setToolTip("Разобранный файл и найденные уровни остаются в памяти (до половины доступной памяти на все вкладки).\nПовторный запуск того же файла с другими настройками не читает его заново.\nИзменённый на диске файл читается снова.")
+        params_layout.addWidget(self.keep_warm_check, 11, 0, 1, 2)
+        self.parsed_cache_check = QCheckBox("Кэшировать разобранные листы на диске")
+        self.parsed_cache_check.setToolTip("Ячейки и стили разобранных листов сохраняются на диск (до 1 ГБ).\nПовторное открытие того же файла, в том числе после перезапуска программы,\nчитает их из кэша, а не разбирает XML заново. Изменённый файл разбирается снова.")
+        params_layout.addWidget(self.parsed_cache_check, 12, 0, 1, 2)
+        self.parallel_load_check = QCheckBox("Разбирать листы параллельно с обработкой")
+        self.parallel_load_check.setChecked(True)
+        self.parallel_load_check.setToolTip("Ячейки выбранных листов разбираются в фоне по порядку выбора,\nи обработка первого листа начинается, как только готов он сам, а не вся книга.\nС «Записывать листы параллельно» (Linux) — в отдельных процессах, иначе в фоновом потоке.")
+        params_layout.addWidget(self.parallel_load_check, 13, 0, 1, 2)
+        self.level_color_rules_check = QCheckBox("Цвета уровней — условным форматированием")
+        self.level_color_rules_check.setToolTip("Вместо заливки каждой ячейки — одно правило условного форматирования на уровень цвета\n(уровни строк пишутся в скрытый служебный столбец справа от данных). Стилей ячеек меньше,\nв Excel выглядит так же. Нужен этап «Цвет в иерархии».")
+        params_layout.addWidget(self.level_color_rules_check, 14, 0, 1, 2)
         params_group.setLayout(params_layout)
         scroll_layout.addWidget(params_group)
 
+        # Подытоги групп
+        self.subtotals_group = QGroupBox("Подытоги групп")
+        subtotals_layout = QGridLayout()
+        subtotals_layout.addWidget(QLabel("Столбцы:"), 0, 0)
+        self.subtotal_columns_edit = QLineEdit("E")
+        self.subtotal_columns_edit.setPlaceholderText("Например: E, F:I")
+        self.subtotal_columns_edit.setToolTip("Числовые столбцы, сумма которых по группе пишется в строку-заголовок группы.")
+        subtotals_layout.addWidget(self.subtotal_columns_edit, 0, 1)
+        self.subtotal_formulas_check = QCheckBox("Формулы SUBTOTAL вместо значений")
+        self.subtotal_formulas_check.setToolTip("Вместо готовых чисел пишет =SUBTOTAL(9; …) — суммы пересчитываются\nпри правке данных, но Excel считает их при каждом открытии.")
+        subtotals_layout.addWidget(self.subtotal_formulas_check, 1, 0, 1, 2)
+        self.subtotals_group.setLayout(subtotals_layout)
+        scroll_layout.addWidget(self.subtotals_group)
+
+        # Палитра шаблона: цвет → уровень без поиска цветов по файлу
+        self.palette_group = QGroupBox("Палитра уровней шаблона")
+        palette_layout = QGridLayout()
+        palette_layout.addWidget(QLabel("Цвета по уровням:"), 0, 0)
+        self.palette_edit = QLineEdit()
+        self.palette_edit.setPlaceholderText("Пусто — уровни по порядку появления цветов в файле")
+        self.palette_edit.setToolTip("Цвета через запятую: первый — уровень 1, второй — уровень 2 и т.д.\nУровни назначаются за один проход, даже если какого-то цвета в файле нет.")
+        palette_layout.addWidget(self.palette_edit, 0, 1)
+        detect_palette_btn = QPushButton("Взять из файла")
+        detect_palette_btn.setToolTip("Заполнить палитру цветами цветового столбца выбранных листов\nв порядке их появления.")
+        detect_palette_btn.clicked.connect(self.detect_palette)
+        palette_layout.addWidget(detect_palette_btn, 0, 2)
+        palette_layout.addWidget(QLabel("Цвет не из палитры:"), 1, 0)
+        self.palette_unknown_combo = QComboBox()
+        for policy, title in PALETTE_UNKNOWN_TITLES:
+            self.palette_unknown_combo.addItem(title, policy)
+        palette_layout.addWidget(self.palette_unknown_combo, 1, 1, 1, 2)
+        self.palette_group.setLayout(palette_layout)
+        scroll_layout.addWidget(self.palette_group)
+
         # ✅ Блок "Сканировать столбцы по строке" — УДАЛЁН
 
         # Выбор листов и логи — на одной высоте
@@ -665,6 +1127,17 @@ class ConfigTab(QWidget):
         """)
         scroll_layout.addWidget(self.start_stop_btn)
 
+        self.merge_thread = None
+        self.merge_btn = QPushButton("🧩 Объединить файлы...")
+        self.merge_btn.setToolTip("Объединить несколько книг одного формата в один обработанный файл\n"
+                                  "с настройками этой вкладки (шапка — из первого файла)")
+        self.merge_btn.clicked.connect(self.toggle_merge)
+        scroll_layout.addWidget(self.merge_btn)
+
+        self.status_label = QLabel("Статус: —")
+        self.status_label.setAlignment(Qt.AlignCenter)
+        scroll_layout.addWidget(self.status_label)
+
         # Секции для скрытия
         self.section_widgets = {
             'hierarchy_colors': [self.format_panel_group],
@@ -672,6 +1145,9 @@ class ConfigTab(QWidget):
             'alignment': [self.format_panel_group, self.editors_group],
             'formatting': [self.format_panel_group, self.editors_group],
             'number_formats': [self.editors_group],
+            'subtotals': [self.subtotals_group],
+            'grouping': [self.palette_group],
+            'hierarchy': [self.palette_group],
             # ✅ 'large_file_mode' не показывает блоков
         }
 
@@ -742,6 +1218,25 @@ class ConfigTab(QWidget):
         except Exception as e:
             self.log(f"❌ Ошибка загрузки листов: {e}")
 
+    def selected_sheets(self):
+        return [self.sheet_list.item(i).text() for i in range(self.sheet_list.count())
+                if self.sheet_list.item(i).checkState() == Qt.Checked]
+
+    def detect_palette(self):
+        file = self.input_line.text()
+        if not file or not os.path.exists(file):
+            self.log("❌ Сначала выберите входной файл.")
+            return
+        try:
+            from processor import detect_palette
+            palette = detect_palette(file, self.selected_sheets(), self.color_col_edit.text().strip().upper(),
+                                     self.min_row_spin.value())
+        except Exception as e:
+            self.log(f"❌ Не удалось определить палитру: {e}")
+            return
+        self.palette_edit.setText(", ".join(palette))
+        self.log(f"🎨 Палитра из файла: {len(palette)} цветов")
+
     def toggle_start_stop(self):
         if self.start_stop_btn.text() == "▶️ Запустить обработку":
             self.start_processing()
@@ -751,7 +1246,7 @@ class ConfigTab(QWidget):
     def start_processing(self):
         if not self.input_line.text():
             self.log("❌ Пожалуйста, выберите входной файл.")
-            return
+            return False
 
         output_file = self.output_line.text() or (os.path.splitext(self.input_line.text())[0] + "_обработанный.xlsx")
         if os.path.exists(output_file):
@@ -765,31 +1260,16 @@ class ConfigTab(QWidget):
                     "❌ Файл уже открыт в Excel или другом приложении.\n\n"
                     "Пожалуйста, закройте его и попробуйте снова."
                 )
-                return
+                return False
 
-        selected_sheets = []
-        for i in range(self.sheet_list.count()):
-            item = self.sheet_list.item(i)
-            if item.checkState() == Qt.Checked:
-                selected_sheets.append(item.text())
+        selected_sheets = self.selected_sheets()
         if not selected_sheets:
             self.log("❌ Нет выбранных листов.")
-            return
+            return False
 
         self.config.input_file = self.input_line.text()
         self.config.output_file = output_file
-        self.config.color_column = self.color_col_edit.text().strip().upper()
-        self.config.hierarchy_column = self.hierarchy_col_edit.text().strip().upper()
-        self.config.min_row = self.min_row_spin.value()
-
-        # ✅ Упрощённая логика: просто флаг
-        self.config.scan_columns_by_row = 1 if self.stage_checks['large_file_mode'].isChecked() else None
-
-        for key, check in self.stage_checks.items():
-            self.config.stages[key] = check.isChecked()
-
-        self.config.column_formats = self.column_format_editor.save_data()
-        self.config.alignment_rules = self.alignment_editor.save_data()
+        self.read_config()
 
         self.start_stop_btn.setText("⏹️ Стоп")
         self.start_stop_btn.setStyleSheet("""
@@ -807,18 +1287,97 @@ class ConfigTab(QWidget):
         self.log_text.clear()
         self.log("🚀 Начинаем обработку...")
 
-        self.worker = WorkerThread(self.config, selected_sheets)
-        self.worker.log_signal.connect(self.log)
-        self.worker.finished_signal.connect(self.on_finished)
-        self.worker.start()
+        self.parent.scheduler.submit(self, self.config, selected_sheets)
+        return True
+
+    def read_config(self):
+        """Переносит настройки из полей вкладки в self.config (кроме входного и выходного файлов)."""
+        self.config.color_column = self.color_col_edit.text().strip().upper()
+        self.config.hierarchy_column = self.hierarchy_col_edit.text().strip().upper()
+        self.config.min_row = self.min_row_spin.value()
+        self.config.use_result_cache = self.result_cache_check.isChecked()
+        self.config.compact_styles = self.compact_styles_check.isChecked()
+        self.config.column_styles = self.column_styles_check.isChecked()
+        self.config.save_compression = self.compression_combo.currentData()
+        self.config.parallel_save = self.parallel_save_check.isChecked()
+        self.config.checkpoints = self.checkpoints_check.isChecked()
+        self.config.export_format = self.export_combo.currentData()
+        self.config.subtotal_columns = [col.strip().upper() for col in self.subtotal_columns_edit.text().split(',') if col.strip()]
+        self.config.subtotal_formulas = self.subtotal_formulas_check.isChecked()
+        self.config.value_free_scan = self.value_free_check.isChecked()
+        self.config.keep_warm = self.keep_warm_check.isChecked()
+        self.config.parsed_cache = self.parsed_cache_check.isChecked()
+        self.config.parallel_load = self.parallel_load_check.isChecked()
+        self.config.level_color_rules = self.level_color_rules_check.isChecked()
+        self.config.palette = [color.strip().lstrip('#').upper() for color in self.palette_edit.text().split(',') if color.strip()]
+        self.config.palette_unknown = self.palette_unknown_combo.currentData()
+
+        # ✅ Упрощённая логика: просто флаг
+        self.config.scan_columns_by_row = 1 if self.stage_checks['large_file_mode'].isChecked() else None
+
+        for key, check in self.stage_checks.items():
+            self.config.stages[key] = check.isChecked()
+
+        self.config.column_formats = self.column_format_editor.save_data()
+        self.config.alignment_rules = self.alignment_editor.save_data()
+
+    def toggle_merge(self):
+        if self.merge_thread is not None:
+            self.stop_merge()
+            return
+        files, _ = QFileDialog.getOpenFileNames(self, "Выберите файлы для объединения", "", "Excel Files (*.xlsx)")
+        if len(files) < 2:
+            if files:
+                self.log("❌ Для объединения выберите хотя бы два файла.")
+            return
+        output_file, _ = QFileDialog.getSaveFileName(self, "Сохранить объединённый файл как", "", "Excel Files (*.xlsx)")
+        if not output_file:
+            return
+        if not output_file.endswith(".xlsx"):
+            output_file += ".xlsx"
+        reply = QMessageBox.question(
+            self,
+            "Объединение",
+            "Вывести каждый файл на отдельный лист?\n\n«Нет» — все строки на одном листе.",
+            QMessageBox.Yes | QMessageBox.No,
+            QMessageBox.No
+        )
+
+        self.read_config()
+        config = copy.deepcopy(self.config.__dict__)
+        config['output_file'] = output_file
+        config['sheet_names'] = self.selected_sheets()
+        config['merge_mode'] = 'per_source' if reply == QMessageBox.Yes else 'single'
+
+        self.log_text.clear()
+        self.merge_btn.setText("⏹️ Остановить объединение")
+        self.merge_thread = MergeThread(config, files, self.parent)
+        self.merge_thread.log_signal.connect(self.log)
+        self.merge_thread.finished_signal.connect(self.on_merge_finished)
+        self.merge_thread.finished.connect(self.merge_thread.deleteLater)
+        self.merge_thread.start()
+        self.parent.on_job_status(self, 'running')
+
+    def stop_merge(self):
+        if self.merge_thread is not None:
+            self.merge_btn.setEnabled(False)
+            self.merge_thread.stopped = True
+
+    def on_merge_finished(self, status, message):
+        self.merge_thread = None
+        self.merge_btn.setText("🧩 Объединить файлы...")
+        self.merge_btn.setEnabled(True)
+        self.parent.on_job_status(self, status)
+        if status == 'error':
+            self.log(f"❌ Ошибка: {message}")
 
     def stop_processing(self):
-        if self.worker:
-            self.worker.stop()
+        if self.parent.scheduler.is_active(self):
             self.start_stop_btn.setEnabled(False)
             self.log("🛑 Запрос на остановку отправлен...")
+            self.parent.scheduler.cancel(self)
 
-    def on_finished(self, success, message):
+    def on_finished(self, status, message):
         self.start_stop_btn.setText("▶️ Запустить обработку")
         self.start_stop_btn.setStyleSheet("""
             QPushButton {
@@ -834,18 +1393,18 @@ class ConfigTab(QWidget):
         """)
         self.start_stop_btn.setEnabled(True)
 
-        if success:
+        if status == 'done':
             self.log("🎉 Обработка завершена успешно!")
             try:
+                import psutil
                 for proc in psutil.process_iter(['pid', 'name']):
                     if proc.info['name'] in ['EXCEL.EXE', 'excel.exe']:
                         proc.terminate()
                         self.log(f"✅ Процесс Excel (PID {proc.info['pid']}) завершён.")
             except Exception as e:
                 self.log(f"⚠️ Не удалось завершить процессы Excel: {e}")
-        else:
-            if message != "Остановлено пользователем":
-                self.log(f"❌ Ошибка: {message}")
+        elif status == 'error':
+            self.log(f"❌ Ошибка: {message}")
 
     def log(self, message):
         self.log_text.append(message)
@@ -864,6 +1423,9 @@ class ExcelProcessorGUI(QMainWindow):
 
         self.setWindowFlags(Qt.FramelessWindowHint)
 
+        self.scheduler = JobScheduler(self)
+        self.scheduler.status_signal.connect(self.on_job_status)
+
         app = QApplication.instance()
         font = app.font()
         font.setPointSize(font.pointSize() + 3)
@@ -1063,10 +1625,15 @@ class ExcelProcessorGUI(QMainWindow):
         btn_layout = QHBoxLayout()
         add_tab_btn = QPushButton("➕ Добавить конфиг")
         add_tab_btn.clicked.connect(self.add_tab)
+        run_all_btn = QPushButton("⏩ Запустить все")
+        run_all_btn.setToolTip("Поставить в очередь все вкладки. Одновременно выполняется\nне больше задач, чем позволяют процессор и свободная память.")
+        run_all_btn.clicked.connect(self.run_all_tabs)
         save_btn = QPushButton("💾 Сохранить настройки")
         save_btn.clicked.connect(self.save_settings)
         load_btn = QPushButton("📂 Загрузить настройки")
         load_btn.clicked.connect(self.load_settings)
+        clear_cache_btn = QPushButton("🧹 Очистить кэш")
+        clear_cache_btn.clicked.connect(self.clear_result_cache)
         exit_btn = QPushButton("🚪 Выход")
         exit_btn.clicked.connect(self.confirm_close)
         exit_btn.setStyleSheet("""
@@ -1083,8 +1650,10 @@ class ExcelProcessorGUI(QMainWindow):
         """)
 
         btn_layout.addWidget(add_tab_btn)
+        btn_layout.addWidget(run_all_btn)
         btn_layout.addWidget(save_btn)
         btn_layout.addWidget(load_btn)
+        btn_layout.addWidget(clear_cache_btn)
         btn_layout.addWidget(exit_btn)
         content_layout.addLayout(btn_layout)
 
@@ -1112,9 +1681,36 @@ class ExcelProcessorGUI(QMainWindow):
         self.tabs.addTab(tab, tab.config_name)
         self.tabs.setCurrentWidget(tab)
 
+    def run_all_tabs(self):
+        submitted = 0
+        for i in range(self.tabs.count()):
+            tab = self.tabs.widget(i)
+            if self.scheduler.is_active(tab):
+                continue
+            if tab.start_processing():
+                submitted += 1
+        if not submitted:
+            QMessageBox.information(self, "Запуск всех вкладок", "Нет вкладок, готовых к обработке.")
+
+    def on_job_status(self, tab, status):
+        text, color = JOB_STATUSES[status]
+        tab.status_label.setText(f"Статус: {text}")
+        index = self.tabs.indexOf(tab)
+        if index >= 0:
+            self.tabs.tabBar().setTabTextColor(index, QColor(color))
+            self.tabs.setTabToolTip(index, text)
+
+    def remove_tab(self, index):
+        # Задача вкладки останавливается, а сама вкладка удаляется — её сигналы задачи больше не достанут
+        tab = self.tabs.widget(index)
+        self.scheduler.detach(tab)
+        tab.stop_merge()
+        self.tabs.removeTab(index)
+        tab.deleteLater()
+
     def close_tab(self, index):
         if self.tabs.count() > 1:
-            self.tabs.removeTab(index)
+            self.remove_tab(index)
         else:
             QMessageBox.warning(self, "Предупреждение", "Нельзя закрыть последнюю вкладку!")
 
@@ -1147,7 +1743,7 @@ class ExcelProcessorGUI(QMainWindow):
                 configs = json.load(f)
 
             while self.tabs.count() > 1:
-                self.tabs.removeTab(1)
+                self.remove_tab(1)
 
             for i, config_data in enumerate(configs):
                 if i == 0:
@@ -1164,6 +1760,26 @@ class ExcelProcessorGUI(QMainWindow):
                 tab.color_col_edit.setText(tab.config.color_column)
                 tab.hierarchy_col_edit.setText(tab.config.hierarchy_column)
                 tab.min_row_spin.setValue(tab.config.min_row)
+                tab.result_cache_check.setChecked(tab.config.use_result_cache)
+                tab.compact_styles_check.setChecked(tab.config.compact_styles)
+                tab.column_styles_check.setChecked(tab.config.column_styles)
+                index = tab.compression_combo.findData(tab.config.save_compression)
+                if index >= 0:
+                    tab.compression_combo.setCurrentIndex(index)
+                tab.parallel_save_check.setChecked(tab.config.parallel_save)
+                tab.checkpoints_check.setChecked(tab.config.checkpoints)
+                index = tab.export_combo.findData(tab.config.export_format)
+                tab.export_combo.setCurrentIndex(max(index, 0))
+                tab.subtotal_columns_edit.setText(", ".join(tab.config.subtotal_columns))
+                tab.subtotal_formulas_check.setChecked(tab.config.subtotal_formulas)
+                tab.value_free_check.setChecked(tab.config.value_free_scan)
+                tab.keep_warm_check.setChecked(tab.config.keep_warm)
+                tab.parsed_cache_check.setChecked(tab.config.parsed_cache)
+                tab.parallel_load_check.setChecked(tab.config.parallel_load)
+                tab.level_color_rules_check.setChecked(tab.config.level_color_rules)
+                tab.palette_edit.setText(", ".join(tab.config.palette))
+                index = tab.palette_unknown_combo.findData(tab.config.palette_unknown)
+                tab.palette_unknown_combo.setCurrentIndex(max(index, 0))
 
                 for key, check in tab.stage_checks.items():
                     check.setChecked(tab.config.stages.get(key, False))
@@ -1194,6 +1810,15 @@ class ExcelProcessorGUI(QMainWindow):
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Не удалось загрузить: {str(e)}")
 
+    def clear_result_cache(self):
+        from parsedcache import ParsedCache
+        try:
+            freed = ResultCache().clear() + ParsedCache().clear()
+            self.scheduler.warm.clear()
+            QMessageBox.information(self, "Кэш", f"Кэш результатов и разбора очищен ({freed / (1024 * 1024):.1f} МБ).")
+        except OSError as e:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось очистить кэш: {str(e)}")
+
     def confirm_close(self):
         reply = QMessageBox.question(
             self,
@@ -1225,9 +1850,31 @@ class ExcelProcessorGUI(QMainWindow):
 # ЗАПУСК
 # ======================
 
+def warm_up_imports():
+    """Догружает тяжёлые модули в фоне, пока пользователь настраивает вкладки."""
+    import processor  # noqa: F401 — тянет за собой openpyxl
+    import psutil  # noqa: F401
+    if startup_profile:
+        startup_profile.mark("processor и openpyxl загружены (фон)")
+        startup_profile.report()
+
+
+def on_window_shown():
+    if startup_profile:
+        startup_profile.mark("окно показано, цикл событий запущен")
+    threading.Thread(target=warm_up_imports, name="warm-up", daemon=True).start()
+
+
 if __name__ == "__main__":
+    if startup_profile:
+        startup_profile.mark("импорты main.py")
     app = QApplication(sys.argv)
     app.setStyle(QStyleFactory.create("Fusion"))
+    if startup_profile:
+        startup_profile.mark("QApplication создан")
     window = ExcelProcessorGUI()
+    if startup_profile:
+        startup_profile.mark("главное окно построено")
     window.show()
-    sys.exit(app.exec_())
\ No newline at end of file
+    QTimer.singleShot(0, on_window_shown)
+    sys.exit(app.exec_())
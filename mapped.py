@@ -0,0 +1,115 @@
+# mapped.py — входной файл, отображённый в память только для чтения: разбор книги, перенос листов
+# при записи и хэш для кэшей читают одно отображение, а не открывают и не читают файл каждый заново
+
+import hashlib
+import io
+import mmap
+
+
+class MappedReader(io.RawIOBase):
+    """Независимый курсор по общему отображению: у каждого zip-архива своя позиция, данные общие."""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self.buffer = buffer
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        if offset < 0:
+            raise ValueError(f"отрицательная позиция: {offset}")
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        end = len(self.buffer) if size is None or size < 0 else min(len(self.buffer), self.pos + size)
+        data = self.buffer[self.pos:end]
+        self.pos = max(self.pos, end)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class MappedFile:
+    """
+    Входной .xlsx одной обработки. Файл отображается в память один раз; zip_source() даёт сколько угодно
+    независимых читателей, и каждый zip разжимает только нужные ему части. Страницы отображения
+    общие для всех читателей и для дочерних процессов после fork — копии файла целиком в памяти нет.
+    mapped=False (или файл, который нельзя отобразить: пустой, на особой файловой системе) —
+    архивы открываются по пути, как раньше.
+    """
+
+    def __init__(self, path, mapped=True):
+        self.path = path
+        self.buffer = None
+        self._digest = None
+        if mapped:
+            with open(path, 'rb') as f:
+                try:
+                    self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    self.buffer = None
+
+    @property
+    def mapped(self):
+        return self.buffer is not None
+
+    def reader(self):
+        return MappedReader(self.buffer)
+
+    def digest(self, chunk_size=1024 * 1024):
+        """SHA-256 содержимого; считается один раз на все кэши, которым нужен ключ файла."""
+        if self._digest is None:
+            digest = hashlib.sha256()
+            if self.buffer is not None:
+                digest.update(self.buffer)
+            else:
+                with open(self.path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(chunk_size), b''):
+                        digest.update(chunk)
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def prefetch(self):
+        """
+        Подтягивает весь файл с диска (сетевой папки) в память. Хэш считается без GIL, поэтому чтение
+        не мешает обработке в другом потоке, а разбор потом не ждёт диска; хэш заодно пригодится кэшам.
+        """
+        if self.buffer is not None:
+            self.digest()
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def zip_source(source):
+    """Что передать в ZipFile: читатель отображения для MappedFile, иначе сам source (путь или поток)."""
+    if isinstance(source, MappedFile):
+        return source.reader() if source.mapped else source.path
+    return source
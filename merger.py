@@ -0,0 +1,400 @@
+# merger.py — объединение нескольких книг одного формата в один обработанный файл
+#
+# Запуск: python merger.py --config вкладка.json --output итог.xlsx [--per-source] файл1.xlsx файл2.xlsx ...
+# Источники читаются по одному в режиме read_only, результат пишется потоково (write_only):
+# в памяти никогда не бывает больше одной книги-источника.
+
+import argparse
+import time
+from array import array
+from pathlib import Path
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell.cell import WriteOnlyCell
+from openpyxl.styles import Font, Border, Side, Alignment
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.numbers import BUILTIN_FORMATS_MAX_SIZE
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.worksheet.dimensions import ColumnDimension
+
+from processor import (RowState, STYLE_TABLES, fill_color, make_callbacks, pin_template_palette,
+                       prepare_alignment_rules, prepare_column_formats, report_palette)
+from saver import save_workbook, DEFAULT_COMPRESSION
+from sheetxml import scan_layout
+
+MAX_SHEET_TITLE = 31
+# Атрибуты <col>, которые переносятся в выходной лист (style переводится отдельно)
+COLUMN_ATTRS = ('min', 'max', 'width', 'customWidth', 'bestFit', 'hidden', 'outlineLevel', 'collapsed')
+
+
+class StyleCopier:
+    """Переводит стиль ячейки книги-источника в стиль выходной книги; каждый стиль переводится один раз."""
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.styles = {}
+        self.derived = {}  # кэш MergeStyles для этого источника
+
+    def __call__(self, style_id):
+        style = self.styles.get(style_id)
+        if style is None:
+            src_style = self.src._cell_styles[style_id]
+            style = StyleArray(src_style)
+            for field, attr, _ in STYLE_TABLES:
+                setattr(style, field, getattr(self.dst, attr).add(getattr(self.src, attr)[getattr(src_style, field)]))
+            if src_style.numFmtId >= BUILTIN_FORMATS_MAX_SIZE:
+                fmt = self.src._number_formats[src_style.numFmtId - BUILTIN_FORMATS_MAX_SIZE]
+                style.numFmtId = BUILTIN_FORMATS_MAX_SIZE + self.dst._number_formats.add(fmt)
+            style.xfId = 0
+            self.styles[style_id] = style
+        return style
+
+
+def source_sheet(wb, CONFIG, path):
+    names = CONFIG.get('sheet_names')
+    name = names[0] if names else wb.sheetnames[0]
+    if name not in wb.sheetnames:
+        raise ValueError(f"В файле {path} нет листа '{name}'")
+    return wb[name]
+
+
+class MergeScan:
+    """
+    Первый проход: для каждого источника — число строк данных, для каждой строки — заливка цветового столбца.
+    Заливки разных книг с одинаковым содержимым получают один общий номер, поэтому палитра уровней
+    (порядок первого появления цвета) общая для всех источников.
+    """
+
+    def __init__(self, CONFIG):
+        self.CONFIG = CONFIG
+        self.fill_ids = array('I')
+        self.fills = []
+        self.fill_index = {}
+        self.colors = {}
+        self.sources = []  # [(путь, строк данных)]
+        self.data_cols = set()
+
+    def add_source(self, path):
+        CONFIG = self.CONFIG
+        color_col_idx = column_index_from_string(CONFIG['color_column'])
+        large = CONFIG.get('scan_columns_by_row') is not None
+        if large:
+            self.data_cols.update(range(1, color_col_idx + 1))
+
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            ws = source_sheet(wb, CONFIG, path)
+            local_ids = array('I')
+            count = 0
+            for k, row in enumerate(ws.iter_rows(min_row=CONFIG['min_row'])):
+                for col, cell in enumerate(row[:color_col_idx] if large else row, 1):
+                    if cell.value not in (None, ""):
+                        count = k + 1
+                        if not large:
+                            self.data_cols.add(col)
+                cell = row[color_col_idx - 1] if len(row) >= color_col_idx else None
+                style_id = getattr(cell, '_style_id', 0)
+                local_ids.append(wb._cell_styles[style_id].fillId if style_id else 0)
+
+            # Строки ниже последней строки с данными не обрабатываются и в палитру не попадают
+            local_to_global = {}
+            for fill_id in local_ids[:count]:
+                gid = local_to_global.get(fill_id)
+                if gid is None:
+                    gid = local_to_global[fill_id] = self.add_fill(wb._fills[fill_id])
+                self.fill_ids.append(gid)
+        finally:
+            wb.close()
+        self.sources.append((path, count))
+        return count
+
+    def add_fill(self, fill):
+        gid = self.fill_index.get(fill)
+        if gid is None:
+            gid = self.fill_index[fill] = len(self.fills)
+            self.fills.append(fill)
+            self.colors[gid] = fill_color(fill)
+        return gid
+
+    def row_state(self):
+        state = RowState(1, len(self.fill_ids))
+        state.fill_ids = self.fill_ids
+        state.fills = self.fills
+        state.colors = self.colors
+        state.rows_read = state.count
+        return state
+
+
+class MergeStyles:
+    """
+    Итоговый стиль ячейки после этапов обработки — те же правила, что в process_workbook
+    для режима «по ячейкам». Считается один раз на сочетание (стиль источника, столбец, уровень, заливка).
+    """
+
+    def __init__(self, CONFIG, used_cols, log):
+        stages = CONFIG['stages']
+        self.used_cols = used_cols = set(used_cols)
+
+        self.hierarchy_col = column_index_from_string(CONFIG['hierarchy_column']) if CONFIG['hierarchy_column'] else None
+        self.colors = stages['hierarchy_colors']
+        self.wrap_cols = set()
+        if stages['wrap_text'] and CONFIG['wrap_text_columns']:
+            self.wrap_cols = {column_index_from_string(c) for c in CONFIG['wrap_text_columns']} & used_cols
+        self.alignments = {}
+        if stages['alignment']:
+            for cols, vertical, horizontal in prepare_alignment_rules(CONFIG['alignment_rules'], log):
+                for c in cols:
+                    col = column_index_from_string(c)
+                    if col in used_cols:
+                        self.alignments.setdefault(col, []).append((vertical, horizontal))
+        self.formats = {}
+        if stages['number_formats']:
+            for cols, fmt in prepare_column_formats(CONFIG['column_formats'], log):
+                for c in cols:
+                    col = column_index_from_string(c)
+                    if col in used_cols:
+                        self.formats.setdefault(col, []).append(fmt)
+        self.formatting = stages['formatting']
+        if self.formatting:
+            font = CONFIG['font']
+            self.font_args = dict(name=font.get('name', 'Times New Roman'), size=font.get('size', 14),
+                                  italic=font.get('italic', False),
+                                  underline='single' if font.get('underline', False) else None)
+            self.font_bold = font.get('bold', False)
+            self.bold_levels = CONFIG.get('bold_levels', [1, 2])
+            side = Side(style=CONFIG.get('border_style', 'thin'))
+            self.border = Border(left=side, right=side, top=side, bottom=side)
+
+    def style(self, ws, copier, style_id, col, level, fill, has_value):
+        key = (style_id, col, level, id(fill) if fill is not None else None, has_value)
+        cache = copier.derived
+        if key in cache:
+            return cache[key]
+
+        cell = WriteOnlyCell(ws)
+        cell._style = StyleArray(copier(style_id)) if style_id else StyleArray()
+        if col == self.hierarchy_col and self.colors and fill is not None:
+            cell.fill = fill
+        if col in self.wrap_cols:
+            a = cell.alignment
+            cell.alignment = Alignment(horizontal=a.horizontal or 'left', vertical=a.vertical or 'bottom', wrap_text=True)
+        for vertical, horizontal in self.alignments.get(col, ()):
+            cell.alignment = Alignment(vertical=vertical, horizontal=horizontal, wrap_text=cell.alignment.wrap_text)
+        if self.formatting and col in self.used_cols:
+            cell.font = Font(bold=self.font_bold or level in self.bold_levels, **self.font_args)
+            cell.border = self.border
+            if fill is not None and self.colors:
+                cell.fill = fill
+        if has_value:
+            for fmt in self.formats.get(col, ()):
+                cell.number_format = fmt
+
+        result = cell._style if cell.has_style else None
+        cache[key] = result
+        return result
+
+
+def copy_layout(ws, src_ws, copier, min_row):
+    """
+    Ширины столбцов и объединённые ячейки шапки (строки выше min_row) листа-источника в выходной лист.
+    Вызывается до первой записанной строки: write_only-лист пишет <cols> вместе с ней.
+    """
+    with src_ws._get_source() as source:
+        columns, merged = scan_layout(source)
+    for attrs in columns:
+        if 'min' not in attrs:
+            continue
+        letter = get_column_letter(int(attrs['min']))
+        style = copier(int(attrs['style'])) if attrs.get('style') else None
+        ws.column_dimensions[letter] = ColumnDimension(
+            ws, index=letter, style=style, **{k: v for k, v in attrs.items() if k in COLUMN_ATTRS})
+    for ref in merged:
+        if CellRange(ref).max_row < min_row:
+            ws.merged_cells.add(ref)
+
+
+def unique_title(title, taken):
+    title = title[:MAX_SHEET_TITLE]
+    candidate, n = title, 1
+    while candidate in taken:
+        n += 1
+        suffix = f" ({n})"
+        candidate = title[:MAX_SHEET_TITLE - len(suffix)] + suffix
+    taken.add(candidate)
+    return candidate
+
+
+def merge_excel(CONFIG, input_files, log_callback=None, stop_callback=None):
+    """
+    Объединяет строки данных (начиная с min_row) нескольких книг одного формата в один файл CONFIG['output_file']:
+    в один лист (шапка — из первого файла) или, при CONFIG['merge_mode'] == 'per_source', в отдельный лист на источник.
+    Нумерация иерархии сквозная, палитра уровней общая; группировка идёт через границы источников
+    (в режиме «лист на источник» — в пределах листа). Этапы оформления применяются как при обычной обработке;
+    режим «стиль на столбец» здесь не используется — стиль задаётся каждой ячейке.
+    """
+    log, stop_requested = make_callbacks(log_callback, stop_callback)
+
+    try:
+        start = time.perf_counter()
+        per_source = CONFIG.get('merge_mode') == 'per_source'
+        if not CONFIG.get('output_file'):
+            first = Path(input_files[0])
+            CONFIG['output_file'] = str(first.parent / ('объединённый_обработанный' + first.suffix))
+        log(f"🧩 Объединение {len(input_files)} файлов → {CONFIG['output_file']}")
+
+        # --- Проход 1: размеры источников и общая палитра ---
+        scan = MergeScan(CONFIG)
+        for path in input_files:
+            if stop_requested():
+                return False, "Остановлено пользователем"
+            count = scan.add_source(path)
+            log(f"🔍 {path}: строк данных {count}")
+
+        stages = CONFIG['stages']
+        has_hierarchy_col = CONFIG['hierarchy_column'] is not None
+        used_cols = set(scan.data_cols)
+        if has_hierarchy_col:
+            used_cols.add(column_index_from_string(CONFIG['hierarchy_column']))
+        if not scan.fill_ids or not used_cols:
+            log("⚠️  Во входных файлах нет строк данных.")
+            return False, "Нет данных для объединения"
+
+        state = scan.row_state()
+        if (stages['hierarchy'] or stages['grouping']) and has_hierarchy_col:
+            pin_template_palette(state, CONFIG)
+            if state.pinned is not None:
+                # Заливки собраны при сканировании — уровни по закреплённой палитре одним проходом по ним
+                state.levels = array('B', map(state.pinned_level, state.fill_ids))
+            state.assign_levels()
+            report_palette(state, log)
+            log(f"🎨 Общая палитра: {len(state.palette)} цветов")
+        labels = state.labels() if stages['hierarchy'] and has_hierarchy_col else None
+        if stages.get('subtotals'):
+            # Заголовок группы пишется в поток раньше её строк, а значения второй раз не читаются
+            log("⚠️ Подытоги при объединении не считаются — обработайте объединённый файл отдельно")
+
+        grouping = stages['grouping'] and has_hierarchy_col
+        if grouping:
+            # Группы идут через границы источников; в режиме «лист на источник» — в пределах листа
+            offset = 0
+            for _, count in (scan.sources if per_source else [(None, state.count)]):
+                part = RowState(1, count)
+                part.levels = state.levels[offset:offset + count]
+                part.compute_outline()
+                state.outline[offset:offset + count] = part.outline
+                state.collapsed[offset:offset + count] = part.collapsed
+                offset += count
+
+        # --- Проход 2: потоковая запись ---
+        out_wb = Workbook(write_only=True)
+        styles = MergeStyles(CONFIG, used_cols, log)
+        label_col = column_index_from_string(CONFIG['hierarchy_column']) if has_hierarchy_col else None
+        color_fill = stages['hierarchy_colors'] or stages['formatting']
+        width = max(used_cols)
+        titles = set()
+        ws = None
+        i = 0
+
+        for source_index, (path, count) in enumerate(scan.sources):
+            if stop_requested():
+                return False, "Остановлено пользователем"
+            wb = load_workbook(path, read_only=True, data_only=True)
+            try:
+                src_ws = source_sheet(wb, CONFIG, path)
+                new_sheet = per_source or ws is None
+                copier = StyleCopier(wb, out_wb)
+                if new_sheet:
+                    title = Path(path).stem if per_source else src_ws.title
+                    ws = out_wb.create_sheet(unique_title(title, titles))
+                    if grouping:
+                        ws.sheet_properties.outlinePr.summaryBelow = True
+                        ws.sheet_properties.outlinePr.summaryRight = True
+                        ws.sheet_properties.outlinePr.showOutlineSymbols = True
+                    copy_layout(ws, src_ws, copier, CONFIG['min_row'])
+                    out_row = 0
+
+                first_row = 1 if new_sheet else CONFIG['min_row']
+                for row in src_ws.iter_rows(min_row=first_row, max_row=CONFIG['min_row'] - 1 + count):
+                    out_row += 1
+                    if out_row < CONFIG['min_row'] and new_sheet:
+                        ws.append([copy_cell(ws, copier, cell) for cell in row])
+                        continue
+
+                    level = state.levels[i]
+                    fill = state.colored_fill(i) if color_fill else None
+                    label = next(labels) if labels is not None else None
+                    values = []
+                    for col in range(1, max(len(row), width) + 1):
+                        cell = row[col - 1] if col <= len(row) else None
+                        value = getattr(cell, 'value', None)
+                        data_type = getattr(cell, 'data_type', 'n')
+                        if col == label_col and label is not None:
+                            value, data_type = label, 's'
+                        style = styles.style(ws, copier, getattr(cell, '_style_id', 0), col, level, fill, value is not None)
+                        if style is None and data_type != 's':
+                            values.append(value)
+                            continue
+                        out = WriteOnlyCell(ws, value)
+                        if value is not None:
+                            out.data_type = data_type
+                        if style is not None:
+                            out._style = StyleArray(style)
+                        values.append(out)
+
+                    if grouping and (state.outline[i] or state.collapsed[i]):
+                        dim = ws.row_dimensions[out_row]
+                        dim.outlineLevel = state.outline[i]
+                        dim.collapsed = bool(state.collapsed[i])
+                        ws.append(values)
+                        # Строка уже записана в поток — её размеры больше не нужны
+                        del ws.row_dimensions[out_row]
+                    else:
+                        ws.append(values)
+                    i += 1
+            finally:
+                wb.close()
+            log(f"✅ {path}: добавлено строк {count}")
+
+        save_workbook(out_wb, CONFIG['output_file'],
+                      compression=CONFIG.get('save_compression', DEFAULT_COMPRESSION), parallel=False, log=log)
+        log(f"\n🎉 УСПЕШНО: объединено строк {state.count} из {len(scan.sources)} файлов за {time.perf_counter() - start:.1f} с")
+        log(f"📁 {CONFIG['output_file']}")
+        return True, "Объединение завершено успешно."
+
+    except Exception as e:
+        error_msg = f"❌ Ошибка: {str(e)}"
+        log(error_msg)
+        return False, error_msg
+
+
+def copy_cell(ws, copier, cell):
+    value = getattr(cell, 'value', None)
+    style_id = getattr(cell, '_style_id', 0)
+    if not style_id and getattr(cell, 'data_type', 'n') != 's':
+        return value
+    out = WriteOnlyCell(ws, value)
+    if value is not None:
+        out.data_type = cell.data_type
+    if style_id:
+        out._style = StyleArray(copier(style_id))
+    return out
+
+
+if __name__ == '__main__':
+    from server import parse_config
+
+    parser = argparse.ArgumentParser(description="Объединение книг одного формата в один обработанный файл")
+    parser.add_argument('inputs', nargs='+', help="входные файлы .xlsx по порядку")
+    parser.add_argument('--config', required=True, help="JSON настроек вкладки (как в файле настроек программы)")
+    parser.add_argument('--output', help="итоговый файл")
+    parser.add_argument('--per-source', action='store_true', help="отдельный лист на каждый источник")
+    args = parser.parse_args()
+
+    with open(args.config, encoding='utf-8') as f:
+        config = parse_config(f.read())
+    config['output_file'] = args.output
+    config['merge_mode'] = 'per_source' if args.per_source else 'single'
+    success, message = merge_excel(config, args.inputs)
+    raise SystemExit(0 if success else 1)
@@ -0,0 +1,224 @@
+# parsedcache.py — дисковый кэш разобранных листов: значения, стили ячеек и строки в компактном двоичном виде.
+# Повторная загрузка того же файла разбирает только «скелет» листа (всё, кроме sheetData),
+# а ячейки собираются из кэша — без XML-разбора, который занимает основную часть загрузки
+
+import hashlib
+import io
+import os
+import pickle
+from array import array
+
+import openpyxl
+from openpyxl.cell.cell import Cell, MergedCell
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.worksheet._reader import WorkSheetParser
+from openpyxl.worksheet.dimensions import RowDimension
+
+from cache import ResultCache, app_data_dir, file_digest
+from sheetxml import SheetXml
+
+# Меняется, когда меняется формат записи — старые записи перестают находиться
+PARSED_CACHE_VERSION = 1
+PARSED_CACHE_LIMIT_BYTES = 1024 * 1024 * 1024
+
+
+def parsed_key(source, data_only=True):
+    """Ключ — содержимое файла и всё, от чего зависит результат разбора (версия openpyxl, data_only)."""
+    digest = hashlib.sha256()
+    digest.update(f"v{PARSED_CACHE_VERSION}\n{openpyxl.__version__}\n{data_only}\n".encode())
+    digest.update(file_digest(source).encode())
+    return digest.hexdigest()
+
+
+def capture_sheet(ws):
+    """Запись листа: ячейки (без MergedCell — они восстанавливаются из объединений) и строки."""
+    styles = {None: 0}
+    rows, cols, style_ids = array('I'), array('I'), array('I')
+    values, types = [], []
+    for (row, col), cell in ws._cells.items():
+        if type(cell) is MergedCell:
+            continue
+        style = None if cell._style is None else cell._style.tobytes()
+        style_id = styles.get(style)
+        if style_id is None:
+            style_id = styles[style] = len(styles)
+        rows.append(row)
+        cols.append(col)
+        style_ids.append(style_id)
+        values.append(cell._value)
+        types.append(cell.data_type)
+    dims = [(index, dim.ht, None if dim._style is None else dim._style.tobytes(), dim.hidden,
+             dim.outlineLevel, dim.collapsed, dim.thickBot, dim.thickTop)
+            for index, dim in ws.row_dimensions.items()]
+    table = [None] * len(styles)
+    for style, style_id in styles.items():
+        table[style_id] = style
+    return (rows, cols, style_ids, table, values, ''.join(types), dims)
+
+
+def parse_record(data, shared_strings, cell_styles, data_only=True):
+    """
+    Запись capture_sheet прямо из XML листа, без объектов листа: разбирается только sheetData,
+    id стилей переводятся через cell_styles книги. Так sheetData разбирается в фоне (sheetfeed),
+    а лист потом заполняется restore_sheet.
+    """
+    sheet = SheetXml(data)
+    rows, cols, style_ids = array('I'), array('I'), array('I')
+    values, types = [], []
+    table, ids = [None], {}
+    dims = []
+    if sheet.start == sheet.end:
+        return (rows, cols, style_ids, table, values, '', dims)
+    p = sheet.prefix
+    parser = WorkSheetParser(io.BytesIO(data[:sheet.end] + b'</' + p + b'sheetData></' + p + b'worksheet>'),
+                             shared_strings, data_only=data_only)
+    for _, row in parser.parse():
+        for cell in row:
+            style_id = ids.get(cell['style_id'])
+            if style_id is None:
+                style_id = ids[cell['style_id']] = len(table)
+                table.append(cell_styles[cell['style_id']].tobytes())
+            rows.append(cell['row'])
+            cols.append(cell['column'])
+            style_ids.append(style_id)
+            values.append(cell['value'])
+            types.append(cell['data_type'])
+    for index, attrs in parser.row_dimensions.items():
+        if 's' in attrs:
+            attrs['s'] = cell_styles[int(attrs['s'])]
+        dim = RowDimension(None, **attrs)
+        dims.append((int(index), dim.ht, None if dim._style is None else dim._style.tobytes(), dim.hidden,
+                     dim.outlineLevel, dim.collapsed, dim.thickBot, dim.thickTop))
+    return (rows, cols, style_ids, table, values, ''.join(types), dims)
+
+
+def style_array(data):
+    values = array('i')
+    values.frombytes(data)
+    return StyleArray(values)
+
+
+def restore_sheet(ws, record):
+    """
+    Заполняет лист, разобранный без sheetData, из записи capture_sheet. Ячейки, которые уже создал разбор
+    скелета (гиперссылки, комментарии, объединения), обновляются на месте; границы объединённых
+    ячеек пересчитываются от восстановленной левой верхней ячейки, как при обычной загрузке.
+    """
+    rows, cols, style_ids, table, values, types, dims = record
+    styles = [None if style is None else style_array(style) for style in table]
+    cells = ws._cells
+    new_cell = Cell.__new__
+    for row, col, style_id, value, data_type in zip(rows, cols, style_ids, values, types):
+        c = cells.get((row, col))
+        if c is None:
+            c = new_cell(Cell)
+            c.row = row
+            c.column = col
+            c.parent = ws
+            c._hyperlink = None
+            c._comment = None
+            cells[(row, col)] = c
+        elif type(c) is MergedCell:
+            continue
+        style = styles[style_id]
+        c._style = None if style is None else StyleArray(style)
+        c._value = value
+        c.data_type = data_type
+        if value is None and c._hyperlink is not None:
+            # При обычной загрузке гиперссылка привязывается после значений и пустой ячейке даёт свой адрес
+            c.value = c._hyperlink.target or c._hyperlink.location
+    if rows:
+        # Как при обычной загрузке: последняя строка sheetData или ячеек гиперссылок и комментариев,
+        # но не объединений (они не сдвигают текущую строку)
+        ws._current_row = max(ws._current_row, max(rows))
+    for index, ht, style, hidden, level, collapsed, thick_bot, thick_top in dims:
+        dim = RowDimension(ws, index=index, ht=ht, hidden=hidden, outlineLevel=level, collapsed=collapsed,
+                           thickBot=thick_bot, thickTop=thick_top)
+        if style is not None:
+            dim._style = style_array(style)
+        ws.row_dimensions[index] = dim
+    for mcr in ws.merged_cells.ranges:
+        mcr.format()
+
+
+def skeleton(data):
+    """XML листа без содержимого sheetData: всё остальное (столбцы, объединения, свойства) разбирается как обычно."""
+    sheet = SheetXml(data)
+    return data[:sheet.start] + data[sheet.end:]
+
+
+class SkeletonArchive:
+    """Обёртка архива книги: части листов из skeletons открываются без sheetData."""
+
+    def __init__(self, archive, skeletons):
+        self.archive = archive
+        self.skeletons = skeletons
+
+    def open(self, name, *args, **kwargs):
+        if name in self.skeletons:
+            return io.BytesIO(skeleton(self.archive.read(name)))
+        return self.archive.open(name, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.archive, name)
+
+
+class ParsedCache(ResultCache):
+    """
+    Записи разобранных листов одного файла: {путь части листа: запись capture_sheet}, под ключом parsed_key().
+    Размер и вытеснение — как у кэша результатов (LRU по mtime).
+    """
+    suffix = '.sheets'
+
+    def __init__(self, directory=None, limit=PARSED_CACHE_LIMIT_BYTES):
+        super().__init__(directory or app_data_dir('parsed'), limit)
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                records = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return {}
+        os.utime(path)
+        return records
+
+    def save(self, key, records):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.path(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+
+class SheetCache:
+    """Кэш листов одной загрузки: какие листы есть в кэше и какие нужно дописать после разбора."""
+
+    def __init__(self, cache, source, data_only=True):
+        self.cache = cache
+        self.key = parsed_key(source, data_only)
+        self.records = cache.load(self.key)
+        self.hits = 0
+        self.captured = 0
+        self.error = None
+
+    def wrap(self, archive):
+        return SkeletonArchive(archive, set(self.records))
+
+    def finish(self, wb, targets):
+        """targets — {имя листа: путь части} разобранных листов книги."""
+        for name, target in targets.items():
+            ws = wb[name]
+            record = self.records.get(target)
+            if record is not None:
+                restore_sheet(ws, record)
+                self.hits += 1
+            else:
+                self.records[target] = capture_sheet(ws)
+                self.captured += 1
+        if self.captured:
+            try:
+                self.cache.save(self.key, self.records)
+            except OSError as e:
+                self.error = e
@@ -0,0 +1,244 @@
+# passthrough.py — выборочная загрузка книги: разбираются только выбранные листы,
+# остальные переносятся в результат из исходного архива байт в байт вместе с рисунками, диаграммами и таблицами
+
+import mimetypes
+import posixpath
+import re
+from zipfile import ZipFile
+
+from openpyxl.packaging.manifest import Manifest, Override
+from openpyxl.packaging.relationship import Relationship, RelationshipList, get_rels_path
+from openpyxl.reader.excel import ExcelReader
+from openpyxl.xml.constants import ARC_CONTENT_TYPES, ARC_SHARED_STRINGS, ARC_WORKBOOK_RELS, SHARED_STRINGS
+from openpyxl.xml.functions import fromstring, tostring
+
+from mapped import zip_source
+from parsedcache import SkeletonArchive
+
+# Связи листа, которые можно перенести вместе с ним: всё, на что они ссылаются, лежит в частях самого листа.
+# Сводные таблицы, срезы и подобное держатся на кэшах уровня книги — такие листы разбираются как обычно.
+PASSTHROUGH_REL_TYPES = {
+    'drawing', 'vmlDrawing', 'chart', 'chartUserShapes', 'chartStyle', 'chartColorStyle',
+    'image', 'comments', 'table', 'printerSettings', 'hyperlink',
+}
+TABLE_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.table+xml'
+# id таблиц в книге должны быть уникальными; openpyxl нумерует таблицы разобранных листов с 1
+PASSTHROUGH_TABLE_ID_START = 100000
+PART_PREFIX = 'pt_'
+
+
+def rel_kind(rel):
+    return rel.Type.rsplit('/', 1)[-1]
+
+
+class PassthroughSource:
+    """Откуда брать перенесённые листы при записи: исходный архив и номер последнего стиля ячеек исходной книги."""
+
+    def __init__(self, source, shared_strings, pinned_styles, strings=()):
+        self.source = source
+        self.shared_strings = shared_strings  # путь sharedStrings.xml в исходном архиве или None
+        self.pinned_styles = pinned_styles
+        self.strings = strings  # общие строки исходной книги — для просмотра листов без разбора (sheetxml)
+
+    def read(self, path):
+        with ZipFile(zip_source(self.source)) as archive:
+            return archive.read(path)
+
+
+class SelectiveReader(ExcelReader):
+    """
+    ExcelReader, который разбирает только листы из selected (None — все). Остальные листы становятся
+    пустыми заглушками с ws._passthrough = путь части листа в архиве и при записи копируются как есть.
+    Лист со связями вне PASSTHROUGH_REL_TYPES разбирается целиком, как раньше.
+    С value_free заглушками становятся и выбранные листы: их строки обрабатываются прямо в XML
+    (processor.process_sheet_xml), значения ячеек не декодируются.
+    sheet_cache — parsedcache.SheetCache: листы из кэша разбираются без sheetData и заполняются из него,
+    остальные разобранные листы дописываются в кэш.
+    feed — sheetfeed.SheetFeed (только без sheet_cache): выбранные листы разбираются без sheetData,
+    а их ячейки — в фоне, в порядке selected.
+    """
+
+    def __init__(self, source, selected, data_only=True, value_free=False, sheet_cache=None, feed=None):
+        super().__init__(zip_source(source), data_only=data_only)
+        self.source = source
+        self.order = None if selected is None else list(selected)
+        self.selected = None if selected is None else set(selected)
+        self.value_free = value_free
+        self.stubs = 0
+        self.sheet_cache = sheet_cache
+        self.parsed = {}  # имя разобранного листа -> путь его части
+        if sheet_cache is not None:
+            self.archive = sheet_cache.wrap(self.archive)
+        self.feed = feed if sheet_cache is None and not value_free else None
+        self.deferred = {}  # имя листа -> путь части, ячейки которого разберёт feed
+        if self.feed is not None:
+            self.archive = SkeletonArchive(self.archive, set())
+
+    def can_pass(self, target):
+        rels_path = get_rels_path(target)
+        if rels_path not in self.valid_files:
+            return True
+        rels = RelationshipList.from_tree(fromstring(self.archive.read(rels_path)))
+        return all(rel_kind(rel) in PASSTHROUGH_REL_TYPES for rel in rels)
+
+    def read_worksheets(self):
+        find_sheets = self.parser.find_sheets
+
+        # Заглушки создаются по ходу обхода, поэтому порядок листов в книге сохраняется
+        def selected_sheets():
+            for sheet, rel in find_sheets():
+                selected = self.selected is None or sheet.name in self.selected
+                if (selected and not self.value_free or rel.target not in self.valid_files
+                        or 'chartsheet' in rel.Type or not self.can_pass(rel.target)):
+                    if rel.target in self.valid_files and 'chartsheet' not in rel.Type:
+                        self.parsed[sheet.name] = rel.target
+                        if self.feed is not None and selected:
+                            self.deferred[sheet.name] = rel.target
+                            self.archive.skeletons.add(rel.target)
+                    yield sheet, rel
+                    continue
+                ws = self.wb.create_sheet(sheet.name)
+                ws.sheet_state = sheet.state
+                ws._passthrough = rel.target
+                ws._value_free = selected
+                self.stubs += 1
+
+        self.parser.find_sheets = selected_sheets
+        super().read_worksheets()
+        if self.sheet_cache is not None:
+            self.sheet_cache.finish(self.wb, self.parsed)
+        if self.feed is not None:
+            order = self.order or self.wb.sheetnames
+            self.feed.start(self.wb, [(name, self.deferred[name]) for name in order if name in self.deferred],
+                            self.shared_strings)
+
+    def read(self):
+        super().read()
+        if self.stubs:
+            ct = self.package.find(SHARED_STRINGS)
+            self.wb._passthrough = PassthroughSource(
+                self.source, ct.PartName[1:] if ct is not None else None, len(self.wb._cell_styles),
+                self.shared_strings if self.value_free else ())
+
+
+def load_selected(source, sheet_names, data_only=True, value_free=False, sheet_cache=None, feed=None):
+    """
+    Загружает книгу, разбирая только листы sheet_names (None — все).
+    value_free — выбранные листы тоже не разбираются; sheet_cache — кэш разобранных листов,
+    feed — фоновый разбор ячеек выбранных листов (см. SelectiveReader).
+    source — путь, mapped.MappedFile или поток с произвольным доступом; поток (отображение) должен оставаться
+    открытым до записи результата.
+    """
+    if not sheet_names and not value_free and sheet_cache is None and feed is None:
+        from openpyxl import load_workbook
+        return load_workbook(zip_source(source), data_only=data_only)
+    reader = SelectiveReader(source, sheet_names or None, data_only=data_only, value_free=value_free,
+                             sheet_cache=sheet_cache, feed=feed)
+    reader.read()
+    return reader.wb
+
+
+def passthrough_sheets(wb):
+    return [ws for ws in wb.worksheets if getattr(ws, '_passthrough', None)]
+
+
+class PassthroughCopier:
+    """Копирует части перенесённых листов из исходного архива в архив результата."""
+
+    def __init__(self, source, archive, manifest):
+        self.source = ZipFile(zip_source(source.source))
+        self.info = source
+        self.archive = archive
+        self.manifest = manifest
+        self.types = Manifest.from_tree(fromstring(self.source.read(ARC_CONTENT_TYPES)))
+        self.copied = {}
+        self.tables = PASSTHROUGH_TABLE_ID_START
+
+    def close(self):
+        self.source.close()
+
+    def content_type(self, path):
+        for override in self.types.Override:
+            if override.PartName == '/' + path:
+                return override.ContentType
+        ext = posixpath.splitext(path)[1][1:].lower()
+        for default in self.types.Default:
+            if default.Extension.lower() == ext:
+                return default.ContentType
+        return None
+
+    def register(self, path, content_type):
+        if content_type is None:
+            return
+        self.manifest.Override.append(Override(PartName='/' + path, ContentType=content_type))
+        # openpyxl регистрирует тип для каждого расширения в архиве и падает на незнакомых (.wmf и т.п.)
+        ext = posixpath.splitext(path)[1].lower()
+        if ext and ext not in mimetypes.types_map:
+            mimetypes.add_type(content_type, ext)
+
+    def copy_rels(self, src_path, dst_path):
+        """Переносит связи части src_path (копируя их цели) как связи части dst_path."""
+        rels_path = get_rels_path(src_path)
+        if rels_path not in self.source.namelist():
+            return
+        rels = RelationshipList.from_tree(fromstring(self.source.read(rels_path)))
+        folder = posixpath.dirname(src_path)
+        for rel in rels:
+            if rel.TargetMode == 'External':
+                continue
+            if rel.Target.startswith('/'):
+                target = rel.Target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join(folder, rel.Target))
+            rel.Target = '/' + self.copy_part(target)
+        self.archive.writestr(get_rels_path(dst_path), tostring(rels.to_tree()))
+
+    def copy_part(self, path):
+        if path in self.copied:
+            return self.copied[path]
+        folder, name = posixpath.split(path)
+        new_path = posixpath.join(folder, PART_PREFIX + name)
+        self.copied[path] = new_path
+        content_type = self.content_type(path)
+        data = self.source.read(path)
+        if content_type == TABLE_TYPE:
+            self.tables += 1
+            data = re.sub(rb'(<(?:\w+:)?table\b[^>]*?\bid=")\d+(")', rb'\g<1>%d\g<2>' % self.tables, data, count=1)
+        self.archive.writestr(new_path, data)
+        self.register(new_path, content_type)
+        self.copy_rels(path, new_path)
+        return new_path
+
+    def copy_sheet(self, ws):
+        """Лист пишется под именем, которое ему дал ExcelWriter (ws.path)."""
+        path = ws.path[1:]
+        data = getattr(ws, '_passthrough_data', None)  # лист, обработанный в XML
+        self.archive.writestr(path, data if data is not None else self.source.read(ws._passthrough))
+        self.copy_rels(ws._passthrough, path)
+
+    def copy_shared_strings(self):
+        """Перенесённые листы ссылаются на общую таблицу строк исходной книги; openpyxl её не пишет."""
+        if self.info.shared_strings is None:
+            return None
+        self.archive.writestr(ARC_SHARED_STRINGS, self.source.read(self.info.shared_strings))
+        self.register(ARC_SHARED_STRINGS, SHARED_STRINGS)
+        return Relationship(Id='rIdSharedStrings', type='sharedStrings', Target='sharedStrings.xml')
+
+
+class RelsPatchingArchive:
+    """Обёртка архива: дописывает связи в workbook.xml.rels, который ExcelWriter формирует сам."""
+
+    def __init__(self, archive, extra_rels):
+        self.archive = archive
+        self.extra_rels = extra_rels
+
+    def writestr(self, name, data, *args, **kwargs):
+        if name == ARC_WORKBOOK_RELS and self.extra_rels:
+            rels = RelationshipList.from_tree(fromstring(data))
+            for rel in self.extra_rels:
+                rels.append(rel)
+            data = tostring(rels.to_tree())
+        return self.archive.writestr(name, data, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.archive, name)
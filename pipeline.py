@@ -0,0 +1,81 @@
+# pipeline.py — конвейер из трёх стадий для пакета файлов: пока текущий файл обрабатывается,
+# следующий уже читается, а предыдущий сжимается и записывается
+
+import queue
+import threading
+
+# Сколько элементов может ждать между стадиями: прочитанных наперёд и ожидающих записи
+PIPELINE_DEPTH = 1
+
+
+_DONE = object()
+
+
+def run_pipeline(items, read, process, write, depth=PIPELINE_DEPTH):
+    """
+    Для каждого элемента: read(item) в потоке чтения, process(item, data, emit) в вызывающем потоке,
+    write(value) в потоке записи — для каждого значения, переданного в emit (их может быть несколько).
+    Читается не больше depth элементов наперёд и ждёт записи не больше depth значений, поэтому
+    в памяти одновременно не больше 2 * depth + 1 книг. Стадии сами обрабатывают свои ошибки;
+    необработанное исключение стадии останавливает конвейер и поднимается из run_pipeline.
+    """
+    items = list(items)
+    loaded, written = queue.Queue(), queue.Queue()
+    # Места в очередях: занимаются до чтения (до передачи на запись), освобождаются, когда элемент забран дальше
+    read_slots, write_slots = threading.Semaphore(depth), threading.Semaphore(depth)
+    stop = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            for item in items:
+                read_slots.acquire()
+                if stop.is_set():
+                    break
+                loaded.put((item, read(item)))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            loaded.put(_DONE)
+
+    def writer():
+        while True:
+            value = written.get()
+            if value is _DONE:
+                return
+            try:
+                if not errors:
+                    write(value)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                write_slots.release()
+
+    def emit(value):
+        write_slots.acquire()
+        written.put(value)
+
+    threads = [threading.Thread(target=reader, name='pipeline-read', daemon=True),
+               threading.Thread(target=writer, name='pipeline-write', daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while not stop.is_set():
+            entry = loaded.get()
+            if entry is _DONE:
+                break
+            read_slots.release()
+            if errors:
+                break
+            process(entry[0], entry[1], emit)
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        stop.set()
+        read_slots.release()  # поток чтения может ждать места
+        written.put(_DONE)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
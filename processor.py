@@ -1,15 +1,37 @@
 # processor.py — обновлённая версия с логикой "Большой файл = до color_column включительно"
 
+import io
+import re
 import time
 import os
+from array import array
 from pathlib import Path
 from openpyxl import load_workbook
 from openpyxl.styles import Font, Border, Side, Alignment, PatternFill
 from openpyxl.utils import get_column_letter, column_index_from_string
-from copy import copy
+from openpyxl.cell.cell import Cell, MergedCell
+from openpyxl.formatting.rule import Rule
+from openpyxl.styles.differential import DifferentialStyle
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.named_styles import NamedStyleList
+from openpyxl.worksheet.dimensions import ColumnDimension, DimensionHolder
+from openpyxl.styles.numbers import BUILTIN_FORMATS_MAX_SIZE, BUILTIN_FORMATS_REVERSE
+from openpyxl.utils.indexed_list import IndexedList
+from copy import copy, deepcopy
+from cache import ResultCache, result_key
+from saver import save_workbook, write_workbook, DEFAULT_COMPRESSION
+from checkpoint import Checkpoint
+from export import export_path, open_export, parquet_available
+from mapped import MappedFile
+from passthrough import load_selected, passthrough_sheets
+from parsedcache import ParsedCache, SheetCache
+from sheetfeed import SheetFeed, finish_sheets, wait_sheet
+from sheetxml import SheetXml, SheetPatch, scan_rows
 
 def get_cell_color(cell):
-    fill = cell.fill
+    return fill_color(cell.fill)
+
+def fill_color(fill):
     if not fill or fill.fgColor is None:
         return None
     fg = fill.fgColor
@@ -24,6 +46,189 @@ def get_cell_color(cell):
         return f"INDEXED_{fg.indexed}"
     return None
 
+WHITE_LIKE = (None, 'FFFFFFFF', '00000000')
+
+class RowState:
+    """
+    Состояние строк листа в компактных массивах, индекс — смещение строки от min_row.
+    На строку приходится около 11 байт: id заливки цветовой ячейки, уровень,
+    уровень группировки, признак свёрнутости и последняя строка группы.
+    """
+
+    def __init__(self, min_row, last_row):
+        self.min_row = min_row
+        self.count = last_row - min_row + 1
+        self.fill_ids = array('I', [0]) * self.count
+        self.levels = array('B', [9]) * self.count
+        self.outline = array('B', [0]) * self.count
+        self.collapsed = array('B', [0]) * self.count
+        self.group_end = array('I', [0]) * self.count
+        self.fills = []
+        self.colors = {}
+        self.fill_copies = {}
+        # Какие этапы анализа уже пройдены — снимок тёплого анализа (snapshot) не повторяет их
+        self.rows_read = 0
+        self.rows_outlined = 0
+        self.levels_ready = False
+        # Закреплённая палитра шаблона (pin_palette): уровни считаются прямо при чтении заливок
+        self.pinned = None
+        self.unknown_policy = 'discover'
+        self.level_by_fill = {}
+        self.unknown = []
+
+    def pin_palette(self, palette, unknown='discover'):
+        """
+        Уровни по готовой палитре: palette[0] — уровень 1 и т.д., белые и пустые — уровень len(palette) + 1.
+        Цвета не из палитры собираются в self.unknown; unknown='discover' — тогда уровни
+        пересчитываются как обычно, но палитра идёт первой; 'flag' — они получают последний уровень.
+        """
+        self.pinned = {color: i + 1 for i, color in enumerate(palette)}
+        self.unknown_policy = unknown
+
+    def pinned_level(self, fill_id):
+        level = self.level_by_fill.get(fill_id)
+        if level is None:
+            color = self.colors[fill_id]
+            level = self.pinned.get(color)
+            if level is None:
+                level = len(self.pinned) + 1
+                if color not in WHITE_LIKE and color not in self.unknown:
+                    self.unknown.append(color)
+            self.level_by_fill[fill_id] = level
+        return level
+
+    def read_fills(self, ws, color_col_idx):
+        # Цвет зависит только от заливки, поэтому fill_color вызывается один раз на каждую заливку.
+        # Отсутствующая ячейка не создаётся: у неё заливка по умолчанию (id 0)
+        self.fills = ws.parent._fills
+        if self.rows_read == self.count:
+            return
+        cells = ws._cells
+        for i in range(self.count):
+            cell = cells.get((self.min_row + i, color_col_idx))
+            fill_id = cell._style.fillId if cell is not None and cell._style is not None else 0
+            self.fill_ids[i] = fill_id
+            if fill_id not in self.colors:
+                self.colors[fill_id] = fill_color(self.fills[fill_id])
+            if self.pinned is not None:
+                self.levels[i] = self.pinned_level(fill_id)
+        self.rows_read = self.count
+
+    def read_style_fills(self, styles, cell_styles, fills):
+        """То же, что read_fills, по id стилей ячеек цветового столбца {строка: s} из XML листа (sheetxml.scan_rows)."""
+        self.fills = fills
+        for i in range(self.count):
+            s = styles.get(self.min_row + i)
+            fill_id = cell_styles[s].fillId if s else 0
+            self.fill_ids[i] = fill_id
+            if fill_id not in self.colors:
+                self.colors[fill_id] = fill_color(self.fills[fill_id])
+            if self.pinned is not None:
+                self.levels[i] = self.pinned_level(fill_id)
+        self.rows_read = self.count
+
+    def colored_fill(self, i):
+        fill_id = self.fill_ids[i]
+        if self.colors[fill_id] in WHITE_LIKE or not self.fills[fill_id]:
+            return None
+        if fill_id not in self.fill_copies:
+            self.fill_copies[fill_id] = copy(self.fills[fill_id])
+        return self.fill_copies[fill_id]
+
+    @property
+    def palette(self):
+        # colors заполняется в порядке строк, поэтому его порядок — порядок первого появления цвета
+        seen_colors = list(self.pinned or ())
+        for color in self.colors.values():
+            if color not in WHITE_LIKE and color not in seen_colors:
+                seen_colors.append(color)
+        return seen_colors
+
+    def assign_levels(self):
+        if self.pinned is not None and not (self.unknown and self.unknown_policy == 'discover'):
+            # Палитра закреплена — уровни уже проставлены при чтении заливок, второй проход не нужен
+            self.levels_ready = True
+            return
+        # Уровни — по порядку первого появления цвета; белые и пустые — последний уровень
+        seen_colors = self.palette
+        color_to_level = {color: i + 1 for i, color in enumerate(seen_colors or ['DUMMY'])}
+        last_level = len(seen_colors) + 1 if seen_colors else 2
+        level_by_fill = {fill_id: color_to_level.get(color, last_level) for fill_id, color in self.colors.items()}
+        self.levels = array('B', [level_by_fill[fill_id] for fill_id in self.fill_ids])
+        self.levels_ready = True
+
+    def labels(self):
+        # Номер строки — номер ближайшей строки уровнем выше плюс свой счётчик: он собирается из готового
+        # номера родителя, а не из всех уровней заново. Пропущенные уровни в номер не входят
+        stack = []  # (уровень, счётчик, номер) — ненулевые счётчики уровней от первого до текущего
+        for level in self.levels:
+            while stack and stack[-1][0] > level:
+                stack.pop()
+            count = stack.pop()[1] + 1 if stack and stack[-1][0] == level else 1
+            label = f"{stack[-1][2]}.{count}" if stack else str(count)
+            stack.append((level, count, label))
+            yield label
+
+    def compute_outline(self):
+        """
+        Один проход со стеком открытых групп. Группу открывает строка уровня 1–7,
+        за которой идёт строка более глубокого уровня; строки внутри получают уровень
+        самой глубокой открытой группы, а сама строка-заголовок — свой уровень минус один.
+        """
+        levels = self.levels
+        stack = []
+        for i in range(self.count):
+            level = levels[i]
+            while stack and levels[stack[-1]] >= level:
+                self.group_end[stack.pop()] = i - 1
+            if level <= 7 and i + 1 < self.count and levels[i + 1] > level:
+                self.outline[i] = level - 1
+                self.collapsed[i] = 1
+                stack.append(i)
+            else:
+                self.outline[i] = levels[stack[-1]] if stack else 0
+                self.group_end[i] = i
+        for i in stack:
+            self.group_end[i] = self.count - 1
+        self.rows_outlined = self.count
+
+    def subtotals(self, values):
+        """
+        Суммы групп одним проходом префиксных сумм: values[i] — число в строке i или None.
+        Складываются только строки без своей группы, поэтому вложенные заголовки не учитываются дважды.
+        Возвращает {i: сумма} для строк-заголовков (compute_outline уже посчитан).
+        """
+        prefix = [0] * (self.count + 1)
+        total = 0
+        for i, value in enumerate(values):
+            if value is not None and not self.collapsed[i]:
+                total += value
+            prefix[i + 1] = total
+        sums = {}
+        for i in range(self.count):
+            if self.collapsed[i]:
+                value = prefix[self.group_end[i] + 1] - prefix[i + 1]
+                # Разность больших дробных префиксов оставляет хвосты вида ...0000001
+                sums[i] = round(value, 10) if isinstance(value, float) else value
+        return sums
+
+    def snapshot(self):
+        """
+        Независимая копия состояния (тёплый анализ warm.WarmAnalysis): массивы и изменяемые поля копируются,
+        поэтому продолжение анализа в одной копии не задевает другую и сохранённую.
+        """
+        clone = copy(self)
+        clone.fill_ids = self.fill_ids[:]
+        clone.levels = self.levels[:]
+        clone.outline = self.outline[:]
+        clone.collapsed = self.collapsed[:]
+        clone.group_end = self.group_end[:]
+        clone.colors = dict(self.colors)
+        clone.fill_copies = {}
+        clone.level_by_fill = dict(self.level_by_fill)
+        clone.unknown = list(self.unknown)
+        return clone
+
 def expand_column_range(col_range):
     if not col_range:
         return []
@@ -34,18 +239,1037 @@ def expand_column_range(col_range):
     end_idx = column_index_from_string(end)
     return [get_column_letter(i) for i in range(start_idx, end_idx + 1)]
 
-def process_excel(CONFIG, log_callback=None):
+def prepare_alignment_rules(rules, log):
+    """Проверяет правила выравнивания; возвращает [(столбцы, vertical, horizontal)] без ошибочных правил."""
+    prepared = []
+    for rule in rules or []:
+        if len(rule) != 3:
+            continue
+        col_range, vertical, horizontal = rule
+        try:
+            cols = expand_column_range(col_range.strip().upper())
+            Alignment(vertical=vertical, horizontal=horizontal)
+        except (ValueError, TypeError, AttributeError) as e:
+            log(f"⚠️ Правило выравнивания {col_range} пропущено: {e}")
+            continue
+        prepared.append((cols, vertical, horizontal))
+    return prepared
+
+def prepare_column_formats(formats, log):
+    """Проверяет числовые форматы; возвращает [(столбцы, формат)] без ошибочных записей."""
+    prepared = []
+    for col_range, num_format in (formats or {}).items():
+        if not isinstance(num_format, str) or not num_format.strip():
+            log(f"⚠️ Формат для {col_range} пропущен: пустой формат")
+            continue
+        try:
+            cols = expand_column_range(col_range.strip().upper())
+        except (ValueError, AttributeError) as e:
+            log(f"⚠️ Формат для {col_range} пропущен: {e}")
+            continue
+        prepared.append((cols, num_format))
+    return prepared
+
+def prepare_subtotal_columns(columns, log):
+    """Проверяет столбцы подытогов; возвращает номера столбцов без повторов и ошибочных записей."""
+    prepared = []
+    for col_range in columns or []:
+        try:
+            cols = expand_column_range(col_range.strip().upper())
+        except (ValueError, AttributeError) as e:
+            log(f"⚠️ Столбец подытогов {col_range} пропущен: {e}")
+            continue
+        for col in cols:
+            col_idx = column_index_from_string(col)
+            if col_idx not in prepared:
+                prepared.append(col_idx)
+    return prepared
+
+def numeric_value(value):
+    # bool — тоже int, но в сумму не идёт
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return None
+
+def column_dimension(ws, col_idx):
     """
-    Основная функция обработки. Принимает CONFIG и опциональный callback для логов.
+    Отдельная запись <col> для столбца. Если столбец входит в общий диапазон min..max,
+    диапазон разбивается, чтобы стиль менялся только у нужного столбца.
+    """
+    letter = get_column_letter(col_idx)
+    for key, dim in list(ws.column_dimensions.items()):
+        dim.reindex()
+        if dim.min <= col_idx <= dim.max and dim.min != dim.max:
+            del ws.column_dimensions[key]
+            for i in range(dim.min, dim.max + 1):
+                ws.column_dimensions[get_column_letter(i)] = ColumnDimension(
+                    ws, index=get_column_letter(i), width=dim.width, bestFit=dim.bestFit,
+                    hidden=dim.hidden, outlineLevel=dim.outlineLevel, collapsed=dim.collapsed,
+                    style=dim._style, min=i, max=i
+                )
+            break
+    if letter not in ws.column_dimensions:
+        # Нулевая ширина не записывается — у столбца остаётся ширина по умолчанию
+        ws.column_dimensions[letter] = ColumnDimension(ws, index=letter, width=0)
+    return ws.column_dimensions[letter]
+
+def _styled_cells(ws, col_idx, min_row, last_row, with_value_only=False):
+    # Ячейки, которые попадут в файл со своим стилем и перекроют стиль столбца
+    cells = ws._cells
+    for row in range(min_row, last_row + 1):
+        cell = cells.get((row, col_idx))
+        if cell is None or cell._value is None and (with_value_only or not cell.has_style):
+            continue
+        yield cell
+
+def _cell_style(cell):
+    if cell._style is None:
+        cell._style = StyleArray()
+    return cell._style
+
+def _remap_style_field(cells, field, remap):
+    """
+    remap(старый id) -> новый id вызывается один раз на каждый встреченный id.
+    Ячейки, у которых id уже целевой, не трогаются; возвращает число изменённых.
+    """
+    cache = {}
+    changed = 0
+    for cell in cells:
+        style = _cell_style(cell)
+        old = getattr(style, field)
+        new = cache.get(old)
+        if new is None:
+            new = cache[old] = remap(old)
+        if new != old:
+            setattr(style, field, new)
+            changed += 1
+    return changed
+
+def number_format_id(wb, num_format):
+    # Так же, как cell.number_format = ...: встроенные форматы — по номеру, свои — после встроенных
+    if num_format in BUILTIN_FORMATS_REVERSE:
+        return BUILTIN_FORMATS_REVERSE[num_format]
+    return wb._number_formats.add(num_format) + BUILTIN_FORMATS_MAX_SIZE
+
+def apply_column_alignment(ws, col_idx, min_row, last_row, make_alignment):
+    """Режим «стиль на столбец»: make_alignment(текущее выравнивание) -> новое выравнивание. Возвращает число изменений."""
+    wb = ws.parent
+    dim = column_dimension(ws, col_idx)
+    old = dim._style.alignmentId if dim._style is not None else 0
+    dim.alignment = make_alignment(dim.alignment)
+    return int(dim._style.alignmentId != old) + _remap_style_field(
+        _styled_cells(ws, col_idx, min_row, last_row), 'alignmentId',
+        lambda old: wb._alignments.add(make_alignment(wb._alignments[old]))
+    )
+
+def apply_column_number_format(ws, col_idx, min_row, last_row, num_format):
+    """Режим «стиль на столбец»: формат столбца и ячеек со значениями. Возвращает число изменений."""
+    dim = column_dimension(ws, col_idx)
+    old = dim._style.numFmtId if dim._style is not None else 0
+    dim.number_format = num_format
+    fmt_id = dim._style.numFmtId
+    return int(fmt_id != old) + _remap_style_field(
+        _styled_cells(ws, col_idx, min_row, last_row, with_value_only=True), 'numFmtId', lambda old: fmt_id)
+
+# Правило цвета уровня смотрит на скрытый служебный столбец уровней (номер уровня по цвету строки).
+# N() отличает эти правила от правил пользователя при повторной обработке
+LEVEL_RULE_FORMULA = 'N(${col}{row})={level}'
+_LEVEL_RULE_RE = re.compile(r'N\(\$([A-Z]+)(\d+)\)=\d+$')
+# Правила прежнего вида (по глубине номера) тоже узнаются и заменяются
+_DEPTH_RULE_RE = re.compile(r'LEN\(\$([A-Z]+)(\d+)\)-LEN\(SUBSTITUTE\(\$\1\2,"\.",""\)\)=\d+$')
+
+def level_rule_fills(state):
+    """
+    {уровень: заливка} для правил условного форматирования. Правило получает уровень, у всех строк
+    которого одна и та же сплошная заливка; строки остальных уровней (разные или узорные заливки)
+    красятся по ячейкам, как без этого режима. Уровням без цвета правила не нужны.
+    """
+    fills = {}
+    mixed = set()
+    for i, level in enumerate(state.levels):
+        fill = state.colored_fill(i)  # одна и та же копия на каждую заливку источника
+        first = fills.setdefault(level, fill)
+        if first is not fill and first != fill:
+            mixed.add(level)
+    return {level: fill for level, fill in fills.items()
+            if level not in mixed and isinstance(fill, PatternFill) and fill.fill_type == 'solid'}
+
+def _is_level_rule(rule):
+    return (rule.type == 'expression' and bool(rule.formula)
+            and (_LEVEL_RULE_RE.match(rule.formula[0]) or _DEPTH_RULE_RE.match(rule.formula[0])) is not None)
+
+def level_rule_column(ws):
+    """Служебный столбец уровней, на который ссылаются правила цветов уровней листа, или None."""
+    for rules in ws.conditional_formatting._cf_rules.values():
+        for rule in rules:
+            m = rule.type == 'expression' and rule.formula and _LEVEL_RULE_RE.match(rule.formula[0])
+            if m:
+                return column_index_from_string(m.group(1))
+    return None
+
+def write_level_column(ws, col_idx, state, levels):
+    """
+    Пишет в скрытый столбец col_idx уровни строк state (только уровней из levels, у остальных ячейка пустая);
+    пустое levels — только очищает столбец. Возвращает число изменённых ячеек.
+    """
+    changed = 0
+    cells = ws._cells
+    for i, level in enumerate(state.levels):
+        row = state.min_row + i
+        value = level if level in levels else None
+        cell = cells.get((row, col_idx))
+        if value is None:
+            if cell is not None and cell.value is not None:
+                del cells[(row, col_idx)]
+                changed += 1
+        elif cell is None or cell.value != value:
+            ws.cell(row=row, column=col_idx, value=value)
+            changed += 1
+    dim = ws.column_dimensions[get_column_letter(col_idx)]
+    if dim.hidden != bool(levels):
+        dim.hidden = bool(levels)
+    return changed
+
+def apply_level_rules(ws, fills, level_col, min_row, last_row, cols):
+    """
+    Заменяет правила цветов уровней листа (прошлые узнаются по формуле) на правила для fills
+    в строках min_row..last_row столбцов cols; условие — уровень в служебном столбце level_col.
+    Пустой fills — только убирает прошлые правила.
+    Возвращает число записанных и удалённых правил; 0 — правила уже такие.
+    """
+    runs = []
+    for col in sorted(cols):
+        if runs and runs[-1][1] == col - 1:
+            runs[-1][1] = col
+        else:
+            runs.append([col, col])
+    sqref = sorted(f"{get_column_letter(a)}{min_row}:{get_column_letter(b)}{last_row}" for a, b in runs)
+    wanted = []
+    for level, fill in sorted(fills.items()):
+        # В дифференциальном стиле сплошная заливка берёт цвет фона, поэтому цвет ставится в оба поля
+        dxf_fill = PatternFill(fill_type='solid', fgColor=copy(fill.fgColor), bgColor=copy(fill.fgColor))
+        wanted.append((sqref, LEVEL_RULE_FORMULA.format(col=get_column_letter(level_col), row=min_row, level=level),
+                       dxf_fill))
+
+    cf_rules = ws.conditional_formatting._cf_rules
+    current = [(sorted(str(cf.sqref).split()), rule.formula[0], rule.dxf.fill if rule.dxf is not None else None)
+               for cf, rules in cf_rules.items() for rule in rules if _is_level_rule(rule)]
+    if current == wanted:
+        return 0
+    for cf in list(cf_rules):
+        kept = [rule for rule in cf_rules[cf] if not _is_level_rule(rule)]
+        if kept:
+            cf_rules[cf] = kept
+        else:
+            del cf_rules[cf]
+    for ranges, formula, dxf_fill in wanted:
+        ws.conditional_formatting.add(' '.join(ranges), Rule(type='expression', formula=[formula],
+                                                             dxf=DifferentialStyle(fill=dxf_fill)))
+    return len(current) + len(wanted)
+
+def load_source(input_file, sheet_names=None, value_free=False, sheet_cache=None, feed=None):
+    """
+    Загружает исходную книгу со значениями: из неё же читаются цвета, в неё пишется результат.
+    Разбираются только листы sheet_names (None — все); остальные переносятся в результат без разбора
+    (passthrough.load_selected). input_file — путь, открытый входной файл (open_input) или двоичный поток
+    с произвольным доступом (seek); файл и поток должны оставаться открытыми до сохранения результата.
+    value_free — и выбранные листы не разбираются: process_workbook обработает их прямо в XML
+    (только при value_free_mode(CONFIG)).
+    sheet_cache — кэш разобранных листов (open_sheet_cache); feed — фоновый разбор ячеек выбранных листов
+    (sheetfeed.SheetFeed): книга возвращается, как только разобрано всё, кроме них, а process_workbook
+    ждёт каждый лист, только когда до него доходит.
+    """
+    return load_selected(input_file, sheet_names, data_only=True, value_free=value_free, sheet_cache=sheet_cache,
+                         feed=feed)
+
+def open_input(CONFIG):
+    """
+    Входной файл обработки, отображённый в память (mapped.MappedFile): загрузка, перенос листов при записи
+    и ключи кэшей читают одно отображение. Если результат пишется поверх исходного файла, он не отображается —
+    отображённый файл нельзя заменить (Windows).
+    """
+    path, output = CONFIG['input_file'], CONFIG['output_file']
+    same = os.path.exists(output) and os.path.samefile(path, output)
+    return MappedFile(path, mapped=not same)
+
+def open_sheet_cache(CONFIG, log, source=None):
+    """Кэш разобранных листов входного файла, если он включён (CONFIG['parsed_cache']); иначе None."""
+    if not CONFIG.get('parsed_cache') or value_free_mode(CONFIG):
+        return None
+    try:
+        return SheetCache(ParsedCache(), source or CONFIG['input_file'])
+    except OSError as e:
+        log(f"⚠️ Кэш разобранных листов недоступен: {e}")
+        return None
+
+def report_sheet_cache(sheet_cache, log):
+    if sheet_cache is None:
+        return
+    if sheet_cache.hits:
+        log(f"🗃️ Из кэша разбора взято листов: {sheet_cache.hits}")
+    if sheet_cache.error is not None:
+        log(f"⚠️ Не удалось сохранить кэш разбора: {sheet_cache.error}")
+    elif sheet_cache.captured:
+        log(f"🗃️ В кэш разбора записано листов: {sheet_cache.captured}")
+
+def report_feed(feed, log):
+    if feed is None or len(feed.sheets) < 2:
+        return
+    where = f"в {feed.processes} процессах" if feed.processes else "в фоновом потоке"
+    log(f"🧵 Ячейки листов ({len(feed.sheets)}) разбираются {where}: каждый лист обрабатывается, как только готов")
+
+# Этапы, которым от листа нужны только непустота строк и id стилей цветового столбца
+VALUE_FREE_STAGES = {'grouping', 'hierarchy', 'large_file_mode'}
+
+def value_free_mode(CONFIG):
+    """Можно ли обработать листы без декодирования значений (sheetxml): включены только группировка и иерархия."""
+    enabled = {key for key, on in CONFIG['stages'].items() if on}
+    return (CONFIG.get('value_free_scan', True) and CONFIG['hierarchy_column'] is not None
+            and bool(enabled & {'grouping', 'hierarchy'}) and enabled <= VALUE_FREE_STAGES
+            and not CONFIG.get('export_format') and not CONFIG.get('checkpoints'))
+
+def loaded_message(wb):
+    stubs = passthrough_sheets(wb)
+    value_free = sum(1 for ws in stubs if getattr(ws, '_value_free', False))
+    message = f"Листы: {wb.sheetnames}"
+    if len(stubs) > value_free:
+        message += f"; без разбора перенесено: {len(stubs) - value_free}"
+    if value_free:
+        message += f"; обрабатываются без чтения значений: {value_free}"
+    return message
+
+def _copy_worksheet(ws, parent):
+    new_ws = copy(ws)
+    new_ws._parent = parent
+
+    new_cell = Cell.__new__
+    cells = {}
+    for key, cell in ws._cells.items():
+        if type(cell) is Cell:
+            c = new_cell(Cell)
+            c.row = cell.row
+            c.column = cell.column
+            c._value = cell._value
+            c.data_type = cell.data_type
+            c._hyperlink = cell._hyperlink
+            c._comment = cell._comment
+            c.parent = new_ws
+        else:
+            c = MergedCell(new_ws, row=cell.row, column=cell.column)
+        c._style = None if cell._style is None else StyleArray(cell._style)
+        cells[key] = c
+    new_ws._cells = cells
+
+    for attr, factory in (('row_dimensions', new_ws._add_row), ('column_dimensions', new_ws._add_column)):
+        holder = DimensionHolder(worksheet=new_ws, default_factory=factory)
+        for key, dim in getattr(ws, attr).items():
+            dim = copy(dim)
+            dim.parent = new_ws
+            holder[key] = dim
+        setattr(new_ws, attr, holder)
+
+    new_ws.sheet_properties = deepcopy(ws.sheet_properties)
+    new_ws.sheet_format = deepcopy(ws.sheet_format)
+    new_ws.conditional_formatting = deepcopy(ws.conditional_formatting)
+    return new_ws
+
+def fork_workbook(wb, sheet_names, own_styles=False):
+    """
+    Копия книги для отдельного конфига (copy-on-write): листы из sheet_names копируются,
+    остальные листы и таблицы стилей остаются общими с исходной книгой.
+    own_styles — таблицы стилей тоже копируются, и исходная книга остаётся нетронутой
+    (нужно, если она переживает обработку, как тёплая книга в warm.WarmCache).
     """
+    fork = copy(wb)
+    fork._sheets = [_copy_worksheet(ws, fork) if ws.title in sheet_names else ws for ws in wb._sheets]
+    if own_styles:
+        for attr in [attr for _, attr, _ in STYLE_TABLES] + ['_number_formats', '_cell_styles']:
+            setattr(fork, attr, IndexedList(getattr(wb, attr)))
+        # Именованные стили хранят номера записей таблиц своей книги (compact_styles их пересчитывает)
+        fork._named_styles = NamedStyleList([copy(style) for style in wb._named_styles])
+        for style in fork._named_styles:
+            style.bind(fork)
+    return fork
+
+# Поле StyleArray, таблица книги, сколько первых записей зарезервировано (заливки 0 и 1 обязательны для Excel)
+STYLE_TABLES = (
+    ('fontId', '_fonts', 1),
+    ('fillId', '_fills', 2),
+    ('borderId', '_borders', 1),
+    ('protectionId', '_protections', 1),
+    ('alignmentId', '_alignments', 1),
+)
+STYLE_TABLE_NAMES = {'fontId': 'шрифты', 'fillId': 'заливки', 'borderId': 'границы',
+                     'protectionId': 'защита', 'alignmentId': 'выравнивания', 'numFmtId': 'форматы', 'xf': 'стили ячеек'}
+
+def compact_styles(wb):
+    """
+    Убирает из таблиц стилей книги дубликаты и неиспользуемые записи и перенумеровывает
+    ссылки ячеек, строк и столбцов. Возвращает статистику {таблица: (было, стало)} по числу записей.
+    Для книги с общими разобранными листами (fork_workbook) ничего не делает и возвращает None;
+    общие перенесённые без разбора листы ячеек не держат и не мешают.
+    """
+    if any(ws.parent is not wb and not getattr(ws, '_passthrough', None) for ws in wb.worksheets):
+        return None
+
+    stats = {}
+    tables = {}
+    for field, attr, reserved in STYLE_TABLES:
+        old = getattr(wb, attr)
+        tables[field] = (old, IndexedList(old[:reserved]))
+        stats[field] = [len(old)]
+    old_formats, new_formats = wb._number_formats, IndexedList()
+    stats['numFmtId'] = [len(old_formats)]
+    stats['xf'] = [len(wb._cell_styles)]
+
+    remapped = {}
+
+    def remap(style):
+        key = style.tobytes()
+        result = remapped.get(key)
+        if result is None:
+            result = StyleArray(style)
+            for field, (old, new) in tables.items():
+                setattr(result, field, new.add(old[getattr(style, field)]))
+            if style.numFmtId >= BUILTIN_FORMATS_MAX_SIZE:
+                result.numFmtId = BUILTIN_FORMATS_MAX_SIZE + new_formats.add(old_formats[style.numFmtId - BUILTIN_FORMATS_MAX_SIZE])
+            remapped[key] = result
+        return result
+
+    # Листы, перенесённые без разбора, ссылаются на стили ячеек исходной книги по номерам:
+    # эти номера остаются на местах, даже если стили в них совпали
+    source = getattr(wb, '_passthrough', None)
+    if source is not None and passthrough_sheets(wb):
+        first = [remap(style) for style in wb._cell_styles[:source.pinned_styles]]
+    else:
+        first = [remap(wb._cell_styles[0]) if wb._cell_styles else StyleArray()]
+    cell_styles = IndexedList()
+    for style in first:
+        cell_styles._dict.setdefault(style, len(cell_styles))
+        list.append(cell_styles, style)
+    for ws in wb.worksheets:
+        for obj in [*ws._cells.values(), *ws.row_dimensions.values(), *ws.column_dimensions.values()]:
+            if obj._style is not None:
+                obj._style[:] = remap(obj._style)
+    for style in remapped.values():
+        cell_styles.add(style)
+
+    for field, attr, _ in STYLE_TABLES:
+        setattr(wb, attr, tables[field][1])
+    wb._number_formats = new_formats
+    wb._cell_styles = cell_styles
+    for style in wb._named_styles:
+        style.bind(wb)
+
+    for field, attr, _ in STYLE_TABLES:
+        stats[field].append(len(getattr(wb, attr)))
+    stats['numFmtId'].append(len(wb._number_formats))
+    stats['xf'].append(len(wb._cell_styles))
+    return stats
+
+PALETTE_UNKNOWN_POLICIES = ('discover', 'flag')
+
+def pin_template_palette(state, CONFIG):
+    """Закрепляет палитру шаблона из CONFIG['palette'] (список цветов в виде fill_color), если она задана."""
+    palette = CONFIG.get('palette')
+    if palette:
+        state.pin_palette(palette, CONFIG.get('palette_unknown', 'discover'))
+
+def report_palette(state, log):
+    if state.pinned is None:
+        return
+    log(f"🎨 Палитра шаблона: {len(state.pinned)} цветов")
+    if state.unknown:
+        colors = ', '.join(state.unknown)
+        if state.unknown_policy == 'flag':
+            log(f"⚠️ Цвета не из палитры шаблона: {colors} — им назначен последний уровень")
+        else:
+            log(f"⚠️ Цвета не из палитры шаблона: {colors} — уровни определены по файлу")
+
+def detect_palette(input_file, sheet_names, color_column, min_row):
+    """Палитра для закрепления: цвета цветового столбца листов sheet_names по порядку первого появления."""
+    wb = load_workbook(input_file, read_only=True)
+    try:
+        col_idx = column_index_from_string(color_column)
+        palette = []
+        for name in (sheet_names or wb.sheetnames):
+            for (cell,) in wb[name].iter_rows(min_row=min_row, min_col=col_idx, max_col=col_idx):
+                color = fill_color(cell.fill)
+                if color not in WHITE_LIKE and color not in palette:
+                    palette.append(color)
+        return palette
+    finally:
+        wb.close()
+
+def analyse_rows(state, ws, color_col_idx, need_fills, need_levels, need_outline):
+    """
+    Анализ строк листа: заливки цветового столбца → уровни → группировка.
+    Уже посчитанное (снимок тёплого анализа, RowState.snapshot) не пересчитывается.
+    """
+    if need_fills:
+        state.read_fills(ws, color_col_idx)
+    if need_levels and not state.levels_ready:
+        state.assign_levels()
+    if need_outline and state.rows_outlined < state.count:
+        state.compute_outline()
+
+def process_sheet_xml(ws, CONFIG, log):
+    """
+    Группировка и иерархия для листа, загруженного без разбора (load_source(value_free=True)):
+    один проход по XML собирает непустоту строк и id стилей цветового столбца, дальше — те же
+    RowState.assign_levels/compute_outline/labels, и правки вносятся в XML точечно.
+    Результат кладётся в ws._passthrough_data и пишется при сохранении вместо исходной части.
+    Возвращает (изменено ячеек, изменено строк) или None, если лист пуст.
+    """
+    source = ws.parent._passthrough
+    sheet = SheetXml(source.read(ws._passthrough))
+    stages = CONFIG['stages']
+    min_row = CONFIG['min_row']
+    color_col_idx = column_index_from_string(CONFIG['color_column'])
+    h_col_idx = column_index_from_string(CONFIG['hierarchy_column'])
+
+    if CONFIG.get('scan_columns_by_row') is not None:
+        log(f"🔍 Режим 'Большой файл': сканируем столбцы до '{CONFIG['color_column']}' включительно...")
+        last_row, data_cols, styles = scan_rows(sheet, source.strings, min_row, color_col_idx, max_col=color_col_idx)
+    else:
+        log("🔍 Сканирование всех столбцов по всем строкам...")
+        last_row, data_cols, styles = scan_rows(sheet, source.strings, min_row, color_col_idx)
+    if last_row is None:
+        log("⚠️  Лист пуст — пропускаем.")
+        return None
+
+    used_cols = sorted(data_cols | {h_col_idx})
+    log(f"📏 Диапазон: строки {min_row}–{last_row}, столбцы: {get_column_letter(used_cols[0])}–{get_column_letter(used_cols[-1])}")
+    log("🔍 Определение уровней по цвету...")
+    state = RowState(min_row, last_row)
+    pin_template_palette(state, CONFIG)
+    state.read_style_fills(styles, ws.parent._cell_styles, ws.parent._fills)
+    state.assign_levels()
+    report_palette(state, log)
+    if stages['grouping']:
+        state.compute_outline()
+
+    patch = SheetPatch(sheet, source.strings, min_row, last_row, h_col_idx,
+                       labels=list(state.labels()) if stages['hierarchy'] else None,
+                       outline=state.outline if stages['grouping'] else None, collapsed=state.collapsed)
+    ws._passthrough_data = patch.apply()
+    if stages['hierarchy']:
+        log("✅ Иерархическая нумерация применена")
+    if stages['grouping']:
+        log("✅ Группировка применена")
+    return patch.changed_cells, patch.changed_rows
+
+def process_workbook(wb, CONFIG, log, stop_requested, checkpoint=None, exporter=None, analysis=None):
+    """
+    Применяет включённые этапы к листам уже загруженной книги и сжимает стили.
+    Возвращает False, если обработку остановили.
+    checkpoint — Checkpoint: диапазон данных и каждый обработанный лист сохраняются на диск,
+    и повторный запуск берёт их оттуда — готовые листы не обрабатываются заново.
+    exporter(имя листа, буквы столбцов) — открывает выгрузку иерархии (export.open_export);
+    строки пишутся в неё по мере нумерации.
+    analysis — анализ строк этой книги из памяти (warm.WarmAnalysis); заполняется, если его ещё нет.
+    """
+    # Правила проверяются один раз за запуск, а не в каждой ячейке
+    alignment_rules = prepare_alignment_rules(CONFIG['alignment_rules'] if CONFIG['stages']['alignment'] else [], log)
+    column_formats = prepare_column_formats(CONFIG['column_formats'] if CONFIG['stages']['number_formats'] else {}, log)
+    subtotal_cols = prepare_subtotal_columns(CONFIG.get('subtotal_columns') if CONFIG['stages'].get('subtotals') else [], log)
+    column_mode = CONFIG.get('column_styles', False)
+    if column_mode:
+        log("🧱 Режим «стиль на столбец»: выравнивание и форматы задаются столбцам целиком")
+    total_cells = total_rows = 0
+    store = checkpoint or analysis
+    if checkpoint is not None and checkpoint.done:
+        if checkpoint.restore_styles(wb):
+            log(f"♻️ Готовых листов в контрольной точке: {len(checkpoint.done)} — они не обрабатываются заново")
+        else:
+            log("⚠️ Готовые листы контрольной точки не подходят к этой книге — листы обрабатываются заново")
+
+    for sheet_name in (CONFIG['sheet_names'] or wb.sheetnames):
+        if stop_requested():
+            return False
+
+        log(f"\n{'='*60}")
+        log(f"📋 ОБРАБОТКА ЛИСТА: '{sheet_name}'")
+        log(f"{'='*60}")
+        start1 = time.perf_counter()
+
+        if checkpoint is not None and sheet_name in checkpoint.done:
+            log(f"♻️ Лист уже обработан в прошлом запуске — взят из {checkpoint.origin}")
+            continue
+
+        ws = wb[sheet_name]
+        wait_sheet(ws)
+
+        if getattr(ws, '_value_free', False):
+            log("⚡ Лист обрабатывается без чтения значений: нужны только группировка и иерархия")
+            changed = process_sheet_xml(ws, CONFIG, log)
+            if changed is not None:
+                total_cells += changed[0]
+                total_rows += changed[1]
+                log(f"✏️ Изменено: ячеек {changed[0]}, строк {changed[1]}")
+                log(f"✅ Лист '{sheet_name}' полностью обработан")
+            continue
+
+        last_row = None
+        data_cols = set()
+
+        # --- ОПРЕДЕЛЕНИЕ ДИАПАЗОНА ДАННЫХ ---
+        scan_row = CONFIG.get('scan_columns_by_row')
+        sheet_state = store.sheet(sheet_name) if store else None
+
+        if sheet_state is not None:
+            last_row, data_cols = sheet_state['last_row'], set(sheet_state['data_cols'])
+            log(f"♻️ Диапазон данных взят из {store.origin}")
+        elif scan_row is not None:
+            # ✅ НОВАЯ ЛОГИКА: Берём все столбцы от A до color_column включительно
+            log(f"🔍 Режим 'Большой файл': сканируем столбцы до '{CONFIG['color_column']}' включительно...")
+            color_col_idx = column_index_from_string(CONFIG['color_column'])
+            for col_idx in range(1, color_col_idx + 1):  # от A до color_column
+                data_cols.add(col_idx)
+            # Находим последнюю строку только в этих столбцах
+            for row in range(CONFIG['min_row'], ws.max_row + 1):
+                for col in data_cols:
+                    cell = ws.cell(row=row, column=col)
+                    if cell.value not in [None, ""]:
+                        last_row = row if last_row is None else max(last_row, row)
+        else:
+            # 📊 Старая логика: сканируем все столбцы по всем строкам
+            log("🔍 Сканирование всех столбцов по всем строкам...")
+            max_col = ws.max_column  # свойство обходит все ячейки листа — считаем его один раз
+            for row in range(CONFIG['min_row'], ws.max_row + 1):
+                for col in range(1, max_col + 1):
+                    cell = ws.cell(row=row, column=col)
+                    if cell.value not in [None, ""]:
+                        last_row = row if last_row is None else max(last_row, row)
+                        data_cols.add(col)
+
+        # Служебный столбец уровней прошлого запуска (цвета уровней условным форматированием) — не данные
+        level_col = level_rule_column(ws)
+        data_cols.discard(level_col)
+
+        if store and sheet_state is None:
+            sheet_state = {'last_row': last_row, 'data_cols': sorted(data_cols)}
+            store.update(sheet_name, sheet_state)
+
+        if last_row is None:
+            log("⚠️  Лист пуст — пропускаем.")
+            continue
+
+        used_cols = set(data_cols)
+        if CONFIG['hierarchy_column'] is not None:
+            h_col_idx = column_index_from_string(CONFIG['hierarchy_column'])
+            used_cols.add(h_col_idx)
+        used_cols = sorted(used_cols)
+        used_cols_letters = {get_column_letter(col) for col in used_cols}
+
+        log(f"📏 Диапазон: строки {CONFIG['min_row']}–{last_row}, столбцы: {get_column_letter(used_cols[0])}–{get_column_letter(used_cols[-1])}")
+
+        stages = CONFIG['stages']
+        has_hierarchy_col = CONFIG['hierarchy_column'] is not None
+        state = RowState(CONFIG['min_row'], last_row)
+        pin_template_palette(state, CONFIG)
+        export = exporter is not None and has_hierarchy_col
+        subtotals = bool(subtotal_cols) and has_hierarchy_col
+        # Цвета уровней условным форматированием: правило на уровень по скрытому служебному столбцу уровней
+        level_rules = CONFIG.get('level_color_rules', False) and stages['hierarchy_colors'] and has_hierarchy_col
+        need_levels = (stages['hierarchy'] or stages['grouping'] or export or subtotals or level_rules) and has_hierarchy_col
+        if need_levels:
+            log("🔍 Определение уровней по цвету...")
+        needs = dict(
+            need_fills=has_hierarchy_col and (stages['hierarchy'] or stages['grouping'] or stages['hierarchy_colors'] or export or subtotals) or stages['formatting'],
+            need_levels=need_levels,
+            need_outline=(stages['grouping'] or subtotals) and has_hierarchy_col,
+        )
+        saved = sheet_state.get('rows') if analysis is not None else None
+        if saved is not None and saved.count == state.count:
+            state = saved.snapshot()
+            state.fills = ws.parent._fills
+            log(f"♻️ Анализ строк восстановлен из {analysis.origin}: прочитано {state.rows_read}, сгруппировано {state.rows_outlined} из {state.count}")
+        else:
+            saved = None
+        progress = (state.rows_read, state.levels_ready, state.rows_outlined)
+        analyse_rows(state, ws, column_index_from_string(CONFIG['color_column']), **needs)
+        if analysis is not None and (saved is None or progress != (state.rows_read, state.levels_ready, state.rows_outlined)):
+            analysis.update(sheet_name, dict(sheet_state, rows=state.snapshot()))
+        if need_levels:
+            report_palette(state, log)
+
+        # Сколько ячеек и строк действительно изменилось: уже приведённые к цели не перезаписываются
+        changed_cells = changed_rows = 0
+        wb_styles = ws.parent
+
+        if stages['hierarchy'] and has_hierarchy_col:
+            h_col_idx = column_index_from_string(CONFIG['hierarchy_column'])
+            cells = ws._cells
+            for i, num in enumerate(state.labels()):
+                row = state.min_row + i
+                cell = cells.get((row, h_col_idx)) or ws.cell(row=row, column=h_col_idx)
+                if cell.value != num or cell.data_type != 's':
+                    if type(cell) is Cell:
+                        # Номер — только цифры и точки: проверки значения в сеттере ему не нужны
+                        cell._value = num
+                    else:
+                        cell.value = num
+                    cell.data_type = 's'
+                    changed_cells += 1
+            log("✅ Иерархическая нумерация применена")
+
+        # id заливки исходного файла -> id той же заливки в книге результата
+        fill_targets = {}
+
+        def fill_target(i, fill):
+            key = state.fill_ids[i]
+            if key not in fill_targets:
+                fill_targets[key] = wb_styles._fills.add(fill)
+            return fill_targets[key]
+
+        # Уровень -> заливка правила; строки этих уровней по ячейкам не красятся
+        rule_fills = {}
+        if stages['hierarchy_colors'] and has_hierarchy_col:
+            h_col_idx = column_index_from_string(CONFIG['hierarchy_column'])
+            if level_rules:
+                rule_fills = level_rule_fills(state)
+            if rule_fills and level_col is None:
+                level_col = max(ws.max_column, used_cols[-1]) + 1
+            # Прошлые правила цветов уровней заменяются и тогда, когда режим выключен: заливка снова по ячейкам
+            rule_cols = {h_col_idx} | (set(used_cols) if stages['formatting'] else set())
+            changed_rules = apply_level_rules(ws, rule_fills, level_col, state.min_row,
+                                              state.min_row + state.count - 1, rule_cols)
+            changed_cells += changed_rules  # правило условного форматирования считается как изменённая ячейка
+            if level_col is not None:
+                changed_cells += write_level_column(ws, level_col, state, rule_fills)
+            if level_rules and rule_fills:
+                log(f"🎨 Цвета уровней — условным форматированием: правил {len(rule_fills)}, уровни в скрытом столбце "
+                    f"{get_column_letter(level_col)}" + (", изменены" if changed_rules else ", уже на месте"))
+            elif level_rules:
+                log("ℹ️ Ни у одного уровня нет единой сплошной заливки — цвета уровней ставятся по ячейкам")
+            for i in range(state.count):
+                fill = None if state.levels[i] in rule_fills else state.colored_fill(i)
+                if fill is not None:
+                    style = _cell_style(ws.cell(row=state.min_row + i, column=h_col_idx))
+                    target = fill_target(i, fill)
+                    if style.fillId != target:
+                        style.fillId = target
+                        changed_cells += 1
+            log("✅ В нумерацию добавлен цвет из оригинального столбца")
+
+        if stages['grouping'] and has_hierarchy_col:
+            for i in range(state.count):
+                dim = ws.row_dimensions[state.min_row + i]
+                level, collapsed = state.outline[i], bool(state.collapsed[i])
+                if dim.outlineLevel != level or dim.hidden or bool(dim.collapsed) != collapsed:
+                    dim.outlineLevel = level
+                    dim.hidden = False
+                    dim.collapsed = collapsed
+                    changed_rows += 1
+
+            if hasattr(ws, 'sheet_properties') and hasattr(ws.sheet_properties, 'outlinePr'):
+                ws.sheet_properties.outlinePr.summaryBelow = True
+                ws.sheet_properties.outlinePr.summaryRight = True
+                ws.sheet_properties.outlinePr.showOutlineSymbols = True
+
+            log("✅ Группировка применена")
+
+        # Подытоги для выгрузки: {(столбец, i): сумма} — в режиме формул в ячейке заголовка текст формулы
+        export_totals = {}
+        if subtotals:
+            headers = [i for i in range(state.count) if state.collapsed[i]]
+            cells = ws._cells
+
+            def column_sums(col_idx):
+                values = (numeric_value(getattr(cells.get((state.min_row + i, col_idx)), 'value', None))
+                          for i in range(state.count))
+                return ((col_idx, i, total) for i, total in state.subtotals(values).items())
+
+            if CONFIG.get('subtotal_formulas', False):
+                if export:
+                    export_totals = {(col_idx, i): total for col_idx in subtotal_cols
+                                     for _, i, total in column_sums(col_idx)}
+                # SUBTOTAL(9, ...) пропускает вложенные SUBTOTAL, поэтому диапазон — вся группа целиком
+                targets = ((col_idx, i, f"=SUBTOTAL(9,{get_column_letter(col_idx)}{state.min_row + i + 1}:"
+                                         f"{get_column_letter(col_idx)}{state.min_row + state.group_end[i]})")
+                           for col_idx in subtotal_cols for i in headers)
+            else:
+                targets = (target for col_idx in subtotal_cols for target in column_sums(col_idx))
+            for col_idx, i, value in targets:
+                cell = ws.cell(row=state.min_row + i, column=col_idx)
+                if cell.value != value:
+                    cell.value = value
+                    changed_cells += 1
+            kind = "формулы SUBTOTAL" if CONFIG.get('subtotal_formulas', False) else "значения"
+            log(f"∑ Подытоги ({kind}): {len(headers)} групп, столбцы {', '.join(get_column_letter(c) for c in subtotal_cols)}")
+
+        # Выгрузка — после подытогов: строки-заголовки групп уходят с посчитанными суммами
+        if export:
+            rows_out = exporter(sheet_name, [get_column_letter(col) for col in used_cols])
+            cells = ws._cells
+            parents = []  # (уровень, номер) открытых родителей
+            for i, num in enumerate(state.labels()):
+                row = state.min_row + i
+                level = state.levels[i]
+                while parents and parents[-1][0] >= level:
+                    parents.pop()
+                values = [export_totals.get((col, i), getattr(cells.get((row, col)), 'value', None)) for col in used_cols]
+                rows_out.write(row, level, num, parents[-1][1] if parents else '', values)
+                parents.append((level, num))
+            rows_out.close()
+            log(f"📤 Иерархия выгружена: {state.count} строк")
+
+        # Форматирование идёт до переноса и выравнивания: созданные им ячейки получают собственный стиль,
+        # и в режиме column_styles выравнивание столбца должно лечь и на них
+        if CONFIG['stages']['formatting']:
+            log("🎨 Применение форматирования...")
+
+            font_name = CONFIG['font'].get('name', 'Times New Roman')
+            font_size = CONFIG['font'].get('size', 14)
+            font_bold = CONFIG['font'].get('bold', False)
+            font_italic = CONFIG['font'].get('italic', False)
+            font_underline = 'single' if CONFIG['font'].get('underline', False) else None
+
+            border_style = CONFIG.get('border_style', 'thin')
+            border = Border(
+                left=Side(style=border_style),
+                right=Side(style=border_style),
+                top=Side(style=border_style),
+                bottom=Side(style=border_style)
+            )
+            bold_levels = CONFIG.get('bold_levels', [1, 2])
+            # id шрифта (обычный/жирный) и границы регистрируются при первой ячейке, как при присваивании cell.font
+            font_ids = {}
+            border_id = None
+
+            for i in range(state.count):
+                row = state.min_row + i
+                level = state.levels[i]
+                color_fill = None if level in rule_fills else state.colored_fill(i)
+                is_bold_level = level in bold_levels
+
+                for col in used_cols:
+                    cell = ws.cell(row=row, column=col)
+                    style = _cell_style(cell)
+                    before = tuple(style)
+
+                    font_id = font_ids.get(is_bold_level)
+                    if font_id is None:
+                        font_id = font_ids[is_bold_level] = wb_styles._fonts.add(Font(
+                            name=font_name,
+                            size=font_size,
+                            bold=font_bold or is_bold_level,
+                            italic=font_italic,
+                            underline=font_underline
+                        ))
+                    style.fontId = font_id
+
+                    if border_id is None:
+                        border_id = wb_styles._borders.add(border)
+                    style.borderId = border_id
+
+                    if hasattr(CONFIG, 'fill_color') and CONFIG['fill_color']:
+                        color = CONFIG['fill_color'].replace("#", "") if CONFIG['fill_color'].startswith("#") else CONFIG['fill_color']
+                        cell.fill = PatternFill(start_color=color, end_color=color, fill_type="solid")
+
+                    if hasattr(CONFIG, 'text_color') and CONFIG['text_color']:
+                        text_color = CONFIG['text_color'].replace("#", "") if CONFIG['text_color'].startswith("#") else CONFIG['text_color']
+                        cell.font = Font(
+                            name=font_name,
+                            size=font_size,
+                            bold=font_bold or is_bold_level,
+                            italic=font_italic,
+                            underline=font_underline,
+                            color=text_color
+                        )
+
+                    if color_fill is not None and CONFIG['stages']['hierarchy_colors']:
+                        style.fillId = fill_target(i, color_fill)
+
+                    if tuple(style) != before:
+                        changed_cells += 1
+
+            log("✅ Форматирование применено")
+
+        if CONFIG['stages']['wrap_text'] and CONFIG['wrap_text_columns']:
+            log("🔁 Применение переноса текста...")
+            wrap_cols = [
+                col for col in CONFIG['wrap_text_columns']
+                if col in used_cols_letters
+            ]
+
+            def wrap_alignment(a):
+                return Alignment(horizontal=a.horizontal or 'left', vertical=a.vertical or 'bottom', wrap_text=True)
+
+            if column_mode:
+                for row in range(CONFIG['min_row'], last_row + 1):
+                    dim = ws.row_dimensions.get(row)
+                    if dim is not None and dim.height is not None:
+                        dim.height = None
+                        changed_rows += 1
+                for col_letter in wrap_cols:
+                    changed_cells += apply_column_alignment(
+                        ws, column_index_from_string(col_letter), CONFIG['min_row'], last_row, wrap_alignment
+                    )
+            else:
+                wrap_idx = [column_index_from_string(col_letter) for col_letter in wrap_cols]
+
+                def wrap_cells():
+                    nonlocal changed_rows
+                    for row in range(CONFIG['min_row'], last_row + 1):
+                        dim = ws.row_dimensions[row]
+                        if dim.height is not None:
+                            dim.height = None
+                            changed_rows += 1
+                        for col_idx in wrap_idx:
+                            yield ws.cell(row=row, column=col_idx)
+
+                changed_cells += _remap_style_field(
+                    wrap_cells(), 'alignmentId',
+                    lambda old: wb_styles._alignments.add(wrap_alignment(wb_styles._alignments[old]))
+                )
+            log(f"✅ Перенос текста: {', '.join(wrap_cols)}")
+
+        if CONFIG['stages']['alignment'] and alignment_rules:
+            log("📏 Применение выравнивания...")
+            applied_cols = set()
+            for cols, vertical, horizontal in alignment_rules:
+
+                def rule_alignment(a, vertical=vertical, horizontal=horizontal):
+                    return Alignment(vertical=vertical, horizontal=horizontal, wrap_text=a.wrap_text)
+
+                for col_letter in cols:
+                    if col_letter in used_cols_letters:
+                        col_idx = column_index_from_string(col_letter)
+                        if column_mode:
+                            changed_cells += apply_column_alignment(ws, col_idx, CONFIG['min_row'], last_row, rule_alignment)
+                        else:
+                            changed_cells += _remap_style_field(
+                                (ws.cell(row=row, column=col_idx) for row in range(CONFIG['min_row'], last_row + 1)),
+                                'alignmentId',
+                                lambda old, make=rule_alignment: wb_styles._alignments.add(make(wb_styles._alignments[old]))
+                            )
+                        applied_cols.add(col_letter)
+            log(f"✅ Выравнивание: {', '.join(sorted(applied_cols))}")
+
+        if CONFIG['stages']['number_formats'] and column_formats:
+            log("🔢 Применение числовых форматов...")
+            for cols, num_format in column_formats:
+                for col_letter in cols:
+                    if col_letter in used_cols_letters:
+                        col_idx = column_index_from_string(col_letter)
+                        if column_mode:
+                            changed_cells += apply_column_number_format(ws, col_idx, CONFIG['min_row'], last_row, num_format)
+                        else:
+                            fmt_id = number_format_id(wb_styles, num_format)
+                            value_cells = (cell for cell in (ws.cell(row=row, column=col_idx)
+                                                             for row in range(CONFIG['min_row'], last_row + 1))
+                                           if cell.value is not None)
+                            changed_cells += _remap_style_field(value_cells, 'numFmtId', lambda old: fmt_id)
+            log("✅ Числовые форматы применены")
+
+        total_cells += changed_cells
+        total_rows += changed_rows
+        log(f"✏️ Изменено: ячеек {changed_cells}, строк {changed_rows}")
+
+        log(f"✅ Лист '{sheet_name}' полностью обработан")
+        if checkpoint is not None:
+            try:
+                if checkpoint.finish_sheet(ws):
+                    log("💾 Лист записан в контрольную точку")
+                else:
+                    log("ℹ️ Лист с рисунками, примечаниями или гиперссылками в контрольную точку не записывается")
+            except Exception as e:
+                # Контрольная точка — только страховка: из-за неё обработка не прерывается
+                log(f"⚠️ Не удалось записать лист в контрольную точку: {e}")
+
+    if stop_requested():
+        return False
+    finish_sheets(wb)
+
+    if total_cells or total_rows:
+        log(f"✏️ Всего изменено: ячеек {total_cells}, строк {total_rows}")
+    else:
+        log("✏️ Изменений нет: книга уже в нужном виде")
+
+    if CONFIG.get('compact_styles'):
+        stats = None if checkpoint is not None else compact_styles(wb)
+        if checkpoint is not None:
+            log("ℹ️ Сжатие стилей пропущено: готовые листы контрольной точки ссылаются на стили по номерам")
+        elif stats is None:
+            log("ℹ️ Сжатие стилей пропущено: листы книги общие с другой вкладкой")
+        else:
+            details = ', '.join(f"{STYLE_TABLE_NAMES[key]} {a}→{b}" for key, (a, b) in stats.items() if a != b)
+            log(f"🧹 Таблица стилей сжата: {details}" if details else "🧹 Таблица стилей уже без дубликатов")
+
+    return True
+
+def make_callbacks(log_callback, stop_callback):
     def log(msg):
         if log_callback:
             log_callback(msg)
         else:
             print(msg)
 
-    try:
-        start = time.perf_counter()
+    def stop_requested():
+        if stop_callback and stop_callback():
+            log("🛑 Обработка остановлена пользователем.")
+            return True
+        return False
+
+    return log, stop_requested
+
+class ExcelRun:
+    """
+    Одна обработка файла по шагам: read — кэш результатов и загрузка книги, process — этапы обработки,
+    write — сохранение и проверка результата. process_excel выполняет шаги подряд; пакет файлов
+    (pipeline.run_pipeline) выполняет их конвейером: пока один файл обрабатывается, следующий читается,
+    а предыдущий записывается. Ошибка или остановка на любом шаге запоминается в result,
+    и следующие шаги ничего не делают.
+    """
+
+    def __init__(self, CONFIG, log_callback=None, stop_callback=None, workbook=None, analysis=None):
+        self.CONFIG = CONFIG
+        self.log, self.stop_requested = make_callbacks(log_callback, stop_callback)
+        self.workbook = workbook
+        self.analysis = analysis
+        self.result = None  # (успех, сообщение), когда обработка закончена
+        self.stopped = False  # обработку остановил пользователем (stop_callback)
+        self.prefetch = False  # в конвейере файл подтягивается с диска целиком ещё на шаге чтения
+        self.source = self.wb = self.feed = None
+        self.cache = self.cache_key = self.checkpoint = None
+        self.start = time.perf_counter()
+
+    def step(self, action):
+        if self.result is None:
+            try:
+                action()
+            except Exception as e:
+                error_msg = f"❌ Ошибка: {str(e)}"
+                self.log(error_msg)
+                self.finish(False, error_msg)
+        return self.result is None
+
+    def finish(self, success, message):
+        self.result = (success, message)
+        self.wb = self.workbook = None
+        if self.feed is not None:
+            self.feed.close()
+            self.feed = None
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+    def read(self):
+        return self.step(self._read)
+
+    def process(self):
+        return self.step(self._process)
+
+    def write(self):
+        """Возвращает (успех, сообщение)."""
+        self.step(self._write)
+        return self.result
+
+    def _read(self):
+        CONFIG, log = self.CONFIG, self.log
+        self.start = time.perf_counter()
 
         if CONFIG['output_file'] is None:
             p = Path(CONFIG['input_file'])
@@ -60,285 +1284,156 @@ def process_excel(CONFIG, log_callback=None):
             except PermissionError:
                 raise PermissionError(f"Файл открыт в Excel: {CONFIG['output_file']}. Закройте его.")
 
-        wb = load_workbook(CONFIG['input_file'], data_only=True)
-        temp_wb = load_workbook(CONFIG['input_file'])
-        log(f"✅ Книга загружена. Листы: {wb.sheetnames}")
-
-        elapsed = time.perf_counter() - start
-        log(f"⏱️  Время загрузки книги: {elapsed:.3f} сек")
-
-        for sheet_name in (CONFIG['sheet_names'] or wb.sheetnames):
-            log(f"\n{'='*60}")
-            log(f"📋 ОБРАБОТКА ЛИСТА: '{sheet_name}'")
-            log(f"{'='*60}")
-            start1 = time.perf_counter()
-
-            ws = wb[sheet_name]
-            temp_ws = temp_wb[sheet_name]
-
-            last_row = None
-            data_cols = set()
-
-            # --- ОПРЕДЕЛЕНИЕ ДИАПАЗОНА ДАННЫХ ---
-            scan_row = CONFIG.get('scan_columns_by_row')
-
-            if scan_row is not None:
-                # ✅ НОВАЯ ЛОГИКА: Берём все столбцы от A до color_column включительно
-                log(f"🔍 Режим 'Большой файл': сканируем столбцы до '{CONFIG['color_column']}' включительно...")
-                color_col_idx = column_index_from_string(CONFIG['color_column'])
-                for col_idx in range(1, color_col_idx + 1):  # от A до color_column
-                    data_cols.add(col_idx)
-                # Находим последнюю строку только в этих столбцах
-                for row in range(CONFIG['min_row'], ws.max_row + 1):
-                    for col in data_cols:
-                        cell = ws.cell(row=row, column=col)
-                        if cell.value not in [None, ""]:
-                            last_row = row if last_row is None else max(last_row, row)
-            else:
-                # 📊 Старая логика: сканируем все столбцы по всем строкам
-                log("🔍 Сканирование всех столбцов по всем строкам...")
-                for row in range(CONFIG['min_row'], ws.max_row + 1):
-                    for col in range(1, ws.max_column + 1):
-                        cell = ws.cell(row=row, column=col)
-                        if cell.value not in [None, ""]:
-                            last_row = row if last_row is None else max(last_row, row)
-                            data_cols.add(col)
-
-            if last_row is None:
-                log("⚠️  Лист пуст — пропускаем.")
-                continue
-
-            used_cols = set(data_cols)
-            if CONFIG['hierarchy_column'] is not None:
-                h_col_idx = column_index_from_string(CONFIG['hierarchy_column'])
-                used_cols.add(h_col_idx)
-            used_cols = sorted(used_cols)
-            used_cols_letters = {get_column_letter(col) for col in used_cols}
-
-            log(f"📏 Диапазон: строки {CONFIG['min_row']}–{last_row}, столбцы: {get_column_letter(used_cols[0])}–{get_column_letter(used_cols[-1])}")
-
-            levels = {}
-            if (CONFIG['stages']['hierarchy'] or CONFIG['stages']['grouping']) and CONFIG['hierarchy_column'] is not None:
-                log("🔍 Определение уровней по цвету...")
-
-                seen_colors = []
-                white_like = [None, 'FFFFFFFF', '00000000']
-
-                for row in range(CONFIG['min_row'], last_row + 1):
-                    cell = temp_ws.cell(row=row, column=column_index_from_string(CONFIG['color_column']))
-                    color = get_cell_color(cell)
-                    if color not in white_like and color not in seen_colors:
-                        seen_colors.append(color)
-
-                color_to_level = {color: i + 1 for i, color in enumerate(seen_colors or ['DUMMY'])}
-                last_level = len(seen_colors) + 1 if seen_colors else 2
-                for white in white_like:
-                    color_to_level[white] = last_level
+        self.source = open_input(CONFIG)
+        if self.prefetch:
+            self.source.prefetch()
+        # Кэш хранит только .xlsx — при выгрузке иерархии файл обрабатывается заново
+        if CONFIG.get('use_result_cache') and not CONFIG.get('export_format'):
+            self.cache = ResultCache()
+            self.cache_key = result_key(CONFIG, self.source)
+            try:
+                cached = self.cache.fetch(self.cache_key, CONFIG['output_file'])
+            except OSError as e:
+                log(f"⚠️ Не удалось взять результат из кэша ({e}) — файл обрабатывается заново")
+                cached = False
+            if cached:
+                log("♻️ Такой файл с такими же настройками уже обрабатывался — результат взят из кэша")
+                log(f"📁 {CONFIG['output_file']}")
+                self.finish(True, "Обработка завершена успешно (результат из кэша).")
+                return
 
-                for row in range(CONFIG['min_row'], last_row + 1):
-                    cell = temp_ws.cell(row=row, column=column_index_from_string(CONFIG['color_column']))
-                    color = get_cell_color(cell)
-                    levels[row] = color_to_level.get(color, last_level)
+        if self.workbook is not None:
+            self.wb = self.workbook
+            log(f"✅ Используется уже загруженная книга. {loaded_message(self.wb)}")
+        else:
+            sheet_cache = open_sheet_cache(CONFIG, log, self.source)
+            value_free = value_free_mode(CONFIG)
+            if CONFIG.get('parallel_load', True) and sheet_cache is None and not value_free:
+                # Процессы (fork) — только вместе с явно включённой параллельной записью, иначе фоновый поток
+                self.feed = SheetFeed(self.source, processes=CONFIG.get('parallel_save', False))
+            self.wb = load_source(self.source, CONFIG['sheet_names'], value_free, sheet_cache, self.feed)
+            log(f"✅ Книга загружена. {loaded_message(self.wb)}")
+            report_sheet_cache(sheet_cache, log)
+            report_feed(self.feed, log)
 
-            if CONFIG['stages']['hierarchy'] and CONFIG['hierarchy_column'] is not None:
-                counter = [0] * 10
-                h_col_idx = column_index_from_string(CONFIG['hierarchy_column'])
-                for row in range(CONFIG['min_row'], last_row + 1):
-                    level = levels[row]
-                    for i in range(level + 1, 10):
-                        counter[i] = 0
-                    counter[level] += 1
-                    num = '.'.join(str(counter[i]) for i in range(1, level + 1) if counter[i] > 0)
-                    cell = ws.cell(row=row, column=h_col_idx)
-                    cell.value = num
-                    cell.data_type = 's'
-                log("✅ Иерархическая нумерация применена")
+        elapsed = time.perf_counter() - self.start
+        log(f"⏱️  Время загрузки книги: {elapsed:.3f} сек")
 
-            if CONFIG['stages']['hierarchy_colors'] and CONFIG['hierarchy_column'] is not None:
-                for row in range(CONFIG['min_row'], last_row + 1):
-                    temp_color_cell = temp_ws.cell(row=row, column=column_index_from_string(CONFIG['color_column']))
-                    has_color = get_cell_color(temp_color_cell) not in [None, 'FFFFFFFF', '00000000']
-                    level = levels.get(row, 9)
-                    cell = ws.cell(row=row, column=column_index_from_string(CONFIG['hierarchy_column']))
-                    if has_color and temp_color_cell.fill:
-                        cell.fill = copy(temp_color_cell.fill)
-                log("✅ В нумерацию добавлен цвет из оригинального столбца")
-
-            if CONFIG['stages']['grouping'] and CONFIG['hierarchy_column'] is not None:
-                for row in range(CONFIG['min_row'], last_row + 1):
-                    ws.row_dimensions[row].outlineLevel = 0
-                    ws.row_dimensions[row].hidden = False
-                    ws.row_dimensions[row].collapsed = False
-
-                for current_level in range(1, 8):
-                    i = 0
-                    while i < last_row - CONFIG['min_row'] + 1:
-                        row = CONFIG['min_row'] + i
-                        level = levels.get(row, 9)
-                        if level == current_level:
-                            end_row = last_row
-                            for j in range(i + 1, last_row - CONFIG['min_row'] + 1):
-                                next_row = CONFIG['min_row'] + j
-                                next_level = levels.get(next_row, 9)
-                                if next_level <= current_level:
-                                    end_row = next_row - 1
-                                    break
-                            if row < end_row:
-                                ws.row_dimensions[row].outlineLevel = current_level - 1
-                                ws.row_dimensions[row].collapsed = True
-                                for r in range(row + 1, end_row + 1):
-                                    nested_level = levels.get(r, 9)
-                                    if nested_level > current_level:
-                                        ws.row_dimensions[r].outlineLevel = current_level
-                        i += 1
-
-                if hasattr(ws, 'sheet_properties') and hasattr(ws.sheet_properties, 'outlinePr'):
-                    ws.sheet_properties.outlinePr.summaryBelow = True
-                    ws.sheet_properties.outlinePr.summaryRight = True
-                    ws.sheet_properties.outlinePr.showOutlineSymbols = True
-
-                log("✅ Группировка применена")
-
-            if CONFIG['stages']['wrap_text'] and CONFIG['wrap_text_columns']:
-                log("🔁 Применение переноса текста...")
-                wrap_cols = [
-                    col for col in CONFIG['wrap_text_columns']
-                    if col in used_cols_letters
-                ]
-                for row in range(CONFIG['min_row'], last_row + 1):
-                    if ws.row_dimensions[row].height is not None:
-                        ws.row_dimensions[row].height = None
-                    for col_letter in wrap_cols:
-                        col_idx = column_index_from_string(col_letter)
-                        cell = ws.cell(row=row, column=col_idx)
-                        h_align = cell.alignment.horizontal if cell.alignment and cell.alignment.horizontal else 'left'
-                        v_align = cell.alignment.vertical if cell.alignment and cell.alignment.vertical else 'bottom'
-                        cell.alignment = Alignment(
-                            horizontal=h_align,
-                            vertical=v_align,
-                            wrap_text=True
-                        )
-                log(f"✅ Перенос текста: {', '.join(wrap_cols)}")
-
-            if CONFIG['stages']['alignment'] and CONFIG['alignment_rules']:
-                log("📏 Применение выравнивания...")
-                applied_cols = set()
-                for rule in CONFIG['alignment_rules']:
-                    if len(rule) != 3:
-                        continue
-                    col_range, vertical, horizontal = rule
-                    cols = expand_column_range(col_range)
-                    for col_letter in cols:
-                        if col_letter in used_cols_letters:
-                            col_idx = column_index_from_string(col_letter)
-                            for row in range(CONFIG['min_row'], last_row + 1):
-                                cell = ws.cell(row=row, column=col_idx)
-                                wrap = cell.alignment.wrap_text if cell.alignment else False
-                                cell.alignment = Alignment(
-                                    vertical=vertical,
-                                    horizontal=horizontal,
-                                    wrap_text=wrap
-                                )
-                            applied_cols.add(col_letter)
-                log(f"✅ Выравнивание: {', '.join(sorted(applied_cols))}")
-
-            if CONFIG['stages']['formatting']:
-                log("🎨 Применение форматирования...")
-
-                font_name = CONFIG['font'].get('name', 'Times New Roman')
-                font_size = CONFIG['font'].get('size', 14)
-                font_bold = CONFIG['font'].get('bold', False)
-                font_italic = CONFIG['font'].get('italic', False)
-                font_underline = 'single' if CONFIG['font'].get('underline', False) else None
-
-                base_font = Font(
-                    name=font_name,
-                    size=font_size,
-                    bold=font_bold,
-                    italic=font_italic,
-                    underline=font_underline
-                )
+    def _process(self):
+        CONFIG, log = self.CONFIG, self.log
+        if CONFIG.get('checkpoints'):
+            self.checkpoint = Checkpoint(self.cache_key or result_key(CONFIG, self.source))
+            if self.checkpoint.resumed:
+                log("♻️ Найдена контрольная точка прошлого запуска — продолжаем с неё")
 
-                border_style = CONFIG.get('border_style', 'thin')
-                border = Border(
-                    left=Side(style=border_style),
-                    right=Side(style=border_style),
-                    top=Side(style=border_style),
-                    bottom=Side(style=border_style)
-                )
+        export_format = CONFIG.get('export_format')
+        if export_format == 'parquet' and not parquet_available():
+            log("⚠️ Для выгрузки в Parquet нужен pyarrow (pip install pyarrow) — выгрузка пропущена")
+            export_format = None
 
-                for row in range(CONFIG['min_row'], last_row + 1):
-                    temp_color_cell = temp_ws.cell(row=row, column=column_index_from_string(CONFIG['color_column']))
-                    has_color = get_cell_color(temp_color_cell) not in [None, 'FFFFFFFF', '00000000']
-                    level = levels.get(row, 9)
+        def open_sheet_export(sheet_name, columns):
+            path = export_path(CONFIG['output_file'], sheet_name, export_format)
+            log(f"📤 Выгрузка иерархии: {path}")
+            return open_export(export_format, path, columns)
 
-                    for col in used_cols:
-                        cell = ws.cell(row=row, column=col)
+        exporter = open_sheet_export if export_format else None
 
-                        is_bold_level = level in CONFIG.get('bold_levels', [1, 2])
-                        current_font = Font(
-                            name=font_name,
-                            size=font_size,
-                            bold=font_bold or is_bold_level,
-                            italic=font_italic,
-                            underline=font_underline
-                        )
-                        cell.font = current_font
-
-                        cell.border = border
-
-                        if hasattr(CONFIG, 'fill_color') and CONFIG['fill_color']:
-                            color = CONFIG['fill_color'].replace("#", "") if CONFIG['fill_color'].startswith("#") else CONFIG['fill_color']
-                            cell.fill = PatternFill(start_color=color, end_color=color, fill_type="solid")
-
-                        if hasattr(CONFIG, 'text_color') and CONFIG['text_color']:
-                            text_color = CONFIG['text_color'].replace("#", "") if CONFIG['text_color'].startswith("#") else CONFIG['text_color']
-                            cell.font = Font(
-                                name=font_name,
-                                size=font_size,
-                                bold=font_bold or is_bold_level,
-                                italic=font_italic,
-                                underline=font_underline,
-                                color=text_color
-                            )
+        if not process_workbook(self.wb, CONFIG, log, self.stop_requested, self.checkpoint, exporter, self.analysis):
+            if self.checkpoint:
+                log("💾 Контрольная точка сохранена — следующий запуск продолжит с неё")
+            self.stopped = True
+            self.finish(False, "Остановлено пользователем")
 
-                        if has_color and temp_color_cell.fill and CONFIG['stages']['hierarchy_colors']:
-                            cell.fill = copy(temp_color_cell.fill)
-
-                log("✅ Форматирование применено")
-
-            if CONFIG['stages']['number_formats'] and CONFIG['column_formats']:
-                log("🔢 Применение числовых форматов...")
-                for col_range, num_format in CONFIG['column_formats'].items():
-                    cols = expand_column_range(col_range)
-                    for col_letter in cols:
-                        if col_letter in used_cols_letters:
-                            col_idx = column_index_from_string(col_letter)
-                            for row in range(CONFIG['min_row'], last_row + 1):
-                                cell = ws.cell(row=row, column=col_idx)
-                                if cell.value is not None:
-                                    try:
-                                        cell.number_format = num_format
-                                    except Exception as e:
-                                        log(f"⚠️ Ошибка формата {num_format} в {col_letter}{row}: {e}")
-                log("✅ Числовые форматы применены")
-
-            log(f"✅ Лист '{sheet_name}' полностью обработан")
-
-        wb.save(CONFIG['output_file'])
+    def _write(self):
+        CONFIG, log = self.CONFIG, self.log
+        save_started = time.perf_counter()
+        save_workbook(self.wb, CONFIG['output_file'],
+                      compression=CONFIG.get('save_compression', DEFAULT_COMPRESSION),
+                      parallel=CONFIG.get('parallel_save', False), log=log,
+                      parts=self.checkpoint.parts(self.wb) if self.checkpoint else None)
+        log(f"💾 Запись файла: {time.perf_counter() - save_started:.1f} с")
+        if self.checkpoint:
+            self.checkpoint.remove()
         log(f"\n🎉 УСПЕШНО: файл сохранён!")
         log(f"📁 {CONFIG['output_file']}")
 
+        cache_key = self.cache_key
         try:
             test_wb = load_workbook(CONFIG['output_file'], read_only=True)
             log("✅ Тестовый запуск успешен — файл корректен.")
             test_wb.close()
         except Exception as e:
             log(f"⚠️ Ошибка при тестовом открытии: {e}")
+            cache_key = None
+
+        if cache_key:
+            try:
+                self.cache.store(cache_key, CONFIG['output_file'])
+            except OSError as e:
+                log(f"⚠️ Не удалось сохранить результат в кэш: {e}")
+
+        self.finish(True, "Обработка завершена успешно.")
+
+def process_excel(CONFIG, log_callback=None, stop_callback=None, workbook=None, analysis=None):
+    """
+    Основная функция обработки. Принимает CONFIG и опциональный callback для логов.
+    stop_callback — функция без аргументов; если она вернёт True, обработка прерывается между листами.
+    workbook — уже загруженная книга из load_source/fork_workbook, чтобы не читать файл повторно.
+    analysis — сохранённый в памяти анализ строк этой книги (warm.WarmAnalysis); без контрольных точек
+    используется вместо них.
+    При CONFIG['use_result_cache'] готовый результат для того же файла и тех же настроек берётся из кэша.
+    Шаги выполняются подряд (ExcelRun).
+    """
+    run = ExcelRun(CONFIG, log_callback, stop_callback, workbook, analysis)
+    run.read()
+    run.process()
+    return run.write()
+
+def process_excel_stream(source, destination, CONFIG, log_callback=None, stop_callback=None):
+    """
+    То же, что process_excel, но без файлов на диске: source — байты, двоичный поток или mapped.MappedFile,
+    результат пишется прямо в поток destination (без промежуточной копии файла целиком).
+    Пути из CONFIG, проверка блокировки, кэш результатов и тестовое открытие не используются.
+    Возвращает (успех, сообщение).
+    """
+    log, stop_requested = make_callbacks(log_callback, stop_callback)
 
+    try:
+        start = time.perf_counter()
+        if isinstance(source, MappedFile):
+            pass  # отображение читается без копии; каждый zip открывает свой курсор (mapped.zip_source)
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        elif not (hasattr(source, 'seek') and source.seekable()):
+            # zip требует произвольного доступа, а неразобранные листы читаются из него ещё раз при записи
+            source = io.BytesIO(source.read())
+        else:
+            source.seek(0)
+
+        wb = load_source(source, CONFIG['sheet_names'], value_free_mode(CONFIG))
+        log(f"✅ Книга загружена из потока. {loaded_message(wb)}")
+        log(f"⏱️  Время загрузки книги: {time.perf_counter() - start:.3f} сек")
+
+        if not process_workbook(wb, CONFIG, log, stop_requested):
+            return False, "Остановлено пользователем"
+
+        save_started = time.perf_counter()
+        write_workbook(wb, destination,
+                       compression=CONFIG.get('save_compression', DEFAULT_COMPRESSION),
+                       parallel=CONFIG.get('parallel_save', False), log=log)
+        log(f"💾 Запись результата в поток: {time.perf_counter() - save_started:.1f} с")
         return True, "Обработка завершена успешно."
 
     except Exception as e:
         error_msg = f"❌ Ошибка: {str(e)}"
         log(error_msg)
-        return False, error_msg
\ No newline at end of file
+        return False, error_msg
+
+def process_excel_bytes(data, CONFIG, log_callback=None, stop_callback=None):
+    """
+    Обработка книги целиком в памяти: принимает содержимое .xlsx, возвращает (успех, сообщение, байты результата).
+    При ошибке или остановке вместо байтов — None.
+    """
+    out = io.BytesIO()
+    success, message = process_excel_stream(data, out, CONFIG, log_callback, stop_callback)
+    return success, message, out.getvalue() if success else None
@@ -0,0 +1,84 @@
+# profiling.py — замер запуска программы: время импорта модулей и ключевые этапы (--profile-startup)
+
+import sys
+import threading
+import time
+from importlib.abc import MetaPathFinder
+
+
+class ImportTimer(MetaPathFinder):
+    """
+    Засекает выполнение каждого импортируемого модуля, как `python -X importtime`:
+    собственное время модуля и время вместе с вложенными импортами.
+    """
+
+    def __init__(self):
+        self.records = []  # (имя, собственное, общее) в секундах, в порядке завершения
+        self.local = threading.local()
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+
+class TimedLoader:
+    def __init__(self, loader, timer):
+        self.loader = loader
+        self.timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        stack = self.timer.stack()
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            total = time.perf_counter() - started
+            children = stack.pop()
+            if stack:
+                stack[-1] += total
+            self.timer.records.append((module.__name__, total - children, total))
+
+
+class StartupProfile:
+    """Этапы запуска с отметками времени от старта процесса и отчёт в stderr."""
+
+    def __init__(self, started):
+        self.started = started
+        self.marks = []
+        self.imports = ImportTimer()
+        sys.meta_path.insert(0, self.imports)
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter() - self.started))
+
+    def report(self, top=25, stream=None):
+        stream = stream or sys.stderr
+        if self.imports in sys.meta_path:
+            sys.meta_path.remove(self.imports)
+        print("⏱ Запуск Chik-chik:", file=stream)
+        for name, elapsed in self.marks:
+            print(f"  {elapsed * 1000:9.1f} мс  {name}", file=stream)
+        records = sorted(self.imports.records, key=lambda r: r[2], reverse=True)[:top]
+        print("import time: self [us] | cumulative | imported package", file=stream)
+        for name, own, total in records:
+            print(f"import time: {own * 1e6:9.0f} | {total * 1e6:10.0f} | {name}", file=stream)
+        stream.flush()
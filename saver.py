@@ -0,0 +1,196 @@
+# saver.py — сохранение книги: уровень сжатия, параллельная запись листов, атомарная замена файла
+
+import datetime
+import multiprocessing
+import os
+import sys
+import tempfile
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+from openpyxl.cell.cell import MergedCell
+from openpyxl.drawing.spreadsheet_drawing import SpreadsheetDrawing
+from openpyxl.packaging.relationship import RelationshipList
+from openpyxl.styles.differential import DifferentialStyle
+from openpyxl.worksheet._writer import WorksheetWriter
+from openpyxl.writer.excel import ExcelWriter
+
+from passthrough import PassthroughCopier, RelsPatchingArchive, passthrough_sheets
+
+# 0 — без сжатия (store), 1..9 — уровни deflate; 6 соответствует обычному wb.save
+DEFAULT_COMPRESSION = 6
+# Меньше ячеек на листе — выгоднее записать его в своём процессе, чем запускать отдельный
+PARALLEL_MIN_CELLS = 50000
+
+# Книга, доступная дочерним процессам после fork (копия памяти родителя, без pickle).
+# Задаётся в каждом дочернем процессе инициализатором пула: одновременные записи разных книг не мешают друг другу
+_FORK_WORKBOOK = None
+
+
+def fork_available():
+    # Параллельная запись держится на fork: передать лист в процесс через pickle дороже, чем записать его.
+    # На Windows fork нет, на macOS он небезопасен с загруженным Qt — там листы пишутся по очереди.
+    return sys.platform.startswith('linux') and 'fork' in multiprocessing.get_all_start_methods()
+
+
+def _prepare_parallel_sheet(ws):
+    """
+    Регистрирует в книге все стили листа заранее, чтобы номера стилей в дочернем процессе
+    совпали с родительскими. Возвращает False, если лист пишет в книгу то,
+    что из дочернего процесса не вернуть (связи, комментарии, рисунки, таблицы).
+    """
+    if ws._charts or ws._images or ws._tables or ws._pivots or ws.legacy_drawing is not None:
+        return False
+    wb = ws.parent
+    cell_styles = wb._cell_styles
+    for cell in ws._cells.values():
+        # У ячеек внутри объединения нет ни ссылок, ни примечаний, но границы объединения — их стиль
+        if type(cell) is not MergedCell and (cell._hyperlink is not None or cell._comment is not None):
+            return False
+        if cell._style is not None and cell.has_style:
+            cell_styles.add(cell._style)
+    df = DifferentialStyle()
+    for cf in ws.conditional_formatting:
+        for rule in cf.rules:
+            if rule.dxf and rule.dxf != df:
+                rule.dxfId = wb._differential_styles.add(rule.dxf)
+    ws.sheet_format.outlineLevelCol = ws.column_dimensions.max_outline
+    ws._hyperlinks = []
+    ws._comments = []
+    return True
+
+
+def _init_fork_workbook(wb):
+    global _FORK_WORKBOOK
+    _FORK_WORKBOOK = wb
+
+
+def _write_sheet_part(task):
+    index, path = task
+    writer = WorksheetWriter(_FORK_WORKBOOK.worksheets[index], out=path)
+    writer.write()
+    return index
+
+
+class ParallelExcelWriter(ExcelWriter):
+    """
+    ExcelWriter, который берёт XML листов из готовых файлов, если они записаны заранее
+    (файлы не удаляются — это делает тот, кто их записал), а листы, загруженные без разбора (passthrough),
+    копирует из исходного архива.
+    """
+
+    def __init__(self, workbook, archive, parts):
+        super().__init__(workbook, archive)
+        self.parts = parts
+        self.copier = None
+
+    def write_data(self):
+        source = getattr(self.workbook, '_passthrough', None)
+        if source is None or not passthrough_sheets(self.workbook):
+            return super().write_data()
+        archive = self._archive
+        self.copier = PassthroughCopier(source, archive, self.manifest)
+        try:
+            rel = self.copier.copy_shared_strings()
+            self._archive = RelsPatchingArchive(archive, [rel] if rel is not None else [])
+            super().write_data()
+        finally:
+            self._archive = archive
+            self.copier.close()
+            self.copier = None
+
+    def write_worksheet(self, ws):
+        if self.copier is not None and getattr(ws, '_passthrough', None):
+            ws._drawing = None
+            ws._rels = RelationshipList()
+            self.copier.copy_sheet(ws)
+            self.manifest.append(ws)
+            return
+        path = self.parts.pop(id(ws), None)
+        if path is None:
+            return super().write_worksheet(ws)
+        ws._drawing = SpreadsheetDrawing()
+        ws._drawing.charts = ws._charts
+        ws._drawing.images = ws._images
+        ws._rels = RelationshipList()
+        self._archive.write(path, ws.path[1:])
+        self.manifest.append(ws)
+
+
+def write_sheet_part(ws, path):
+    """Записывает XML листа в файл path заранее, до записи книги. False — лист так записать нельзя."""
+    if not _prepare_parallel_sheet(ws):
+        return False
+    WorksheetWriter(ws, out=path).write()
+    return True
+
+
+def write_sheet_parts(wb, workers, log=None, ready=()):
+    """
+    Записывает XML больших листов в параллельных процессах (кроме листов с id из ready, уже записанных).
+    Возвращает {id(ws): путь к файлу}.
+    """
+    candidates = [i for i, ws in enumerate(wb.worksheets)
+                  if id(ws) not in ready and len(ws._cells) >= PARALLEL_MIN_CELLS and _prepare_parallel_sheet(ws)]
+    if len(candidates) < 2 or workers < 2:
+        return {}
+
+    tasks = []
+    for index in candidates:
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.close(fd)
+        tasks.append((index, path))
+
+    try:
+        # С fork аргументы инициализатора не сериализуются: процессы получают книгу из памяти родителя
+        with multiprocessing.get_context('fork').Pool(min(workers, len(tasks)), _init_fork_workbook, (wb,)) as pool:
+            pool.map(_write_sheet_part, tasks)
+    except Exception:
+        for _, path in tasks:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    if log:
+        log(f"🧵 Листов записано параллельно: {len(tasks)}")
+    return {id(wb.worksheets[index]): path for index, path in tasks}
+
+
+def write_workbook(wb, file, compression=DEFAULT_COMPRESSION, parallel=False, log=None, parts=None):
+    """
+    Пишет книгу в file — путь или двоичный поток (в том числе без seek: zip пишется с дескрипторами данных).
+    parts — уже записанный XML листов {id(ws): путь к файлу} (checkpoint.Checkpoint.parts).
+    """
+    if compression:
+        zip_args = dict(compression=ZIP_DEFLATED, compresslevel=compression)
+    else:
+        zip_args = dict(compression=ZIP_STORED)
+
+    ready = parts or {}
+    written = {}
+    try:
+        if parallel and fork_available():
+            written = write_sheet_parts(wb, os.cpu_count() or 1, log, ready)
+        wb.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+        with ZipFile(file, 'w', allowZip64=True, **zip_args) as archive:
+            ParallelExcelWriter(wb, archive, {**ready, **written}).write_data()
+    finally:
+        for path in written.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def save_workbook(wb, filename, compression=DEFAULT_COMPRESSION, parallel=False, log=None, parts=None):
+    """
+    Сохраняет книгу во временный файл рядом с filename и атомарно заменяет им результат:
+    при сбое на середине записи прежний файл (или его отсутствие) остаётся нетронутым.
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    # Уникальное имя: одновременные задачи (в том числе потоки одного процесса) не пишут в один файл
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f"~{name}.", suffix='.tmp')
+    os.close(fd)
+    try:
+        write_workbook(wb, tmp, compression, parallel, log, parts)
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
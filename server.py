@@ -0,0 +1,407 @@
+# server.py — локальный HTTP-сервис: загрузить книгу, получить обработанную
+#
+# Запуск: python server.py [--port 8765] [--workers 2]
+# Слушает только 127.0.0.1. Эндпоинты:
+#   POST   /jobs              multipart/form-data: file — .xlsx, config — JSON настроек вкладки → {"id", "status"}
+#   GET    /jobs              список задач
+#   GET    /jobs/<id>         статус задачи и лог
+#   GET    /jobs/<id>/result  готовый .xlsx
+#   DELETE /jobs/<id>         отмена (если ещё идёт) и удаление файлов задачи
+
+import argparse
+import email.parser
+import email.policy
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_REQUEST_BYTES = 200 * 1024 * 1024
+# Тело запроса читается порциями: книга пишется прямо в файл задачи, в памяти — только поля настроек
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+MAX_FIELD_BYTES = 1024 * 1024
+MAX_PART_HEADER_BYTES = 64 * 1024
+# Сколько задач может ждать и выполняться одновременно; сверх этого — 429
+MAX_ACTIVE_JOBS = 16
+# Готовые задачи хранятся час, потом их файлы удаляются
+JOB_TTL_SECONDS = 60 * 60
+
+# Ключи настроек, без которых обработка не запустится (формат — вкладка из файла настроек GUI)
+REQUIRED_KEYS = ('color_column', 'hierarchy_column', 'min_row', 'font', 'border_style', 'bold_levels',
+                 'column_formats', 'wrap_text_columns', 'alignment_rules', 'stages')
+STAGE_KEYS = ('grouping', 'hierarchy', 'hierarchy_colors', 'wrap_text', 'alignment',
+              'formatting', 'number_formats', 'subtotals', 'large_file_mode')
+
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def run_job(input_path, output_path, cancel_path, config):
+    """Выполняется в процессе пула: читает загруженный файл, пишет результат рядом."""
+    from mapped import MappedFile
+    from processor import process_excel_stream
+
+    log = []
+    # Загруженный файл отображается в память: разбор и перенос неразобранных листов читают его без копий
+    with MappedFile(input_path) as src, open(output_path, 'wb') as dst:
+        success, message = process_excel_stream(src, dst, config, log.append,
+                                                stop_callback=lambda: os.path.exists(cancel_path))
+    return success, message, log
+
+
+def parse_config(raw):
+    try:
+        config = json.loads(raw)
+    except ValueError as e:
+        raise ValueError(f"config: некорректный JSON ({e})")
+    if not isinstance(config, dict):
+        raise ValueError("config: ожидается объект с настройками вкладки")
+    missing = [key for key in REQUIRED_KEYS if key not in config]
+    if missing:
+        raise ValueError(f"config: нет обязательных полей: {', '.join(missing)}")
+    stages = config['stages']
+    if not isinstance(stages, dict):
+        raise ValueError("config: stages — объект вида {этап: true/false}")
+    config['stages'] = {key: bool(stages.get(key, False)) for key in STAGE_KEYS}
+    config.setdefault('sheet_names', None)
+    config.setdefault('scan_columns_by_row', 1 if config['stages']['large_file_mode'] else None)
+    config.setdefault('fill_color', None)
+    config.setdefault('text_color', None)
+    config.setdefault('grid_enabled', False)
+    config['input_file'] = config['output_file'] = None
+    # Задачи и так идут параллельно в пуле; процессы пула не должны порождать свои
+    config['parallel_save'] = False
+    return config
+
+
+def parse_headers(data):
+    return email.parser.BytesHeaderParser(policy=email.policy.HTTP).parsebytes(data + b'\r\n\r\n')
+
+
+def parse_multipart(content_type, stream, length, file_path):
+    """
+    Читает из stream тело multipart/form-data длиной length порциями. Поле file пишется прямо в file_path,
+    остальные поля (не больше MAX_FIELD_BYTES) остаются в памяти.
+    Возвращает {имя поля: (имя файла или None, байты; для file — None)}.
+    """
+    header = parse_headers(b'Content-Type: ' + content_type.encode('latin-1'))
+    boundary = header.get_boundary() if header.get_content_maintype() == 'multipart' else None
+    if not boundary:
+        raise ValueError("ожидается multipart/form-data")
+    delimiter = b'\r\n--' + boundary.encode('latin-1')
+    buffer = b'\r\n'  # перед первой границей перевода строки нет
+    remaining = length
+
+    def fill():
+        nonlocal buffer, remaining
+        if remaining <= 0:
+            raise ValueError("multipart: тело запроса оборвано")
+        chunk = stream.read(min(remaining, UPLOAD_CHUNK_BYTES))
+        if not chunk:
+            raise ValueError("multipart: тело короче Content-Length")
+        remaining -= len(chunk)
+        buffer += chunk
+
+    def take_until(marker, sink):
+        # Всё до marker уходит в sink; хвост, где marker может начинаться, ждёт следующей порции
+        nonlocal buffer
+        while True:
+            index = buffer.find(marker)
+            if index >= 0:
+                sink(buffer[:index])
+                buffer = buffer[index + len(marker):]
+                return
+            keep = len(marker) - 1
+            sink(buffer[:-keep])
+            buffer = buffer[-keep:]
+            fill()
+
+    take_until(delimiter, lambda data: None)
+    fields = {}
+    while True:
+        while len(buffer) < 2:
+            fill()
+        if buffer.startswith(b'--'):
+            return fields
+        head = []
+
+        def collect_head(data):
+            head.append(data)
+            if sum(map(len, head)) > MAX_PART_HEADER_BYTES:
+                raise ValueError("multipart: слишком длинные заголовки части")
+
+        take_until(b'\r\n\r\n', collect_head)
+        part = parse_headers(b''.join(head).split(b'\r\n', 1)[-1])
+        name = part.get_param('name', header='content-disposition')
+        if name == 'file':
+            with open(file_path, 'wb') as f:
+                take_until(delimiter, f.write)
+            fields[name] = (part.get_filename(), None)
+            continue
+        body = []
+
+        def collect_body(data):
+            body.append(data)
+            if sum(map(len, body)) > MAX_FIELD_BYTES:
+                raise ValueError(f"multipart: поле {name} больше {MAX_FIELD_BYTES // 1024} КБ")
+
+        take_until(delimiter, collect_body)
+        if name:
+            fields[name] = (part.get_filename(), b''.join(body))
+
+
+class Job:
+    def __init__(self, job_id, directory, filename):
+        self.id = job_id
+        self.directory = directory
+        self.filename = filename
+        self.status = 'queued'
+        self.message = ''
+        self.log = []
+        self.created = time.time()
+        self.finished = None
+        self.future = None
+
+    @property
+    def input_path(self):
+        return os.path.join(self.directory, 'input.xlsx')
+
+    @property
+    def output_path(self):
+        return os.path.join(self.directory, 'output.xlsx')
+
+    @property
+    def cancel_path(self):
+        return os.path.join(self.directory, 'cancel')
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running', 'cancelling')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'file': self.filename,
+            'status': self.status,
+            'message': self.message,
+            'log': self.log,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+class JobManager:
+    """Очередь задач поверх ограниченного пула процессов."""
+
+    def __init__(self, workers, root=None):
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.root = root or tempfile.mkdtemp(prefix='chikchik-server-')
+        self.jobs = {}
+        # RLock: future.cancel() вызывает on_done сразу, в том же потоке и под той же блокировкой
+        self.lock = threading.RLock()
+
+    def submit(self, filename, upload_path, config):
+        """Ставит в очередь книгу из upload_path (файл переносится в каталог задачи)."""
+        with self.lock:
+            self.cleanup()
+            if sum(job.active for job in self.jobs.values()) >= MAX_ACTIVE_JOBS:
+                return None
+            job_id = uuid.uuid4().hex
+            job = Job(job_id, os.path.join(self.root, job_id), filename)
+            os.makedirs(job.directory)
+            os.replace(upload_path, job.input_path)
+            self.jobs[job_id] = job
+            job.future = self.pool.submit(run_job, job.input_path, job.output_path, job.cancel_path, config)
+            job.future.add_done_callback(lambda future: self.on_done(job, future))
+        return job
+
+    def on_done(self, job, future):
+        with self.lock:
+            job.finished = time.time()
+            if future.cancelled():
+                job.status, job.message = 'cancelled', "Отменено до запуска"
+                return
+            error = future.exception()
+            if error is not None:
+                job.status, job.message = 'failed', f"Исключение: {error}"
+                return
+            success, message, log = future.result()
+            job.message, job.log = message, log
+            if success:
+                job.status = 'done'
+            elif os.path.exists(job.cancel_path):
+                job.status = 'cancelled'
+            else:
+                job.status = 'failed'
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def refresh(self, job):
+        # Задача, которую пул уже взял в работу, больше не отменить через future.cancel()
+        if job.status == 'queued' and job.future.running():
+            job.status = 'running'
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.active:
+                if job.future.cancel():
+                    return job  # статус выставит on_done
+                open(job.cancel_path, 'w').close()
+                job.status = 'cancelling'
+            else:
+                del self.jobs[job_id]
+                shutil.rmtree(job.directory, ignore_errors=True)
+            return job
+
+    def cleanup(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and now - job.finished > JOB_TTL_SECONDS:
+                del self.jobs[job_id]
+                shutil.rmtree(job.directory, ignore_errors=True)
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    manager = None  # JobManager, задаётся в serve()
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {'error': message})
+
+    def route(self):
+        parts = [part for part in self.path.split('?', 1)[0].split('/') if part]
+        if not parts or parts[0] != 'jobs' or len(parts) > 3:
+            return None, None
+        job_id = parts[1] if len(parts) > 1 else None
+        action = parts[2] if len(parts) > 2 else None
+        return job_id, action
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.send_error_json(404, "нет такого адреса")
+
+        length = self.headers.get('Content-Length')
+        if length is None:
+            return self.send_error_json(411, "нужен заголовок Content-Length")
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self.send_error_json(400, "некорректный заголовок Content-Length")
+        if length > MAX_REQUEST_BYTES:
+            return self.send_error_json(413, f"запрос больше {MAX_REQUEST_BYTES // (1024 * 1024)} МБ")
+
+        fd, upload_path = tempfile.mkstemp(dir=self.manager.root, suffix='.upload')
+        os.close(fd)
+        try:
+            try:
+                fields = parse_multipart(self.headers.get('Content-Type', ''), self.rfile, length, upload_path)
+                if 'file' not in fields:
+                    raise ValueError("нет поля file с книгой .xlsx")
+                if 'config' not in fields:
+                    raise ValueError("нет поля config с настройками")
+                config = parse_config(fields['config'][1])
+            except ValueError as e:
+                return self.send_error_json(400, str(e))
+
+            filename = fields['file'][0]
+            job = self.manager.submit(filename or 'input.xlsx', upload_path, config)
+            if job is None:
+                return self.send_error_json(429, "слишком много задач в очереди, повторите позже")
+            self.send_json(202, {'id': job.id, 'status': job.status})
+        finally:
+            if os.path.exists(upload_path):
+                os.remove(upload_path)
+
+    def do_GET(self):
+        job_id, action = self.route()
+        if self.path.rstrip('/') == '/jobs':
+            with self.manager.lock:
+                for job in self.manager.jobs.values():
+                    self.manager.refresh(job)
+                jobs = [job.to_dict() for job in self.manager.jobs.values()]
+            return self.send_json(200, {'jobs': jobs})
+
+        job = self.manager.get(job_id) if job_id else None
+        if job is None:
+            return self.send_error_json(404, "задача не найдена")
+
+        if action is None:
+            with self.manager.lock:
+                self.manager.refresh(job)
+                data = job.to_dict()
+            return self.send_json(200, data)
+
+        if action != 'result':
+            return self.send_error_json(404, "нет такого адреса")
+        if job.status != 'done':
+            return self.send_error_json(409, f"результат не готов: {job.status}")
+
+        stem = os.path.splitext(os.path.basename(job.filename))[0]
+        download_name = f"{stem}_обработанный.xlsx"
+        self.send_response(200)
+        self.send_header('Content-Type', XLSX_MIME)
+        self.send_header('Content-Length', str(os.path.getsize(job.output_path)))
+        self.send_header('Content-Disposition', "attachment; filename*=UTF-8''" + quote(download_name))
+        self.end_headers()
+        with open(job.output_path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    def do_DELETE(self):
+        job_id, action = self.route()
+        if not job_id or action is not None:
+            return self.send_error_json(404, "нет такого адреса")
+        job = self.manager.cancel(job_id)
+        if job is None:
+            return self.send_error_json(404, "задача не найдена")
+        self.send_json(200, {'id': job.id, 'status': job.status})
+
+    def log_message(self, format, *args):
+        print(f"🌐 {self.address_string()} {format % args}")
+
+
+def serve(port=DEFAULT_PORT, workers=None):
+    workers = workers or max(1, (os.cpu_count() or 2) // 2)
+    manager = JobManager(workers)
+    RequestHandler.manager = manager
+    httpd = ThreadingHTTPServer((HOST, port), RequestHandler)
+    print(f"🚀 Chik-chik сервис: http://{HOST}:{httpd.server_port}/jobs (процессов: {workers})")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        manager.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальный HTTP-сервис обработки книг Chik-chik")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=None, help="размер пула процессов")
+    args = parser.parse_args()
+    serve(args.port, args.workers)
@@ -0,0 +1,143 @@
+# sheetfeed.py — разбор листов в фоне: книга загружается без sheetData выбранных листов, ячейки
+# разбираются по порядку выбора, и обработка листа начинается, как только готов он сам, а не вся книга
+
+import multiprocessing
+import os
+import threading
+from zipfile import ZipFile
+
+from mapped import zip_source
+from parsedcache import parse_record, restore_sheet
+from saver import fork_available
+
+# Задание дочерним процессам разбора, доступное после fork (как книга в saver).
+# Задаётся в каждом дочернем процессе инициализатором пула: одновременные разборы разных книг не мешают друг другу
+_FORK_FEED = None
+
+
+def _init_fork_feed(feed):
+    global _FORK_FEED
+    _FORK_FEED = feed
+
+
+def _parse_target(target):
+    feed = _FORK_FEED
+    with ZipFile(zip_source(feed.source)) as archive:
+        data = archive.read(target)
+    return parse_record(data, feed.shared_strings, feed.cell_styles, feed.data_only)
+
+
+class SheetFeed:
+    """
+    Отложенный разбор ячеек выбранных листов. SelectiveReader открывает их части без sheetData
+    (parsedcache.SkeletonArchive) и передаёт в start() в порядке выбора; записи листов
+    (parsedcache.parse_record) готовятся в фоне, а wait(ws) заполняет лист, когда до него дошла обработка.
+    По умолчанию листы разбираются в фоновом потоке. С processes=True на Linux с несколькими ядрами —
+    в процессах (fork, общий отображённый файл): fork из процесса с другими живыми потоками (GUI, конвейер)
+    небезопасен, поэтому, как и параллельная запись (saver), это только по явному выбору.
+    Книгу меняет только поток, который вызывает wait/finish.
+    """
+
+    def __init__(self, source, data_only=True, workers=None, processes=False):
+        self.source = source
+        self.data_only = data_only
+        self.use_processes = processes
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.shared_strings = None
+        self.cell_styles = None
+        self.sheets = {}  # имя листа -> путь части
+        self.records = {}  # путь части -> запись
+        self.error = None
+        self.ready = threading.Condition()
+        self.thread = None
+        self.pool = None
+        self.closed = False
+        self.processes = 0
+
+    def start(self, wb, sheets, shared_strings):
+        """sheets — [(имя листа, путь части)] в порядке обработки."""
+        self.sheets = dict(sheets)
+        self.shared_strings = shared_strings
+        self.cell_styles = wb._cell_styles
+        targets = [target for _, target in sheets]
+        wb._sheet_feed = self
+        if not targets:
+            return
+        if self.use_processes and fork_available() and self.workers > 1 and len(targets) > 1:
+            self.processes = min(self.workers - 1, len(targets))
+            self.pool = multiprocessing.get_context('fork').Pool(
+                self.processes, initializer=_init_fork_feed, initargs=(self,))
+            results = self.pool.imap(_parse_target, targets)
+            next_record = lambda: self.pool_result(results)
+        else:
+            parsed = map(self.parse, targets)  # лениво: листы разбираются в потоке collect
+            next_record = lambda: next(parsed)
+        self.thread = threading.Thread(target=self.collect, args=(targets, next_record), name='sheet-feed', daemon=True)
+        self.thread.start()
+
+    def parse(self, target):
+        with ZipFile(zip_source(self.source)) as archive:
+            data = archive.read(target)
+        return parse_record(data, self.shared_strings, self.cell_styles, self.data_only)
+
+    def pool_result(self, results):
+        # Ожидание с таймаутом: после close() пул остановлен, и результата может не быть никогда
+        while True:
+            try:
+                return results.next(timeout=0.2)
+            except multiprocessing.TimeoutError:
+                if self.closed:
+                    return None
+
+    def collect(self, targets, next_record):
+        try:
+            for target in targets:
+                record = next_record()
+                with self.ready:
+                    if self.closed:
+                        return
+                    self.records[target] = record
+                    self.ready.notify_all()
+        except Exception as e:
+            with self.ready:
+                self.error = e
+                self.ready.notify_all()
+
+    def wait(self, ws):
+        """Заполняет лист ячейками, если он ещё ждёт разбора; ошибка разбора поднимается здесь."""
+        target = self.sheets.pop(ws.title, None)
+        if target is None:
+            return
+        with self.ready:
+            while target not in self.records and self.error is None:
+                self.ready.wait()
+            if target not in self.records:
+                raise self.error
+            record = self.records.pop(target)
+        restore_sheet(ws, record)
+
+    def finish(self, wb):
+        """Дозаполняет все листы (перед записью книги) и освобождает процессы."""
+        for name in list(self.sheets):
+            self.wait(wb[name])
+        self.close()
+        del wb._sheet_feed
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+def wait_sheet(ws):
+    feed = getattr(ws.parent, '_sheet_feed', None)
+    if feed is not None:
+        feed.wait(ws)
+
+
+def finish_sheets(wb):
+    feed = getattr(wb, '_sheet_feed', None)
+    if feed is not None:
+        feed.finish(wb)
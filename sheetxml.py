@@ -0,0 +1,330 @@
+# sheetxml.py — лист без разбора в объекты openpyxl: просмотр строк XML и точечная правка
+# для запусков, где нужны только группировка и иерархия (значения ячеек не декодируются)
+
+import re
+from xml.sax.saxutils import escape, unescape
+
+from openpyxl.utils import column_index_from_string
+
+_ATTR_RE = {}
+_REF_RE = re.compile(rb'([A-Z]+)(\d*)')
+_ROW_ATTRS_RE = re.compile(rb'\s(?:outlineLevel|collapsed|hidden|spans)=(["\'])[^"\']*\1')
+_LABEL_ATTRS_RE = re.compile(rb'\s(?:r|t|cm|vm)=(["\'])[^"\']*\1')
+_OUTLINE_ATTRS_RE = re.compile(rb'\s(?:summaryBelow|summaryRight|showOutlineSymbols)=(["\'])[^"\']*\1')
+_FORMULA_ATTRS_RE = re.compile(rb'\s(?:t|cm)=(["\'])[^"\']*\1')
+_TRUE = (b'1', b'true')
+
+
+def attr(attrs, name):
+    pattern = _ATTR_RE.get(name)
+    if pattern is None:
+        pattern = _ATTR_RE[name] = re.compile(rb'(?:^|\s)' + name + rb'=["\']([^"\']*)["\']')
+    m = pattern.search(attrs)
+    return m.group(1) if m else None
+
+
+class SheetXml:
+    """
+    XML листа как байты: строки <row> и ячейки <c> находятся регулярными выражениями,
+    без построения дерева. Поддерживаются префиксы пространства имён (<x:row>) и строки/ячейки без r.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        m = re.search(rb'<(\w+:)?worksheet\b', data)
+        p = self.prefix = (m.group(1) or b'') if m else b''
+        self.row_re = re.compile(rb'<' + p + rb'row\b([^>]*?)(/>|>(.*?)</' + p + rb'row>)', re.S)
+        self.cell_re = re.compile(rb'<' + p + rb'c\b([^>]*?)(/>|>(.*?)</' + p + rb'c>)', re.S)
+        self.v_re = re.compile(rb'<' + p + rb'v\b[^>]*>([^<]*)</', re.S)
+        self.t_re = re.compile(rb'<' + p + rb't\b[^>]*>([^<]*)</', re.S)
+        self.f_re = re.compile(rb'<' + p + rb'f\b')
+        self.v_element_re = re.compile(rb'<' + p + rb'v\b[^>]*?(?:/>|>([^<]*)</' + p + rb'v>)')
+        m = re.search(rb'<' + p + rb'sheetData\b[^>]*?(/?)>', data)
+        if m is None or m.group(1):
+            self.start = self.end = m.end() if m else len(data)
+        else:
+            self.start = m.end()
+            self.end = data.index(b'</' + p + b'sheetData>', self.start)
+        self._columns = {}
+
+    def rows(self):
+        """(номер строки, совпадение <row>) по порядку файла."""
+        number = 0
+        for m in self.row_re.finditer(self.data, self.start, self.end):
+            r = attr(m.group(1), b'r')
+            number = int(r) if r else number + 1
+            yield number, m
+
+    def cells(self, body):
+        """(номер столбца, совпадение <c>) в теле строки."""
+        column = 0
+        if not body:
+            return
+        for m in self.cell_re.finditer(body):
+            ref = attr(m.group(1), b'r')
+            if ref:
+                letters = _REF_RE.match(ref).group(1)
+                column = self._columns.get(letters)
+                if column is None:
+                    column = self._columns[letters] = column_index_from_string(letters.decode('ascii'))
+            else:
+                column += 1
+            yield column, m
+
+    def text(self, cell, strings):
+        """Текст ячейки как строка или None (не строка/пусто); значения остальных типов не разбираются."""
+        attrs, body = cell.group(1), cell.group(3)
+        if not body:
+            return None
+        t = attr(attrs, b't')
+        if t == b'inlineStr':
+            return unescape(b''.join(self.t_re.findall(body)).decode('utf-8'))
+        m = self.v_re.search(body)
+        if m is None:
+            return None
+        if t == b's':
+            return str(strings[int(m.group(1))])
+        if t == b'str':
+            return unescape(m.group(1).decode('utf-8'))
+        return None
+
+    def has_value(self, cell, strings):
+        """Непустое значение — как cell.value not in (None, "") у книги со значениями."""
+        attrs, body = cell.group(1), cell.group(3)
+        if not body:
+            return False
+        t = attr(attrs, b't')
+        if t == b'inlineStr':
+            return any(self.t_re.findall(body))
+        m = self.v_re.search(body)
+        if m is None or not m.group(1):
+            return False
+        if t == b's':
+            return str(strings[int(m.group(1))]) != ''
+        return True
+
+
+    def cached_value(self, cell):
+        """
+        Ячейка с формулой — её сохранённым значением, как у книги, загруженной с data_only=True:
+        <f> убирается, <v> остаётся; строковый результат (t="str") становится встроенной строкой.
+        Ячейка без формулы возвращается как есть.
+        """
+        attrs, body = cell.group(1), cell.group(3)
+        if not body or not self.f_re.search(body):
+            return cell.group(0)
+        p = self.prefix
+        t = attr(attrs, b't')
+        attrs = _FORMULA_ATTRS_RE.sub(b'', attrs)  # cm ссылается на metadata.xml, который не пишется
+        m = self.v_element_re.search(body)
+        if m is None or m.group(1) is None or (not m.group(1) and t == b'str'):
+            return b'<' + p + b'c' + attrs + b'/>'
+        if t == b'str':
+            space = b' xml:space="preserve"' if m.group(1) != m.group(1).strip() else b''
+            return (b'<' + p + b'c' + attrs + b' t="inlineStr"><' + p + b'is><' + p + b't' + space + b'>'
+                    + m.group(1) + b'</' + p + b't></' + p + b'is></' + p + b'c>')
+        if t:
+            attrs += b' t="' + t + b'"'
+        return b'<' + p + b'c' + attrs + b'>' + m.group(0) + b'</' + p + b'c>'
+
+    def without_formulas(self, data):
+        """XML листа data (с той же разметкой, что self.data), где формулы заменены сохранёнными значениями."""
+        p = self.prefix
+        start = re.search(rb'<' + p + rb'sheetData\b[^>]*?(/?)>', data)
+        if start is None or start.group(1) or not self.f_re.search(data, start.end()):
+            return data
+        end = data.index(b'</' + p + b'sheetData>', start.end())
+        return data[:start.end()] + self.cell_re.sub(self.cached_value, data[start.end():end]) + data[end:]
+
+
+def scan_rows(sheet, strings, min_row, color_col, max_col=None):
+    """
+    Один проход по строкам от min_row: последняя непустая строка, столбцы со значениями и id стилей
+    ячеек цветового столбца {строка: s}. С max_col непустота проверяется только в столбцах до него,
+    а столбцами данных считаются все A..max_col (как в режиме «Большой файл»).
+    Возвращает (last_row или None, столбцы, стили).
+    """
+    last_row = None
+    data_cols = set(range(1, max_col + 1)) if max_col is not None else set()
+    styles = {}
+    for row, m in sheet.rows():
+        if row < min_row:
+            continue
+        filled = False
+        for col, cell in sheet.cells(m.group(3)):
+            if col == color_col:
+                s = attr(cell.group(1), b's')
+                if s:
+                    styles[row] = int(s)
+            if max_col is not None and col > max_col:
+                continue
+            # Значение проверяется, пока строка не признана непустой или столбец ещё не встречался
+            if (not filled or col not in data_cols) and sheet.has_value(cell, strings):
+                filled = True
+                data_cols.add(col)
+        if filled:
+            last_row = row if last_row is None else max(last_row, row)
+    return last_row, data_cols, styles
+
+
+class SheetPatch:
+    """
+    Правка строк min_row..last_row: номер иерархии в столбце h_col (labels[i] для строки min_row + i)
+    и атрибуты группировки (outline/collapsed). labels или outline равны None, если этап выключен.
+    Ячейки и строки, которые уже в нужном виде, копируются без изменений.
+    """
+
+    def __init__(self, sheet, strings, min_row, last_row, h_col, labels=None, outline=None, collapsed=None):
+        self.sheet = sheet
+        self.strings = strings
+        self.min_row = min_row
+        self.last_row = last_row
+        self.h_col = h_col
+        self.h_letter = None
+        self.labels = labels
+        self.outline = outline
+        self.collapsed = collapsed
+        self.changed_cells = 0
+        self.changed_rows = 0
+
+    def label_cell(self, row, label, attrs=b''):
+        # Номер пишется встроенной строкой, как и в openpyxl: номера почти все разные, и таблица общих
+        # строк (sharedStrings.xml) из них не стала бы меньше — только добавила бы индекс в каждую ячейку
+        p = self.sheet.prefix
+        if attrs:
+            attrs = _LABEL_ATTRS_RE.sub(b'', attrs)
+        return (b'<' + p + b'c r="' + self.h_letter + str(row).encode() + b'"' + attrs + b' t="inlineStr"><'
+                + p + b'is><' + p + b't>' + escape(label).encode('utf-8') + b'</' + p + b't></' + p + b'is></' + p + b'c>')
+
+    def row_attrs(self, i, attrs):
+        if self.outline is None:
+            return attrs
+        level, collapsed = self.outline[i], bool(self.collapsed[i])
+        current = int(attr(attrs, b'outlineLevel') or 0)
+        if (current == level and (attr(attrs, b'collapsed') in _TRUE) == collapsed
+                and attr(attrs, b'hidden') not in _TRUE):
+            return attrs
+        self.changed_rows += 1
+        attrs = _ROW_ATTRS_RE.sub(b'', attrs)
+        if level:
+            attrs += b' outlineLevel="%d"' % level
+        if collapsed:
+            attrs += b' collapsed="1"'
+        return attrs
+
+    def row_body(self, i, row, body):
+        if self.labels is None:
+            return body
+        label = self.labels[i]
+        body = body or b''
+        for col, cell in self.sheet.cells(body):
+            if col == self.h_col:
+                if self.sheet.text(cell, self.strings) == label and attr(cell.group(1), b't') in (b'inlineStr', b's'):
+                    return body
+                self.changed_cells += 1
+                return body[:cell.start()] + self.label_cell(row, label, cell.group(1)) + body[cell.end():]
+            if col > self.h_col:
+                self.changed_cells += 1
+                return body[:cell.start()] + self.label_cell(row, label) + body[cell.start():]
+        self.changed_cells += 1
+        return body + self.label_cell(row, label)
+
+    def new_row(self, row):
+        i = row - self.min_row
+        p = self.sheet.prefix
+        plain = b' r="%d"' % row
+        attrs = self.row_attrs(i, plain)
+        body = self.row_body(i, row, b'')
+        if not body and attrs is plain:
+            return b''  # пустая строка без группировки в файл не пишется
+        if body:
+            return b'<' + p + b'row' + attrs + b'>' + body + b'</' + p + b'row>'
+        return b'<' + p + b'row' + attrs + b'/>'
+
+    def apply(self):
+        """Возвращает новый XML листа."""
+        from openpyxl.utils import get_column_letter
+
+        sheet, data, p = self.sheet, self.sheet.data, self.sheet.prefix
+        self.h_letter = get_column_letter(self.h_col).encode('ascii')
+        out = [data[:sheet.start]]
+        pos = sheet.start
+        expected = self.min_row
+
+        def missing(upto):
+            for row in range(expected, upto):
+                out.append(self.new_row(row))
+
+        for row, m in sheet.rows():
+            if row < self.min_row:
+                continue
+            if row > self.last_row:
+                if expected <= self.last_row:
+                    out.append(data[pos:m.start()])
+                    pos = m.start()
+                    missing(self.last_row + 1)
+                    expected = self.last_row + 1
+                break
+            out.append(data[pos:m.start()])
+            missing(row)
+            expected = row + 1
+            i = row - self.min_row
+            attrs = self.row_attrs(i, m.group(1))
+            body = self.row_body(i, row, m.group(3))
+            if attrs is m.group(1) and body is m.group(3):
+                out.append(m.group(0))
+            elif body:
+                out.append(b'<' + p + b'row' + attrs + b'>' + body + b'</' + p + b'row>')
+            else:
+                out.append(b'<' + p + b'row' + attrs + b'/>')
+            pos = m.end()
+        out.append(data[pos:sheet.end])
+        pos = sheet.end
+        missing(self.last_row + 1)
+        out.append(data[pos:])
+
+        # Значения — как в книге, загруженной с data_only=True: формулы заменяются сохранёнными результатами
+        data = sheet.without_formulas(b''.join(out))
+        if self.outline is not None:
+            return self.outline_properties(data)
+        return data
+
+    def outline_properties(self, data):
+        # Как у openpyxl-пути: итоги под группой и справа, символы структуры видны
+        p = self.sheet.prefix
+        m = re.search(rb'<' + p + rb'outlinePr\b([^>]*?)/>', data)
+        if m is None:
+            return data  # по умолчанию все три признака и так включены
+        attrs = _OUTLINE_ATTRS_RE.sub(b'', m.group(1)) + b' summaryBelow="1" summaryRight="1" showOutlineSymbols="1"'
+        return data[:m.start()] + b'<' + p + b'outlinePr' + attrs + b'/>' + data[m.end():]
+
+
+_COL_RE = re.compile(rb'<(?:\w+:)?col\s([^>]*?)/?>')
+_MERGE_RE = re.compile(rb'<(?:\w+:)?mergeCell\s([^>]*?)/?>')
+_XML_ATTR_RE = re.compile(rb'(\w+)=["\']([^"\']*)["\']')
+
+
+def scan_layout(stream, chunk_size=1 << 20):
+    """
+    Ширины столбцов и объединённые ячейки листа одним потоковым проходом по его XML (лист не загружается):
+    ([{атрибут <col>: значение}], [диапазоны <mergeCell ref>]). Нужен там, где лист открыт в режиме read_only,
+    — такой лист ни <cols>, ни <mergeCells> не читает.
+    """
+    columns, merged = [], []
+    tail = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        data = tail + chunk
+        # Незаконченный тег переносится в следующий кусок
+        cut = data.rfind(b'<') if chunk else len(data)
+        if cut < 0 or data.find(b'>', cut) >= 0:
+            cut = len(data)
+        for m in _COL_RE.finditer(data, 0, cut):
+            columns.append({k.decode('ascii'): v.decode('utf-8') for k, v in _XML_ATTR_RE.findall(m.group(1))})
+        for m in _MERGE_RE.finditer(data, 0, cut):
+            ref = attr(m.group(1), b'ref')
+            if ref:
+                merged.append(ref.decode('ascii'))
+        tail = data[cut:]
+        if not chunk:
+            return columns, merged
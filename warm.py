@@ -0,0 +1,106 @@
+# warm.py — «тёплая» книга для сессии GUI: последний разобранный исходник и анализ его строк держатся в памяти,
+# и повторный запуск того же файла с другими настройками только применяет этапы и сохраняет результат
+
+import json
+import threading
+from collections import OrderedDict
+
+# Какую долю памяти, доступной программе (свободная + уже занятая тёплыми книгами), могут занимать тёплые книги
+WARM_MEMORY_SHARE = 0.5
+# Поля конфига, от которых зависят диапазон данных и анализ строк (уровни, группировка)
+ANALYSIS_KEYS = ('min_row', 'color_column', 'hierarchy_column', 'scan_columns_by_row', 'palette', 'palette_unknown')
+
+
+def analysis_key(CONFIG):
+    return json.dumps([CONFIG.get(key) for key in ANALYSIS_KEYS], ensure_ascii=False, default=str)
+
+
+def available_memory():
+    import psutil
+    return psutil.virtual_memory().available
+
+
+class WarmAnalysis:
+    """
+    Анализ листов в памяти с интерфейсом checkpoint.Checkpoint (sheet/update), поэтому process_workbook
+    берёт из него диапазон так же, как из контрольной точки. Состояние строк лежит в 'rows' как есть —
+    снимок RowState (RowState.snapshot), без сериализации.
+    """
+    origin = "памяти прошлого запуска"
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def sheet(self, name):
+        return self.sheets.get(name)
+
+    def update(self, name, state):
+        self.sheets[name] = state
+
+
+class WarmEntry:
+    def __init__(self, workbook, sheet_names, size):
+        self.workbook = workbook  # исходная книга; обработка идёт только в её копиях (fork_workbook)
+        self.sheet_names = sheet_names  # разобранные листы; None — все
+        self.size = size
+        self.analysis = {}  # analysis_key -> {имя листа: состояние}
+        self.lock = threading.Lock()  # копии книги делаются по одной: fork_workbook читает её таблицы стилей
+
+    def covers(self, sheet_names):
+        return self.sheet_names is None or set(sheet_names) <= set(self.sheet_names)
+
+    def analysis_for(self, CONFIG):
+        return WarmAnalysis(self.analysis.setdefault(analysis_key(CONFIG), {}))
+
+
+class WarmCache:
+    """
+    Разобранные исходные книги по ключу (путь, время изменения) с LRU-вытеснением.
+    size — оценка памяти книги в байтах; суммарно не больше budget, а без него — не больше
+    WARM_MEMORY_SHARE памяти, доступной на момент добавления книги. Изменённый файл получает новый
+    ключ, а старая запись вытесняется как давно не использованная. Потокобезопасен.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def limit(self):
+        if self.budget is not None:
+            return self.budget
+        # Книги в кэше уже занимают память, поэтому в доступную она не входит
+        return int((available_memory() + sum(e.size for e in self.entries.values())) * WARM_MEMORY_SHARE)
+
+    def get(self, key, sheet_names):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not entry.covers(sheet_names):
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, workbook, sheet_names, size):
+        """Кладёт книгу и возвращает её запись; книга больше бюджета не кэшируется (возвращается None)."""
+        entry = WarmEntry(workbook, sheet_names, size)
+        with self.lock:
+            self.entries.pop(key, None)
+            # Книги того же файла с другим временем изменения устарели
+            for stale in [k for k in self.entries if k[0] == key[0]]:
+                del self.entries[stale]
+            limit = self.limit()
+            if size > limit:
+                return None
+            self.entries[key] = entry
+            while sum(e.size for e in self.entries.values()) > limit:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @property
+    def used(self):
+        with self.lock:
+            return sum(e.size for e in self.entries.values())